@@ -1,4 +1,7 @@
-import serial, utm, plotly.graph_objs as go, plotly, os, time, numpy as np, logging
+import serial, utm, plotly.graph_objs as go, plotly, os, sys, time, asyncio, numpy as np, logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'v2'))
+from serial_io import SerialHub
 
 ar_ser, em_ser = "COM3", "COM8"
 # COM 9 ''' ulr_ard || COM7 ''' /dev/gps_tail
@@ -50,6 +53,47 @@ def calculate_new_points(x, y, direction, distance):
     
     return new_x1, new_y1, new_x2, new_y2, new_x3, new_y3, new_x4, new_y4, new_x5, new_y5, new_x6, new_y6
 
+async def wait_for_date(emlid):
+    async with SerialHub() as hub:
+        hub.add('emlid', emlid)
+        async for record in hub.subscribe():
+            parse_nmea_data(record.data.decode('ascii', errors='replace'))
+            if start_time is not None:
+                break
+
+async def record_data(emlid, arduino, data_file):
+    ded = False
+    async with SerialHub() as hub:
+        hub.add('emlid', emlid)
+        hub.add('arduino', arduino)
+        async for record in hub.subscribe():
+            if record.device == 'arduino':
+                # The latest line of the array is paired with the next fix
+                distances = record.data.decode('ascii', errors='replace').strip().split(', ')
+                d1, d2, d3, d4, d5, d6, d7 = float(distances[0]), float(distances[1]), float(distances[2]), float(distances[3]), float(distances[4]), float(distances[5]), float(distances[6])
+                ded = True
+                continue
+
+            parsed_data = parse_nmea_data(record.data.decode('ascii', errors='replace'))
+            if parsed_data and isinstance(parsed_data, tuple) and ded:
+                if last_direction is not None:
+                    time_utc, lat, lon = parsed_data
+                    print(f"[Rover] Time: {time_utc}, Lat: {lat}, Lon: {lon}, Dist: {d1}, {d2}, {d3}, {d4}, {d5}, {d6}, {d7} cm")
+
+                #     x, y, _, _ = utm.from_latlon(lat, lon)
+
+                # if not origin_set:
+                #     origin_x, origin_y = x, y
+                #     origin_set = True
+
+                # rel_x, rel_y = x - origin_x, y - origin_y
+                rel_x, rel_y = lat, lon
+
+                # new_x1, new_y1, new_x2, new_y2, new_x3, new_y3, new_x5, new_y5, new_x6, new_y6, new_x7, new_y7 = calculate_new_points(rel_x, rel_y, last_direction, 1.7)
+
+                data_file.write(f"{time_utc}, {rel_x}, {rel_y}, {last_direction}, {d1}, {d2}, {d3}, {d4}, {d5}, {d6}, {d7}\n")
+                data_file.flush()
+
 emlid = serial.Serial(em_ser, 11520, timeout=.1)
 arduino = serial.Serial(ar_ser, 9600, timeout=.1)
 
@@ -57,16 +101,13 @@ time.sleep(1)
 emlid.flushInput()
 arduino.flushInput()
 
-origin_set, ded = False, False
+origin_set = False
 origin_x, origin_y, last_direction = 0, 0, 0
 x, y = 1, 1
 
 time.sleep(0.1)
 
-while start_time is None:
-    if emlid.in_waiting > 0:
-        data = emlid.readline().decode('ascii', errors='replace')
-        parse_nmea_data(data)
+asyncio.run(wait_for_date(emlid))
 
 folder_name = start_time.replace(':', '-')
 folder_path = os.path.join('data', folder_name)
@@ -79,34 +120,7 @@ while not os.path.exists(folder_path):
 
 try:
     with open(os.path.join(folder_path, 'data.txt'), 'w') as data_file:
-    
-        while True:
-            if emlid.in_waiting > 0:
-                data = emlid.readline().decode('ascii', errors='replace')
-                parsed_data = parse_nmea_data(data)
-                if parsed_data and isinstance(parsed_data, tuple):
-                    if arduino.in_waiting > 0:
-                        distances = (arduino.readline()[:-1].decode('ascii', errors='replace')).strip().split(', ')
-                        d1, d2, d3, d4, d5, d6, d7 = float(distances[0]), float(distances[1]), float(distances[2]), float(distances[3]), float(distances[4]), float(distances[5]), float(distances[6])
-                        ded = True
-
-                    if ded and last_direction is not None:
-                        time_utc, lat, lon = parsed_data
-                        print(f"[Rover] Time: {time_utc}, Lat: {lat}, Lon: {lon}, Dist: {d1}, {d2}, {d3}, {d4}, {d5}, {d6}, {d7} cm")
-
-                    #     x, y, _, _ = utm.from_latlon(lat, lon)
-
-                    # if not origin_set:
-                    #     origin_x, origin_y = x, y
-                    #     origin_set = True
-
-                    # rel_x, rel_y = x - origin_x, y - origin_y
-                    rel_x, rel_y = lat, lon
-
-                    # new_x1, new_y1, new_x2, new_y2, new_x3, new_y3, new_x5, new_y5, new_x6, new_y6, new_x7, new_y7 = calculate_new_points(rel_x, rel_y, last_direction, 1.7)
-
-                    data_file.write(f"{time_utc}, {rel_x}, {rel_y}, {last_direction}, {d1}, {d2}, {d3}, {d4}, {d5}, {d6}, {d7}\n")
-                    data_file.flush()
+        asyncio.run(record_data(emlid, arduino, data_file))
 
 except KeyboardInterrupt:
     print("Gathering data...")
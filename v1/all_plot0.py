@@ -5,6 +5,11 @@ import plotly
 import os
 import time
 import numpy as np
+import sys
+import asyncio
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'v2'))
+from serial_io import SerialHub
 
 ar_ser = "COM3"
 # COM 9 ''' ulr_ard
@@ -75,6 +80,52 @@ def calculate_new_points(x, y, direction, distance):
     return new_x1, new_y1, new_x2, new_y2, new_x3, new_y3, new_x4, new_y4, new_x5, new_y5, new_x6, new_y6
 
 
+async def wait_for_date(emlid):
+    async with SerialHub() as hub:
+        hub.add('emlid', emlid)
+        async for record in hub.subscribe():
+            parse_nmea_data(record.data.decode('ascii', errors='replace'))
+            if start_time is not None:
+                break
+
+async def record_data(emlid, arduino, data_file):
+    global origin_set, origin_x, origin_y, x, y
+    ded = False
+    async with SerialHub() as hub:
+        hub.add('emlid', emlid)
+        hub.add('arduino', arduino)
+        async for record in hub.subscribe():
+            if record.device == 'arduino':
+                # The latest line of the array is paired with the next fix
+                distances = record.data.decode('ascii', errors='replace').strip().split(', ')
+                d1, d2, d3, d4, d5, d6, d7 = float(distances[0]), float(distances[1]), float(distances[2]), float(distances[3]), float(distances[4]), float(distances[5]), float(distances[6])
+                ded = True
+                continue
+
+            parsed_data = parse_nmea_data(record.data.decode('ascii', errors='replace'))
+            if not ded:
+                # No distances to pair the fix with yet
+                continue
+            if parsed_data and isinstance(parsed_data, tuple):
+                if ded and last_direction is not None:
+                    time_utc, lat, lon = parsed_data
+                    print(f"[Rover] Time: {time_utc}, Lat: {lat}, Lon: {lon}, Dist: {d1}, {d2}, {d3}, {d4}, {d5}, {d6}, {d7} cm")
+
+                    x, y, _, _ = utm.from_latlon(lat, lon)
+
+                if not origin_set:
+                    origin_x, origin_y = x, y
+                    origin_set = True
+
+                rel_x = x - origin_x
+                rel_y = y - origin_y
+
+                new_x1, new_y1, new_x2, new_y2, new_x3, new_y3, new_x5, new_y5, new_x6, new_y6, new_x7, new_y7 = calculate_new_points(rel_x, rel_y, last_direction, 1.7)
+
+                data_file.write(f"{time_utc}, {new_x1}, {new_y1}, {d1}, {new_x2}, {new_y2}, {d2}, {new_x3}, {new_y3}, {d3}, {rel_x}, {rel_y}, {d4}, {new_x5}, {new_y5}, {d5}, {new_x6}, {new_y6}, {d6}, {new_x7}, {new_y7}, {d7}\n")
+                data_file.flush()
+
+
 emlid = serial.Serial(em_ser, 11520, timeout=.1)
 arduino = serial.Serial(ar_ser, 9600, timeout=.1)
 
@@ -87,14 +138,9 @@ origin_x, origin_y = 0, 0
 x, y = 1, 1
 last_direction = 0
 
-ded = False
-
 time.sleep(0.1)
 
-while start_time is None:
-    if emlid.in_waiting > 0:
-        data = emlid.readline().decode('ascii', errors='replace')
-        parse_nmea_data(data)
+asyncio.run(wait_for_date(emlid))
 
 folder_name = start_time.replace(':', '-')
 
@@ -102,34 +148,7 @@ try:
     folder_path = os.path.join('data', folder_name)
     os.makedirs(folder_path, exist_ok=True)
     with open(os.path.join(folder_path, 'data.txt'), 'w') as data_file:
-
-        while True:
-            if emlid.in_waiting > 0:
-                data = emlid.readline().decode('ascii', errors='replace')
-                parsed_data = parse_nmea_data(data)
-                if parsed_data and isinstance(parsed_data, tuple):
-                    if arduino.in_waiting > 0:
-                        distances = (arduino.readline()[:-1].decode('ascii', errors='replace')).strip().split(', ')
-                        d1, d2, d3, d4, d5, d6, d7 = float(distances[0]), float(distances[1]), float(distances[2]), float(distances[3]), float(distances[4]), float(distances[5]), float(distances[6])
-                        ded = True
-
-                    if ded and last_direction is not None:
-                        time_utc, lat, lon = parsed_data
-                        print(f"[Rover] Time: {time_utc}, Lat: {lat}, Lon: {lon}, Dist: {d1}, {d2}, {d3}, {d4}, {d5}, {d6}, {d7} cm")
-
-                        x, y, _, _ = utm.from_latlon(lat, lon)
-
-                    if not origin_set:
-                        origin_x, origin_y = x, y
-                        origin_set = True
-
-                    rel_x = x - origin_x
-                    rel_y = y - origin_y
-
-                    new_x1, new_y1, new_x2, new_y2, new_x3, new_y3, new_x5, new_y5, new_x6, new_y6, new_x7, new_y7 = calculate_new_points(rel_x, rel_y, last_direction, 1.7)
-
-                    data_file.write(f"{time_utc}, {new_x1}, {new_y1}, {d1}, {new_x2}, {new_y2}, {d2}, {new_x3}, {new_y3}, {d3}, {rel_x}, {rel_y}, {d4}, {new_x5}, {new_y5}, {d5}, {new_x6}, {new_y6}, {d6}, {new_x7}, {new_y7}, {d7}\n")
-                    data_file.flush()
+        asyncio.run(record_data(emlid, arduino, data_file))
 
 except KeyboardInterrupt:
     print("Gathering data...")
@@ -1,6 +1,12 @@
 import serial
 import matplotlib.pyplot as plt
 import utm
+import os
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'v2'))
+from live_view import LiveView, TrailBuffer
 
 def parse_nmea_data(data):
     data = data.strip().split(',')
@@ -21,30 +27,39 @@ def parse_nmea_data(data):
 
         return time_utc, lat, lon
 
-emlid = serial.Serial('COM4', 57600)
+def read_fixes(emlid, trail, stop):
+    origin_set = False
+    origin_x, origin_y = 0, 0
+    while not stop.is_set():
+        data = emlid.readline().decode('ascii', errors='replace')
+        parsed_data = parse_nmea_data(data)
+        if parsed_data:
+            time_utc, lat, lon = parsed_data
+            print(f"[Plot] Time: {time_utc}, Lat: {lat}, Lon: {lon}")
 
-plt.ion()
-fig, ax = plt.subplots()
+            x, y, _, _ = utm.from_latlon(lat, lon)
 
-origin_set = False
-origin_x, origin_y = 0, 0
+            if not origin_set:
+                origin_x, origin_y = x, y
+                origin_set = True
 
-while True:
-    data = emlid.readline().decode('ascii', errors='replace')
-    parsed_data = parse_nmea_data(data)
-    if parsed_data:
-        time_utc, lat, lon = parsed_data
-        print(f"[Plot] Time: {time_utc}, Lat: {lat}, Lon: {lon}")
+            trail.append(x - origin_x, y - origin_y)
 
-        x, y, _, _ = utm.from_latlon(lat, lon)
+emlid = serial.Serial('COM4', 57600, timeout=0.5)
 
-        if not origin_set:
-            origin_x, origin_y = x, y
-            origin_set = True
+fig, ax = plt.subplots()
+ax.set_xlim(-10, 10)
+ax.set_ylim(-10, 10)
 
-        rel_x = x - origin_x
-        rel_y = y - origin_y
+# The fixes are read on their own thread, the plot is redrawn on a timer whatever their rate
+trail = TrailBuffer()
+view = LiveView(fig)
+view.add(ax.scatter([], [], c='green', marker='o'), trail, grow=True)
 
-        ax.scatter(rel_x, rel_y, c='green', marker='o')
-        plt.draw()
-        plt.pause(0.01)
\ No newline at end of file
+stop = threading.Event()
+reader = threading.Thread(target=read_fixes, args=(emlid, trail, stop), daemon=True)
+reader.start()
+plt.show()
+stop.set()
+reader.join()
+emlid.close()
@@ -1,17 +1,388 @@
+import os
+import time
+import json
+import argparse
 import datetime
-import random
+import numpy as np
 
-num_lines = int(input("Enter the number of lines to generate: "))
+ORIGIN = (34.907264, -120.447987)  # lat, lon of the test field
+START_TIME = datetime.datetime(2024, 7, 16, 17, 15, 4)
+EARTH_RADIUS = 6378137.0  # m
+TERRAIN_EXTENT = 30  # m, half width of the simulated field
+TERRAIN_RESOLUTION = 0.05  # m
 
-current_timestamp = datetime.datetime(2023, 5, 18, 22, 0, 0, 60000)
+GPS_RATE = 5  # Hz
+ROVER_SPEED = 1.0  # m/s
+LANE_LENGTH = 30  # m
+LANE_SPACING = 2  # m
+TURN_SMOOTHING = 1.0  # m of path averaged, rounds the corners so the rover turns like a real one
 
-with open("data\data.txt", "w") as f:
-    f.write("2023-05-18_22:00:00.60, 0.0, 0.0, 38.0\n")
+LIDAR_RATE = 4000  # measures per second
+LIDAR_ROTATION = 5.5  # Hz
+LIDAR_HEIGHT = 0.973  # m
+LIDAR_TILT = 35  # Degrees
+LIDAR_MAX_RANGE = 12  # m
 
-    for _ in range(1, num_lines):
-        current_timestamp += datetime.timedelta(seconds=1)
-        timestamp = current_timestamp.strftime("%Y-%m-%d_%H:%M:%S.%f")[:-3]
-        xdis = random.uniform(-0.02, 0.02)
-        ydis = random.uniform(-0.02, 0.02)
-        zdis = random.randint(35, 40)
-        f.write(f"{timestamp}, {xdis}, {ydis}, {zdis}\n")
+ULTRASONIC_RATE = 10  # Hz
+ULTRASONIC_HEIGHT = 0.75  # m
+ULTRASONIC_SPACING = 1.7  # m, as in all_plot0.calculate_new_points
+ULTRASONIC_OFFSETS = np.array([1, -1, 2, 0, -2, 3, -3])  # d1..d7 in units of ULTRASONIC_SPACING, to the right
+ULTRASONIC_MAX = 400  # cm
+
+IMU_RATE = 200  # Hz
+GRAVITY = 9.80665  # m/s2
+
+DEPTH_FPS = 2
+DEPTH_WIDTH = 424
+DEPTH_HEIGHT = 240
+DEPTH_HFOV = 87  # Degrees
+DEPTH_HEIGHT_ABOVE_GROUND = 0.973  # m
+DEPTH_TILT = 0  # Degrees, same convention as SENSOR_TILT in v2/realsense/main.py
+DEPTH_MAX_RANGE = 10  # m
+
+NOISE = {
+    'gps': 0.01,  # m
+    'heading': 0.5,  # Degrees
+    'lidar_distance': 5,  # mm
+    'lidar_angle': 0.1,  # Degrees
+    'lidar_dropout': 0.02,  # fraction of measures with no return
+    'ultrasonic': 0.5,  # cm
+    'depth': 0.002,  # relative depth error at 1 m, grows with distance squared
+    'depth_dropout': 0.01,
+    'accel': 0.05,  # m/s2
+    'gyro': 0.002,  # rad/s
+    'gyro_bias': 0.005,  # rad/s, constant
+}
+
+
+class Terrain:
+    def __init__(self, seed=0, slope=(0.01, -0.005), amplitude=0.08, wavelength=7.0, bumps=12, bump_height=0.15,
+                 step_x=12.0, step_height=0.1, extent=TERRAIN_EXTENT, resolution=TERRAIN_RESOLUTION):
+        rng = np.random.default_rng(seed)
+        self.slope = slope
+        self.amplitude = amplitude
+        self.wavelength = wavelength
+        self.bump_centers = rng.uniform(-extent / 2, extent / 2, (bumps, 2))
+        self.bump_heights = rng.uniform(-bump_height, bump_height, bumps)
+        self.bump_widths = rng.uniform(0.3, 1.5, bumps)
+        self.step_x = step_x
+        self.step_height = step_height
+        # the analytic surface is sampled once, rays are then cast against the raster
+        self.resolution = np.float32(resolution)
+        self.grid_origin = np.float32(-extent)
+        axis = np.arange(-extent, extent + resolution, resolution)
+        gx, gy = np.meshgrid(axis, axis)
+        self.grid = self.exact(gx, gy).astype(np.float32)
+
+    def exact(self, x, y):
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        k = 2 * np.pi / self.wavelength
+        z = self.slope[0] * x + self.slope[1] * y
+        z = z + self.amplitude * np.sin(k * x) * np.cos(0.7 * k * y)
+        for (cx, cy), height, width in zip(self.bump_centers, self.bump_heights, self.bump_widths):
+            z = z + height * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * width ** 2))
+        return z + np.where(x > self.step_x, self.step_height, 0.0)
+
+    def __call__(self, x, y):
+        size = self.grid.shape[1]
+        gx = np.clip((np.asarray(x, dtype=np.float32) - self.grid_origin) / self.resolution, 0, size - 1.001)
+        gy = np.clip((np.asarray(y, dtype=np.float32) - self.grid_origin) / self.resolution, 0, size - 1.001)
+        ix, iy = gx.astype(np.int32), gy.astype(np.int32)
+        fx, fy = gx - ix, gy - iy
+        index = iy * size + ix
+        grid = self.grid.ravel()
+        top = grid[index] + (grid[index + 1] - grid[index]) * fx
+        bottom = grid[index + size] + (grid[index + size + 1] - grid[index + size]) * fx
+        return top + (bottom - top) * fy
+
+    def params(self):
+        return {'slope': list(self.slope), 'amplitude': self.amplitude, 'wavelength': self.wavelength,
+                'bump_centers': self.bump_centers.tolist(), 'bump_heights': self.bump_heights.tolist(),
+                'bump_widths': self.bump_widths.tolist(), 'step_x': self.step_x, 'step_height': self.step_height}
+
+
+def waypoints(pattern, lanes):
+    if pattern == 'line':
+        return np.array([[0.0, -LANE_LENGTH / 2], [0.0, LANE_LENGTH / 2]])
+    points = []
+    for lane in range(lanes):
+        x = (lane - (lanes - 1) / 2) * LANE_SPACING
+        ends = [-LANE_LENGTH / 2, LANE_LENGTH / 2]
+        if lane % 2:
+            ends.reverse()
+        points += [[x, ends[0]], [x, ends[1]]]
+    return np.array(points)
+
+
+def simulate_trajectory(t, pattern='serpentine', speed=ROVER_SPEED, lanes=6):
+    '''Rover position (local east/north, m) and heading (degrees clockwise from north) at times t, looping the path'''
+    path = waypoints(pattern, lanes)
+    if pattern == 'line':
+        path = np.vstack([path, path[::-1]])
+    else:
+        path = np.vstack([path, path[:1]])
+    segments = np.diff(path, axis=0)
+    lengths = np.hypot(segments[:, 0], segments[:, 1])
+    cumulative = np.concatenate([[0], np.cumsum(lengths)])
+    s = np.asarray(t) * speed
+
+    def along(offset):
+        distance = (s + offset) % cumulative[-1]
+        return np.interp(distance, cumulative, path[:, 0]), np.interp(distance, cumulative, path[:, 1])
+
+    # Moving average of the polyline over TURN_SMOOTHING meters, its direction is the difference of the window ends
+    half = TURN_SMOOTHING / 2
+    samples = [along(offset) for offset in np.linspace(-half, half, 9)]
+    x = np.mean([sample[0] for sample in samples], axis=0)
+    y = np.mean([sample[1] for sample in samples], axis=0)
+    heading = np.degrees(np.arctan2(samples[-1][0] - samples[0][0], samples[-1][1] - samples[0][1])) % 360
+    return x, y, heading
+
+
+def local_to_latlon(x, y, origin=ORIGIN):
+    lat0, lon0 = origin
+    lat = lat0 + np.degrees(y / EARTH_RADIUS)
+    lon = lon0 + np.degrees(x / (EARTH_RADIUS * np.cos(np.radians(lat0))))
+    return lat, lon
+
+
+def heading_vectors(heading):
+    h = np.radians(heading)
+    forward = np.stack([np.sin(h), np.cos(h)], axis=-1)
+    right = np.stack([np.cos(h), -np.sin(h)], axis=-1)
+    return forward, right
+
+
+def cast_to_terrain(terrain, origin_xy, origin_z, horizontal, drop, max_range, iterations=4):
+    '''Distance along unit rays (horizontal part, downward part) from origin to the terrain, 0 when there is no hit'''
+    hits = drop > 1e-3
+    safe_drop = np.where(hits, drop, 1.0)
+    s = (origin_z - terrain(origin_xy[..., 0], origin_xy[..., 1])) / safe_drop
+    for _ in range(iterations):
+        point = origin_xy + horizontal * s[..., np.newaxis]
+        s = (origin_z - terrain(point[..., 0], point[..., 1])) / safe_drop
+    hits &= (s > 0) & (s <= max_range)
+    return np.where(hits, s, 0.0)
+
+
+def utc_fields(t, start=START_TIME):
+    '''hhmmss.ss, ddmmyy and date parts for session times t, as fixed width strings'''
+    day_start = datetime.datetime(start.year, start.month, start.day)
+    centiseconds = np.round(((start - day_start).total_seconds() + np.asarray(t)) * 100).astype(np.int64)
+    day = centiseconds // 8640000
+    cs = centiseconds % 8640000
+    utc = np.char.mod('%06d', (cs // 360000) * 10000 + (cs // 6000 % 60) * 100 + cs // 100 % 60)
+    utc = np.char.add(np.char.add(utc, '.'), np.char.mod('%02d', cs % 100))
+    dates = {d: day_start + datetime.timedelta(days=int(d)) for d in np.unique(day)}
+    ddmmyy = np.array([dates[d].strftime('%d%m%y') for d in day])
+    zda_date = np.array([dates[d].strftime('%d,%m,%Y') for d in day])
+    iso_date = np.array([dates[d].strftime('%Y-%m-%d') for d in day])
+    return utc, ddmmyy, zda_date, iso_date
+
+
+def format_rows(fmt, columns):
+    rows = np.empty((len(columns[0]), len(columns)), dtype=object)
+    for i, column in enumerate(columns):
+        rows[:, i] = column
+    return (fmt * len(rows)) % tuple(rows.ravel())
+
+
+def write_rows(path, fmt, columns, chunk=200000):
+    with open(path, 'w') as f:
+        for start in range(0, len(columns[0]), chunk):
+            f.write(format_rows(fmt, [column[start:start + chunk] for column in columns]))
+
+
+def add_checksums(bodies):
+    '''Appends *CS to fixed width NMEA bodies, checksummed in bulk'''
+    width = len(bodies[0])
+    raw = np.frombuffer(''.join(bodies).encode('ascii'), dtype=np.uint8).reshape(len(bodies), width)
+    checksums = np.char.mod('%02X', np.bitwise_xor.reduce(raw, axis=1))
+    return np.char.add(np.char.add(np.char.add('$', bodies), '*'), checksums)
+
+
+def nmea_sentences(t, lat, lon, heading, speed, altitude, start=START_TIME):
+    '''GNZDA, GNGGA and GNRMC sentences for every fix, in that order'''
+    utc, ddmmyy, zda_date, _ = utc_fields(t, start)
+    lat_deg, lon_deg = np.floor(np.abs(lat)).astype(int), np.floor(np.abs(lon)).astype(int)
+    lat_min, lon_min = (np.abs(lat) - lat_deg) * 60, (np.abs(lon) - lon_deg) * 60
+    ns = np.where(lat >= 0, 'N', 'S')
+    ew = np.where(lon >= 0, 'E', 'W')
+    coordinates = format_rows('%02d%011.8f,%s,%03d%011.8f,%s\n', [lat_deg, lat_min, ns, lon_deg, lon_min, ew]).split('\n')[:-1]
+    zda = format_rows('GNZDA,%s,%s,00,00\n', [utc, zda_date]).split('\n')[:-1]
+    gga = format_rows('GNGGA,%s,%s,4,12,0.6,%08.3f,M,0.000,M,1.0,0000\n', [utc, coordinates, altitude]).split('\n')[:-1]
+    rmc = format_rows('GNRMC,%s,A,%s,%06.2f,%06.2f,%s,,,R\n', [utc, coordinates, speed * 1.943844, heading, ddmmyy]).split('\n')[:-1]
+    return add_checksums(zda), add_checksums(gga), add_checksums(rmc)
+
+
+def lidar_measures(terrain, t, pattern, rng, noise):
+    x, y, heading = simulate_trajectory(t, pattern)
+    angle = (360 * LIDAR_ROTATION * t) % 360
+    new_scan = np.concatenate([[True], np.diff(angle) < 0])
+    measured_angle = (angle + rng.normal(0, noise['lidar_angle'], len(t))) % 360
+    forward, right = heading_vectors(heading)
+    a, tilt = np.radians(angle), np.radians(LIDAR_TILT)
+    horizontal = forward * (np.cos(a) * np.cos(tilt))[:, np.newaxis] + right * np.sin(a)[:, np.newaxis]
+    drop = np.cos(a) * np.sin(tilt)
+    rover = np.stack([x, y], axis=-1)
+    distance = cast_to_terrain(terrain, rover, terrain(x, y) + LIDAR_HEIGHT, horizontal, drop, LIDAR_MAX_RANGE) * 1000
+    distance += rng.normal(0, noise['lidar_distance'], len(t)) * (distance > 0)
+    distance[rng.random(len(t)) < noise['lidar_dropout']] = 0
+    distance = np.round(np.clip(distance, 0, None) * 4) / 4
+    quality = np.where(distance > 0, 15, 0)
+    return new_scan, quality, np.round(measured_angle * 64) / 64, distance
+
+
+def ultrasonic_distances(terrain, t, pattern, rng, noise):
+    x, y, heading = simulate_trajectory(t, pattern)
+    _, right = heading_vectors(heading)
+    offsets = ULTRASONIC_OFFSETS * ULTRASONIC_SPACING
+    sensor_x = x[:, np.newaxis] + right[:, 0:1] * offsets
+    sensor_y = y[:, np.newaxis] + right[:, 1:2] * offsets
+    distance = (terrain(x, y)[:, np.newaxis] + ULTRASONIC_HEIGHT - terrain(sensor_x, sensor_y)) * 100
+    distance += rng.normal(0, noise['ultrasonic'], distance.shape)
+    return np.clip(np.round(distance), 0, ULTRASONIC_MAX)
+
+
+def imu_samples(t, pattern, rng, noise):
+    '''RealSense accel (m/s2) and gyro (rad/s) samples in camera axes: x right, y down, z forward'''
+    x, y, heading = simulate_trajectory(t, pattern)
+    vx, vy = np.gradient(x, t), np.gradient(y, t)
+    ax, ay = np.gradient(vx, t), np.gradient(vy, t)
+    forward, right = heading_vectors(heading)
+    a_forward = ax * forward[:, 0] + ay * forward[:, 1]
+    a_right = ax * right[:, 0] + ay * right[:, 1]
+    # Clockwise seen from above is a positive rotation about the down axis
+    yaw_rate = np.gradient(np.unwrap(np.radians(heading)), t)
+    n = len(t)
+    accel = np.stack([a_right, np.full(n, -GRAVITY), a_forward], axis=-1) + rng.normal(0, noise['accel'], (n, 3))
+    gyro = np.stack([np.zeros(n), yaw_rate, np.zeros(n)], axis=-1) + rng.normal(0, noise['gyro'], (n, 3))
+    gyro[:, 1] += noise['gyro_bias']
+    return accel, gyro
+
+
+def depth_intrinsics(width=DEPTH_WIDTH, height=DEPTH_HEIGHT):
+    fx = (width / 2) / np.tan(np.radians(DEPTH_HFOV / 2))
+    return {'width': width, 'height': height, 'fx': fx, 'fy': fx, 'ppx': width / 2, 'ppy': height / 2}
+
+
+def depth_frame(terrain, x, y, heading, intrinsics, rng, noise):
+    '''uint16 depth image (mm) seen by a camera looking along the heading, tilted down by DEPTH_TILT'''
+    u = (np.arange(intrinsics['width']) - intrinsics['ppx']) / intrinsics['fx']
+    v = (np.arange(intrinsics['height']) - intrinsics['ppy']) / intrinsics['fy']
+    u, v = np.meshgrid(u, v)
+    tilt = np.radians(DEPTH_TILT)
+    # camera axes: x right, y down, z forward; z is the value stored in the depth image
+    forward_part = np.cos(tilt) - v * np.sin(tilt)
+    drop = np.sin(tilt) + v * np.cos(tilt)
+    forward, right = heading_vectors(heading)
+    horizontal = forward * forward_part[..., np.newaxis] + right * u[..., np.newaxis]
+    norm = np.sqrt(u ** 2 + v ** 2 + 1)
+    origin = np.broadcast_to(np.array([x, y]), horizontal.shape)
+    s = cast_to_terrain(terrain, origin, terrain(x, y) + DEPTH_HEIGHT_ABOVE_GROUND,
+                        horizontal / norm[..., np.newaxis], drop / norm, DEPTH_MAX_RANGE * np.sqrt(2))
+    z = s / norm
+    z *= 1 + rng.normal(0, noise['depth'], z.shape) * z
+    z[(z > DEPTH_MAX_RANGE) | (rng.random(z.shape) < noise['depth_dropout'])] = 0
+    return np.round(z * 1000).astype(np.uint16)
+
+
+def generate_session(output, duration=60, pattern='serpentine', seed=0, noise_scale=1.0, gps_rate=GPS_RATE,
+                     lidar_rate=LIDAR_RATE, ultrasonic_rate=ULTRASONIC_RATE, depth_fps=DEPTH_FPS,
+                     depth_size=(DEPTH_WIDTH, DEPTH_HEIGHT), start=START_TIME, imu_rate=IMU_RATE, flat=False):
+    rng = np.random.default_rng(seed)
+    noise = {key: value * noise_scale for key, value in NOISE.items()}
+    # A flat field is what calibrate.py expects for a calibration pass
+    terrain = Terrain(seed, slope=(0, 0), amplitude=0, bumps=0, step_height=0) if flat else Terrain(seed)
+    folder = os.path.join(output, f"data_{start.strftime('%Y%m%d_%H%M%S')}")
+    # Another pass with the same start would mix its files with this one's
+    if os.path.exists(folder):
+        raise FileExistsError(f"{folder} already exists, give the session another start time")
+    os.makedirs(folder)
+    counts = {}
+
+    t_gps = np.arange(0, duration, 1 / gps_rate)
+    x, y, heading = simulate_trajectory(t_gps, pattern)
+    z = terrain(x, y)
+    lat, lon = local_to_latlon(x + rng.normal(0, noise['gps'], len(x)), y + rng.normal(0, noise['gps'], len(y)))
+    measured_heading = (heading + rng.normal(0, noise['heading'], len(heading))) % 360
+    write_rows(os.path.join(folder, 'gps_data.txt'), '%r,%.15g,%.15g,%.2f\n', [t_gps, lat, lon, measured_heading])
+    zda, gga, rmc = nmea_sentences(t_gps, lat, lon, measured_heading, ROVER_SPEED, z, start)
+    write_rows(os.path.join(folder, 'nmea_data.txt'), '%r,%s\n%r,%s\n%r,%s\n', [t_gps, zda, t_gps, gga, t_gps, rmc])
+    write_rows(os.path.join(folder, 'truth.txt'), '%r,%.4f,%.4f,%.4f,%.2f\n', [t_gps, x, y, z, heading])
+    counts['gps fixes'] = len(t_gps)
+
+    t_lidar = np.arange(0, duration, 1 / lidar_rate)
+    new_scan, quality, angle, distance = lidar_measures(terrain, t_lidar, pattern, rng, noise)
+    write_rows(os.path.join(folder, 'lidar_data.txt'), '%r,%s,%d,%r,%r\n',
+               [t_lidar, np.where(new_scan, 'True', 'False'), quality, angle, distance])
+    counts['lidar measures'] = len(t_lidar)
+
+    t_ultrasonic = np.arange(0, duration, 1 / ultrasonic_rate)
+    ultrasonic = ultrasonic_distances(terrain, t_ultrasonic, pattern, rng, noise)
+    write_rows(os.path.join(folder, 'arduino_data.txt'), '%r,' + ', '.join(['%d'] * 7) + '\n',
+               [t_ultrasonic] + [ultrasonic[:, i] for i in range(7)])
+    counts['ultrasonic lines'] = len(t_ultrasonic)
+
+    # v1 all_plot format, latest ultrasonic line at each fix
+    latest = np.clip(np.searchsorted(t_ultrasonic, t_gps, side='right') - 1, 0, None)
+    utc, _, _, iso_date = utc_fields(t_gps, start)
+    v1_time = np.char.add(np.char.add(iso_date, '_'), [f"{u[:2]}:{u[2:4]}:{u[4:]}" for u in utc])
+    write_rows(os.path.join(folder, 'data.txt'), '%s, %.15g, %.15g, %.1f' + ', %.1f' * 7 + '\n',
+               [v1_time, lat, lon, measured_heading] + [ultrasonic[latest, i] for i in range(7)])
+
+    if imu_rate > 0:
+        t_imu = np.arange(0, duration, 1 / imu_rate)
+        accel, gyro = imu_samples(t_imu, pattern, rng, noise)
+        write_rows(os.path.join(folder, 'imu_data.txt'), '%r' + ',%.5f' * 6 + '\n',
+                   [t_imu] + [accel[:, i] for i in range(3)] + [gyro[:, i] for i in range(3)])
+        counts['imu samples'] = len(t_imu)
+
+    if depth_fps > 0:
+        intrinsics = depth_intrinsics(*depth_size)
+        t_depth = np.arange(0, duration, 1 / depth_fps)
+        dx, dy, dheading = simulate_trajectory(t_depth, pattern)
+        with open(os.path.join(folder, 'depth_data.npy'), 'wb') as f:
+            for t, fx, fy, fh in zip(t_depth, dx, dy, dheading):
+                depth = depth_frame(terrain, fx, fy, fh, intrinsics, rng, noise)
+                np.save(f, {'timestamp': float(t), 'depth': depth, 'depth_scale': 0.001, 'intrinsics': intrinsics})
+        counts['depth frames'] = len(t_depth)
+
+    with open(os.path.join(folder, 'terrain.json'), 'w') as f:
+        json.dump({'origin': ORIGIN, 'start': start.isoformat(), 'seed': seed, 'pattern': pattern,
+                   'noise': noise, 'terrain': terrain.params()}, f, indent=2)
+    return folder, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic survey session (GPS, lidar, ultrasonic and depth streams).")
+    parser.add_argument('--output', default='data', help="folder the data_YYYYMMDD_HHMMSS session is created in")
+    parser.add_argument('--duration', type=float, default=60, help="seconds")
+    parser.add_argument('--pattern', choices=['serpentine', 'line'], default='serpentine')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--noise', type=float, default=1.0, help="scale applied to every noise level, 0 for perfect data")
+    parser.add_argument('--gps-rate', type=float, default=GPS_RATE)
+    parser.add_argument('--lidar-rate', type=float, default=LIDAR_RATE)
+    parser.add_argument('--ultrasonic-rate', type=float, default=ULTRASONIC_RATE)
+    parser.add_argument('--depth-fps', type=float, default=DEPTH_FPS, help="0 to skip depth frames")
+    parser.add_argument('--depth-size', default=f"{DEPTH_WIDTH}x{DEPTH_HEIGHT}")
+    parser.add_argument('--imu-rate', type=float, default=IMU_RATE, help="0 to skip the IMU samples")
+    parser.add_argument('--flat', action='store_true', help="flat field, for calibration passes")
+    parser.add_argument('--start', type=lambda value: datetime.datetime.strptime(value, '%Y%m%d_%H%M%S'),
+                        default=START_TIME, help="start time of the session and of its folder name, YYYYMMDD_HHMMSS")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    try:
+        folder, counts = generate_session(args.output, args.duration, args.pattern, args.seed, args.noise,
+                                          args.gps_rate, args.lidar_rate, args.ultrasonic_rate, args.depth_fps,
+                                          tuple(int(v) for v in args.depth_size.split('x')), start=args.start,
+                                          imu_rate=args.imu_rate, flat=args.flat)
+    except FileExistsError as e:
+        parser.error(str(e))
+    print(f"Generated {', '.join(f'{n} {name}' for name, n in counts.items())} in {folder} "
+          f"({time.perf_counter() - start_time:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
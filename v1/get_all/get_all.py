@@ -1,4 +1,7 @@
-import serial, time, keyboard
+import serial, time, keyboard, asyncio, os, sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'v2'))
+from serial_io import SerialHub
 
 def parse_nmea_data(data):
     d = data.strip().split(',')
@@ -6,18 +9,25 @@ def parse_nmea_data(data):
     if t == "GNGGA":
         return f"[Rover] Time: {d[1][:2]}:{d[1][2:4]}:{d[1][4:]}, Lat: {d[2][:2]}°{d[2][2:]}'{d[3]}, Lon: {d[4][:3]}°{d[4][3:]}'{d[5]}"
 
-emlid, arduino, ded = serial.Serial('COM8', 57600, timeout=.1), serial.Serial('COM3', 9600, timeout=.1), False
-# emlid, ded = serial.Serial('COM8', 57600, timeout=.1), False
+async def read_all(emlid, arduino):
+    d = None
+    async with SerialHub() as hub:
+        hub.add('emlid', emlid)
+        hub.add('arduino', arduino)
+        async for record in hub.subscribe():
+            data = record.data.decode('ascii', errors='replace')
+            if record.device == 'arduino':
+                if data: d = data
+            elif d is not None:
+                if em_parsed_data := parse_nmea_data(data): print(f'{em_parsed_data}, Dist: {d} cm')
+            if keyboard.is_pressed('s') or keyboard.is_pressed('c'):
+                break
+
+emlid, arduino = serial.Serial('COM8', 57600, timeout=.1), serial.Serial('COM3', 9600, timeout=.1)
+# emlid = serial.Serial('COM8', 57600, timeout=.1)
 
 time.sleep(1)
 emlid.flushInput()
 arduino.flushInput()
 
-while True:
-    if arduino.in_waiting > 0:
-        if ar_data := arduino.readline()[:-1].decode('ascii', errors='replace'): d, ded = ar_data, True
-    if ded and emlid.in_waiting > 0:
-        em_data = emlid.readline().decode('ascii', errors='replace')
-        if em_parsed_data := parse_nmea_data(em_data): print(f'{em_parsed_data}, Dist: {d} cm')
-    if keyboard.is_pressed('s') or keyboard.is_pressed('c'):
-        break
+asyncio.run(read_all(emlid, arduino))
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+'''Benchmarks the processing hot paths on synthetic inputs and stores throughput and peak memory as JSON
+
+    python benchmark.py --sizes 1000 10000 100000
+    python benchmark.py --only voxel_downsample --compare benchmarks/20240716_171504_abc1234.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import shutil
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', 'v1', 'generate_data'))
+import generate_data
+import cloud_io
+import ground
+import processing
+import projection
+import registration
+from replay import deproject_depth, ReplayIntrinsics
+from pool import FramePool, default_workers
+from depth_projection import RayTable
+
+RESULTS_FOLDER = os.path.join(HERE, 'benchmarks')
+SIZES = [1000, 10000, 100000]
+REPEAT = 3
+MAX_SECONDS = 10  # larger sizes are skipped once a run takes longer than this
+REGRESSION_THRESHOLD = 0.1
+WORK_FOLDER = None  # temporary folder of the file benchmarks, created by main
+
+SENSOR_HEIGHT = 973  # mm
+SENSOR_TILT = 35  # Degrees
+POOL_FRAMES = 16  # frames the points are split into for the process pool
+LIDAR_BATCH = 32  # measures of an express packet, the batch main.py usually gets from the driver
+
+
+def synthetic_trajectory(size, rng):
+    t = np.linspace(0, size / generate_data.LIDAR_RATE, size)
+    x, y, heading = generate_data.simulate_trajectory(t)
+    lat, lon = generate_data.local_to_latlon(x, y)
+    return t, lat, lon, heading
+
+
+def synthetic_depth(size, rng):
+    width = max(int(np.sqrt(size * 16 / 9)), 1)
+    height = max(size // width, 1)
+    intrinsics = generate_data.depth_intrinsics(width, height)
+    terrain = generate_data.Terrain()
+    noise = {key: 0 for key in generate_data.NOISE}
+    return generate_data.depth_frame(terrain, 0, 0, 0, intrinsics, rng, noise), ReplayIntrinsics(**intrinsics)
+
+
+def synthetic_vertices(size, rng):
+    depth, intrinsics = synthetic_depth(size, rng)
+    return deproject_depth(depth, intrinsics, 0.001)
+
+
+def setup_depth_projection(size, rng):
+    depth, intrinsics = synthetic_depth(size, rng)
+    return RayTable(intrinsics, 0.001, 0.15, 4), depth
+
+
+def synthetic_points(size, rng):
+    vertices = synthetic_vertices(size, rng)
+    return np.stack([vertices['f0'], vertices['f1'], vertices['f2']], axis=-1).astype(np.float64)
+
+
+def setup_nmea(size, rng):
+    t, lat, lon, heading = synthetic_trajectory(size // 2 + 1, rng)
+    _, gga, rmc = generate_data.nmea_sentences(t, lat, lon, heading, generate_data.ROVER_SPEED, np.zeros(len(t)))
+    return list(np.ravel(np.column_stack([gga, rmc])))[:size]
+
+
+def run_nmea(lines):
+    for line in lines:
+        processing.parse_nmea(line)
+
+
+def setup_lidar(size, rng):
+    _, lat, lon, heading = synthetic_trajectory(size, rng)
+    angle = rng.uniform(-45, 45, size) % 360
+    distance = rng.uniform(1000, 2000, size)
+    return lat, lon, heading, angle, distance
+
+
+def run_lidar(state):
+    # A batch of the driver at a time, with the heading of the last fix, as main.py processes them
+    lat, lon, heading, angle, distance = state
+    for start in range(0, len(lat), LIDAR_BATCH):
+        batch = slice(start, start + LIDAR_BATCH)
+        processing.georeference_lidar_point(lat[batch], lon[batch], heading[start], angle[batch], distance[batch],
+                                            SENSOR_HEIGHT, SENSOR_TILT)
+
+
+def setup_projection(size, rng):
+    _, lat, lon, _ = synthetic_trajectory(size, rng)
+    return lat, lon
+
+
+def run_projection(state):
+    # A fresh projection each run, its fitting is part of the cost
+    projection.Projection(state[0][0], state[1][0]).forward(*state)
+
+
+def run_vertices(vertices):
+    processing.extract_vertices(vertices)
+
+
+def run_depth_projection(state):
+    rays, depth = state
+    rays.project(depth)
+
+
+def run_voxel(points):
+    processing.voxel_downsample(points)
+
+
+def run_pointcloud(points):
+    processing.process_pointcloud(points, generate_data.ORIGIN[0], generate_data.ORIGIN[1], 30, 0.973, 0, max_distance=4)
+
+
+def setup_pool(size, rng):
+    return np.array_split(synthetic_points(size, rng), POOL_FRAMES)
+
+
+def run_pool(frames):
+    # Includes starting the workers, like a recording does once
+    pool = FramePool(processing.process_pointcloud, max(len(frame) for frame in frames), default_workers(),
+                     sensor_height=0.973, sensor_tilt=0, max_distance=4)
+    try:
+        for frame in frames:
+            pool.submit(frame, generate_data.ORIGIN[0], generate_data.ORIGIN[1], 30)
+            if pool.in_flight() >= len(pool.buffers):
+                pool.get()
+        while pool.in_flight():
+            pool.get()
+    finally:
+        pool.close()
+
+
+def setup_icp(size, rng):
+    points = synthetic_points(size, rng)
+    points = points[np.linalg.norm(points, axis=1) <= 4]
+    offset = registration.pose_matrix(0.08, -0.05, 0.03, 2)
+    return registration.transform_points(points, np.linalg.inv(offset)), points
+
+
+def run_icp(state):
+    registration.register(*state)
+
+
+def setup_ground(size, rng):
+    # Leveled and relative to the GPS position, as the recorder fits them, without the pixels lacking a depth
+    points = synthetic_points(size, rng)
+    points = processing.georeference_pointcloud(points[points[:, 2] > 0], *generate_data.ORIGIN, 30, 0.973, 0)
+    return points - [points[:, 0].min(), points[:, 1].min(), 0]
+
+
+def run_ground(points):
+    ground.segment_ground(points)
+
+
+def setup_cyglidar(size, rng):
+    size += size % 2
+    return list(rng.integers(0, 256, size * 3 // 2))
+
+
+def run_cyglidar(payload):
+    processing.decode_cyglidar_3d(payload, len(payload))
+
+
+def setup_file(size, rng):
+    points = synthetic_points(size, rng)
+    text_path = os.path.join(WORK_FOLDER, 'processed_data.txt')
+    bin_path = os.path.join(WORK_FOLDER, 'processed_data.bin')
+    with open(text_path, 'w') as f:
+        processing.write_points(f, 0.0, points)
+    processing.save_bin_data(bin_path, points)
+    return points, text_path, bin_path
+
+
+def run_text_write(state):
+    points, text_path, _ = state
+    with open(text_path, 'w') as f:
+        processing.write_points(f, 0.0, points)
+
+
+def run_text_load(state):
+    np.loadtxt(state[1], delimiter=',')
+
+
+def run_cloud_text_load(state):
+    cloud_io.load_cloud(state[1])
+
+
+def run_bin_write(state):
+    processing.save_bin_data(state[2], state[0])
+
+
+def run_bin_load(state):
+    processing.load_bin_data(state[2])
+
+
+def run_cloud_bin_load(state):
+    cloud_io.load_cloud(state[2])
+
+
+def setup_plot(size, rng):
+    import plotly.graph_objs as go
+    return synthetic_points(size, rng), go
+
+
+def run_plot(state):
+    points, go = state
+    fig = go.Figure(data=[go.Scatter3d(x=points[:, 0], y=points[:, 1], z=points[:, 2], mode='markers',
+                                       marker=dict(size=2, color=points[:, 2], colorscale='Balance'))])
+    fig.write_html(os.path.join(WORK_FOLDER, '3d_scatter_plot.html'))
+
+
+def setup_mesh(size, rng):
+    import plot
+    return synthetic_points(size, rng), plot
+
+
+def run_mesh(state):
+    points, plot = state
+    plot.save_as_ply(os.path.join(WORK_FOLDER, 'point_cloud.ply'), points[:, 0], points[:, 1], points[:, 2])
+
+
+def setup_obstacles(size, rng):
+    from obstacles import ObstacleDetector
+    # The ground line swept ahead of the rover, the batch of a read at a time as in main.py
+    terrain = generate_data.Terrain()
+    t = np.linspace(0, size / generate_data.LIDAR_RATE, size)
+    x, y, heading = generate_data.simulate_trajectory(t)
+    angle = np.radians((360 * generate_data.LIDAR_ROTATION * t) % 360)
+    forward = 1.4 * np.cos(angle)
+    x, y = x + forward * np.sin(np.radians(heading)), y + forward * np.cos(np.radians(heading))
+    z = terrain(x, y) + rng.normal(0, 0.01, size)
+    return ObstacleDetector, (x, y, z, time.time() + t)
+
+
+def run_obstacles(state):
+    ObstacleDetector, points = state
+    detector = ObstacleDetector()
+    for start in range(0, len(points[0]), LIDAR_BATCH):
+        detector.update(*(values[start:start + LIDAR_BATCH] for values in points))
+
+
+def setup_stream(size, rng):
+    import streaming
+    return streaming, synthetic_points(size, rng)
+
+
+def run_stream(state):
+    # Packing of a batch as the recorders publish it, then unpacking as the subscriber
+    streaming, points = state
+    for start in range(0, len(points), streaming.POINTS_PER_PACKET):
+        packet = streaming.encode_points(start, 0.0, points[start:start + streaming.POINTS_PER_PACKET])
+        streaming.decode_packet(packet)
+
+
+def setup_live_view(size, rng):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from live_view import LiveView, TrailBuffer
+    _, lat, lon, _ = synthetic_trajectory(size, rng)
+    x, y = projection.Projection(lat[0], lon[0]).forward(lat, lon)
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    trail = TrailBuffer()
+    view = LiveView(fig)
+    view.add(ax.scatter([], []), trail, grow=True)
+    for point in zip(x - x[0], y - y[0]):
+        trail.append(*point)
+    view.render()
+    return view, trail, rng
+
+
+def run_live_view(state):
+    # Redraws after new fixes, the same cost whatever the length of the history
+    view, trail, rng = state
+    for _ in range(10):
+        trail.append(*trail.latest + rng.normal(0, 1e-3, 2))
+        view.render()
+
+
+def setup_pty_nmea(size, rng):
+    import serial
+    import emulators
+    gnss = emulators.GnssEmulator(speed=emulators.AS_FAST_AS_POSSIBLE).start()
+    return serial.Serial(gnss.port, gnss.baudrate, timeout=1), size, gnss
+
+
+def run_pty_nmea(state):
+    ser, size, _ = state
+    for _ in range(size):
+        processing.parse_nmea(ser.readline().decode('ascii', errors='replace'))
+
+
+def setup_pty_rplidar(size, rng):
+    import emulators
+    from lidar_driver import RPLidarDriver
+    lidar = emulators.RPLidarEmulator(speed=emulators.AS_FAST_AS_POSSIBLE).start()
+    return RPLidarDriver(lidar.port), size, lidar
+
+
+def run_pty_rplidar(state):
+    lidar, size, _ = state
+    samples = 0
+    batches = lidar.iter_batches('express')
+    for batch in batches:
+        samples += len(batch)
+        if samples >= size:
+            break
+    batches.close()
+    lidar.stop()
+
+
+def teardown_pty_rplidar(state):
+    lidar, _, emulator = state
+    lidar.disconnect()
+    emulator.close()
+
+
+def setup_pty_cyglidar(size, rng):
+    import serial
+    import emulators
+    cyglidar = emulators.CygLidarEmulator(speed=emulators.AS_FAST_AS_POSSIBLE).start()
+    ser = serial.Serial(cyglidar.port, cyglidar.baudrate, timeout=1)
+    ser.write(emulators.CYGLIDAR_RUN_3D_COMMAND)
+    pixels = processing.CYGLIDAR_3D_LENGTH * 2 // 3
+    return ser, -(-size // pixels), bytearray(), cyglidar
+
+
+def run_pty_cyglidar(state):
+    ser, frames, buffer, _ = state
+    while frames > 0:
+        buffer += ser.read(max(ser.in_waiting, 1))
+        payloads, _ = processing.split_cyglidar_frames(buffer)
+        for payload in payloads:
+            processing.decode_cyglidar_3d(payload[1:])
+        frames -= len(payloads)
+
+
+def teardown_pty(state):
+    # The emulator's writer thread would otherwise compete with the benchmarks timed after it
+    state[0].close()
+    state[-1].close()
+
+
+BENCHMARKS = {
+    'nmea_parsing': (setup_nmea, run_nmea),
+    'lidar_georeference': (setup_lidar, run_lidar),
+    'utm_projection': (setup_projection, run_projection),
+    'vertex_extraction': (synthetic_vertices, run_vertices),
+    'depth_projection': (setup_depth_projection, run_depth_projection),
+    'voxel_downsample': (synthetic_points, run_voxel),
+    'pointcloud_processing': (synthetic_points, run_pointcloud),
+    'pool_processing': (setup_pool, run_pool),
+    'icp_registration': (setup_icp, run_icp),
+    'ground_segmentation': (setup_ground, run_ground),
+    'cyglidar_decoding': (setup_cyglidar, run_cyglidar),
+    'obstacle_detection': (setup_obstacles, run_obstacles),
+    'stream_encoding': (setup_stream, run_stream),
+    'live_view': (setup_live_view, run_live_view),
+    'pty_nmea': (setup_pty_nmea, run_pty_nmea, teardown_pty),
+    'pty_rplidar': (setup_pty_rplidar, run_pty_rplidar, teardown_pty_rplidar),
+    'pty_cyglidar': (setup_pty_cyglidar, run_pty_cyglidar, teardown_pty),
+    'text_write': (setup_file, run_text_write),
+    'text_load': (setup_file, run_text_load),
+    'cloud_text_load': (setup_file, run_cloud_text_load),
+    'bin_write': (setup_file, run_bin_write),
+    'bin_load': (setup_file, run_bin_load),
+    'cloud_bin_load': (setup_file, run_cloud_bin_load),
+    'plot_export': (setup_plot, run_plot),
+    'mesh_export': (setup_mesh, run_mesh),
+}
+
+
+def measure(run, state, repeat):
+    tracemalloc.start()
+    try:
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    return min(times), peak
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=HERE, text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def run_benchmarks(names, sizes, repeat, max_seconds):
+    results = []
+    for name in names:
+        setup, run, *teardown = BENCHMARKS[name]
+        for size in sizes:
+            rng = np.random.default_rng(0)
+            # A benchmark missing an optional dependency is skipped, a failing one is reported, the others still run
+            try:
+                state = setup(size, rng)
+                try:
+                    seconds, peak = measure(run, state, repeat)
+                finally:
+                    for close in teardown:
+                        close(state)
+            except ImportError as e:
+                print(f"{name:<24}{size:>10}  skipped: {e}")
+                results.append({'benchmark': name, 'size': size, 'skipped': str(e)})
+                break
+            except Exception as e:
+                reason = f"{type(e).__name__}: {e}"
+                print(f"{name:<24}{size:>10}  FAILED: {reason}")
+                results.append({'benchmark': name, 'size': size, 'failed': reason})
+                break
+            results.append({'benchmark': name, 'size': size, 'seconds': seconds,
+                            'items_per_second': size / seconds if seconds else None,
+                            'peak_memory_mb': peak / 1e6})
+            print(f"{name:<24}{size:>10}{seconds * 1000:>12.2f} ms{size / seconds if seconds else 0:>14.0f} /s{peak / 1e6:>10.1f} MB")
+            if seconds > max_seconds:
+                break
+    return results
+
+
+def latest_results(exclude=None):
+    if not os.path.isdir(RESULTS_FOLDER):
+        return None
+    files = sorted(f for f in os.listdir(RESULTS_FOLDER) if f.endswith('.json'))
+    files = [os.path.join(RESULTS_FOLDER, f) for f in files]
+    files = [f for f in files if f != exclude]
+    return files[-1] if files else None
+
+
+def compare(results, previous_path):
+    with open(previous_path, 'r') as f:
+        previous = json.load(f)
+    before = {(r['benchmark'], r['size']): r for r in previous['results'] if 'seconds' in r}
+    print(f"\nCompared to {previous['commit']} ({previous['date']}):")
+    regressions = 0
+    for result in results:
+        key = (result['benchmark'], result['size'])
+        if 'failed' in result:
+            print(f"{key[0]:<24}{key[1]:>10}   FAILED")
+            regressions += 1
+            continue
+        if 'seconds' not in result or key not in before:
+            continue
+        ratio = result['seconds'] / before[key]['seconds']
+        flag = ''
+        if ratio > 1 + REGRESSION_THRESHOLD:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif ratio < 1 - REGRESSION_THRESHOLD:
+            flag = '  faster'
+        print(f"{key[0]:<24}{key[1]:>10}{ratio:>9.2f}x time{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing hot paths on synthetic inputs.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help="benchmarks to run, all by default")
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--max-seconds', type=float, default=MAX_SECONDS)
+    parser.add_argument('--compare', help="results file to compare against, the latest one by default")
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    global WORK_FOLDER
+    WORK_FOLDER = tempfile.mkdtemp(prefix='tric_benchmark_')
+    commit, dirty = git_commit()
+    print(f"{'benchmark':<24}{'size':>10}{'time':>15}{'throughput':>16}{'peak':>13}")
+    try:
+        results = run_benchmarks(args.only or list(BENCHMARKS), args.sizes, args.repeat, args.max_seconds)
+    finally:
+        shutil.rmtree(WORK_FOLDER, ignore_errors=True)
+    report = {
+        'commit': commit + ('-dirty' if dirty else ''),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+    path = None
+    if not args.no_save:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        path = os.path.join(RESULTS_FOLDER, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{report['commit']}.json")
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to {path}")
+
+    # Failures count as regressions, the exit status tells whether there were any
+    previous = args.compare or latest_results(exclude=path)
+    regressions = compare(results, previous) if previous else sum('failed' in result for result in results)
+    if regressions:
+        sys.exit(f"\n{regressions} failures or regressions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''Bounded hand-off between the acquisition threads and the processing stage of the recorders'''
+import time
+import queue
+import threading
+from collections import deque
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, COALESCE, BLOCK)
+
+
+class BoundedQueue:
+    '''Queue holding at most maxsize items. When it is full, the policy decides what happens:
+
+    drop_oldest: the oldest pending item is discarded to make room
+    coalesce: get returns the latest pending item only, older ones are merged into it
+    block: put waits for room, the producer is slowed down to the consumer's pace
+    '''
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy!r}, expected one of {', '.join(POLICIES)}")
+        self.maxsize = max(int(maxsize), 1)
+        self.policy = policy
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.merged = 0
+        self.blocked_time = 0.0
+
+    def qsize(self):
+        return len(self.items)
+
+    def put(self, item, timeout=None):
+        '''Adds an item, returns False if it was not queued because the queue closed or a block timed out'''
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxsize:
+                if self.policy == BLOCK:
+                    start = time.perf_counter()
+                    full = not self.condition.wait_for(lambda: self.closed or len(self.items) < self.maxsize, timeout)
+                    self.blocked_time += time.perf_counter() - start
+                    if full or self.closed:
+                        return False
+                elif self.policy == COALESCE:
+                    self.items.popleft()
+                    self.merged += 1
+                else:
+                    self.items.popleft()
+                    self.dropped += 1
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        '''Next item, raises queue.Empty on timeout or once the queue is closed and drained'''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items or self.closed, timeout) or not self.items:
+                raise queue.Empty
+            if self.policy == COALESCE:
+                self.merged += len(self.items) - 1
+                item = self.items.pop()
+                self.items.clear()
+            else:
+                item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class FrameBuffer:
+    '''Ring of the latest timestamped frames, to pair each GPS fix with the frame nearest in time'''
+    def __init__(self, size):
+        self.frames = deque(maxlen=max(int(size), 1))
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, timestamp, frame):
+        with self.condition:
+            self.frames.append((timestamp, frame))
+            self.condition.notify_all()
+
+    def nearest(self, timestamp, max_offset=None, timeout=0):
+        '''(frame timestamp, frame) nearest to timestamp, or None if none is within max_offset seconds.
+        Waits up to timeout seconds for a frame taken after timestamp, so a fix is not paired with an older frame
+        while the next one is still being decoded.'''
+        with self.condition:
+            if timeout:
+                self.condition.wait_for(lambda: self.frames and self.frames[-1][0] >= timestamp, timeout)
+            if not self.frames:
+                return None
+            best = min(self.frames, key=lambda frame: abs(frame[0] - timestamp))
+        if max_offset is not None and abs(best[0] - timestamp) > max_offset:
+            return None
+        return best
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+'''Estimates the mounting constants of a recorder by least squares from a recorded pass over flat ground, and
+optionally over known target planes
+
+    python calibrate.py lidar data/data_20240716_171504
+    python calibrate.py realsense data/data_20240716_173012 --plane 0.7071,0.7071,0,-3256402.2
+
+Every measure of the session is georeferenced with the recorder's own functions, vectorized over the whole session,
+and the distances to the nearest target are minimized. Constants the targets do not constrain (e.g. ANGLE_FROM_GPS
+over flat ground) are left as they are. The result is written to calibration.json, which the recorders load over
+their constants when they start, and a copy is kept in the session folder.'''
+import os
+import ast
+import json
+import time
+import argparse
+import numpy as np
+
+from processing import lidar_offsets, camera_to_local
+from projection import Projection
+from cloud_io import load_gps, iter_npy_frames
+from config import CALIBRATION_FILE, load_calibration, session_config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GATE = 0.3  # meters, points farther than this from every target are left out, e.g. obstacles
+ROUNDS = 2  # the points are assigned to their nearest target again after each solve
+LOSS_SCALE = 0.02  # meters, larger residuals are down-weighted
+MAX_POINTS = 1000000
+FRAME_POINTS = 20000  # points sampled from each RealSense frame
+MAX_DISTANCE_FROM_SENSOR = 4  # meters, farther RealSense points are too noisy
+OBSERVABLE = 1e-9  # relative Jacobian column norm under which a constant is not constrained by the targets
+MAX_CONDITION = 100  # of the column scaled Jacobian, above it some constants are nearly interchangeable
+
+# Recorder script, mounting constants, and the ones calibrated by default. A single line lidar over flat ground only
+# sees SENSOR_HEIGHT / sin(SENSOR_TILT), its height is taken as measured unless --params asks for it.
+SENSORS = {
+    'lidar': ('main.py', ('SENSOR_HEIGHT', 'SENSOR_TILT', 'LIDAR_ORIENTATION', 'ANGLE_FROM_GPS', 'DISTANCE_FROM_GPS'),
+              ('SENSOR_TILT', 'LIDAR_ORIENTATION', 'ANGLE_FROM_GPS', 'DISTANCE_FROM_GPS')),
+    'realsense': (os.path.join('realsense', 'main.py'),
+                  ('SENSOR_HEIGHT', 'SENSOR_TILT', 'SENSOR_ORIENTATION', 'ANGLE_FROM_GPS', 'DISTANCE_FROM_GPS'),
+                  ('SENSOR_HEIGHT', 'SENSOR_TILT', 'SENSOR_ORIENTATION', 'ANGLE_FROM_GPS', 'DISTANCE_FROM_GPS')),
+}
+
+
+def recorder_constants(sensor):
+    '''Mounting constants as written in the recorder, read without importing it and its hardware libraries'''
+    script, names, _ = SENSORS[sensor]
+    with open(os.path.join(HERE, script)) as f:
+        tree = ast.parse(f.read())
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            if node.targets[0].id in names and node.targets[0].id not in constants:
+                constants[node.targets[0].id] = float(ast.literal_eval(node.value))
+    return {name: constants[name] for name in names}
+
+
+def session_poses(folder, timestamps):
+    '''(projection, origin, easting, northing, heading) at timestamps, positions interpolated between fixes and the
+    heading of the previous fix as the recorders use it, easting and northing relative to origin'''
+    gps = load_gps(os.path.join(folder, 'gps_data.txt'))
+    projection = Projection(gps[0, 1], gps[0, 2])
+    easting, northing = projection.forward(gps[:, 1], gps[:, 2])
+    origin = np.array([np.floor(easting[0]), np.floor(northing[0]), 0.0])
+    previous = np.clip(np.searchsorted(gps[:, 0], timestamps, side='right') - 1, 0, len(gps) - 1)
+    return (projection, origin, np.interp(timestamps, gps[:, 0], easting - origin[0]),
+            np.interp(timestamps, gps[:, 0], northing - origin[1]), gps[previous, 3])
+
+
+def load_lidar_session(folder, constants, rng, max_points=MAX_POINTS):
+    measures = np.loadtxt(os.path.join(folder, 'lidar_data.txt'), delimiter=',', usecols=(0, 3, 4), ndmin=2)
+    gps_times = load_gps(os.path.join(folder, 'gps_data.txt'))[:, 0]
+    measures = measures[(measures[:, 2] > 0) & (measures[:, 0] >= gps_times[0]) & (measures[:, 0] <= gps_times[-1])]
+    if len(measures) > max_points:
+        measures = measures[np.sort(rng.choice(len(measures), max_points, replace=False))]
+    projection, origin, easting, northing, heading = session_poses(folder, measures[:, 0])
+    # The recorder writes the angles turned by its LIDAR_ORIENTATION, the model turns them by the one it fits
+    angle = (measures[:, 1] - constants['LIDAR_ORIENTATION']) % 360
+    return {'easting': easting, 'northing': northing, 'heading': heading, 'angle': angle,
+            'distance': measures[:, 2]}, projection, origin
+
+
+def load_realsense_session(folder, constants, rng, max_points=MAX_POINTS, frame_points=FRAME_POINTS):
+    timestamps, points = [], []
+    for entry in iter_npy_frames(os.path.join(folder, 'pointcloud_data.npy')):
+        frame = np.asarray(entry['points'], dtype=np.float64).reshape(-1, 3)
+        frame = frame[np.any(frame != 0, axis=1) & (np.linalg.norm(frame, axis=1) <= MAX_DISTANCE_FROM_SENSOR)]
+        if len(frame) > frame_points:
+            frame = frame[rng.choice(len(frame), frame_points, replace=False)]
+        timestamps.append(np.full(len(frame), entry['timestamp']))
+        points.append(frame)
+    timestamps, points = np.concatenate(timestamps), np.vstack(points)
+    if len(points) > max_points:
+        keep = rng.choice(len(points), max_points, replace=False)
+        timestamps, points = timestamps[keep], points[keep]
+    projection, origin, easting, northing, heading = session_poses(folder, timestamps)
+    return {'easting': easting, 'northing': northing, 'heading': heading, 'points': points}, projection, origin
+
+
+def lidar_model(values, data):
+    '''East, north, up meters of every measure with the constants in values'''
+    d_easting, d_northing, delta_y = lidar_offsets(data['heading'], data['angle'], data['distance'],
+                                                   values['SENSOR_HEIGHT'], values['SENSOR_TILT'],
+                                                   values['LIDAR_ORIENTATION'], values['ANGLE_FROM_GPS'],
+                                                   values['DISTANCE_FROM_GPS'])
+    # Heights are in mm like the lidar constants
+    return np.column_stack([data['easting'] + d_easting, data['northing'] + d_northing, delta_y / 1000])
+
+
+def realsense_model(values, data):
+    local = camera_to_local(data['points'], data['heading'], values['SENSOR_HEIGHT'], values['SENSOR_TILT'],
+                            values['SENSOR_ORIENTATION'], values['ANGLE_FROM_GPS'], values['DISTANCE_FROM_GPS'])
+    local[:, 0] += data['easting']
+    local[:, 1] += data['northing']
+    return local
+
+
+MODELS = {'lidar': (load_lidar_session, lidar_model), 'realsense': (load_realsense_session, realsense_model)}
+
+
+def assign_targets(points, planes, gate=GATE):
+    '''Index of the nearest plane of every point, -1 beyond gate'''
+    distances = np.abs(points @ planes[:, :3].T + planes[:, 3])
+    nearest = np.argmin(distances, axis=1)
+    nearest[distances[np.arange(len(points)), nearest] > gate] = -1
+    return nearest
+
+
+def calibrate(model, data, planes, initial, names, gate=GATE, rounds=ROUNDS):
+    '''(calibrated constants, names left out as not observable, rms in meters, points used)'''
+    from scipy.optimize import least_squares
+
+    values = dict(initial)
+
+    def evaluate(x):
+        return model({**values, **dict(zip(free, x))}, data)
+
+    def residuals(x):
+        points = evaluate(x)[used]
+        return np.einsum('ij,ij->i', points, targets[:, :3]) + targets[:, 3]
+
+    def jacobian(x):
+        # Forward differences, every column is one vectorized evaluation of the whole session
+        x = np.asarray(x, dtype=float)
+        base = residuals(x)
+        columns = []
+        for i in range(len(x)):
+            step = 1e-6 * max(1.0, abs(x[i]))
+            shifted = x.copy()
+            shifted[i] += step
+            columns.append((residuals(shifted) - base) / step)
+        return np.column_stack(columns)
+
+    free = list(names)
+    rms, count = np.inf, 0
+    for _ in range(rounds):
+        assignment = assign_targets(evaluate(np.array([values[n] for n in free], dtype=float)), planes, gate)
+        used = assignment >= 0
+        count = int(used.sum())
+        if count < len(free):
+            raise ValueError(f"Only {count} points are within {gate} m of a target")
+        targets = planes[assignment[used]]
+        x0 = np.array([values[n] for n in free], dtype=float)
+        J = jacobian(x0)
+        norms = np.linalg.norm(J, axis=0)
+        observable = norms > OBSERVABLE * norms.max()
+        if not observable.any():
+            raise ValueError(f"None of {', '.join(free)} is constrained by these targets")
+        free = [n for n, o in zip(free, observable) if o]
+        x0 = x0[observable]
+        singular_values, vectors = np.linalg.svd(J[:, observable] / norms[observable], full_matrices=False)[1:]
+        if singular_values[-1] < singular_values[0] / MAX_CONDITION:
+            mixed = [n for n, v in zip(free, vectors[-1]) if abs(v) > 0.1]
+            raise ValueError(f"{', '.join(mixed)} cannot be told apart with these targets, calibrate fewer of them "
+                             f"with --params or add a --plane target")
+        result = least_squares(residuals, x0, jac=jacobian, loss='soft_l1', f_scale=LOSS_SCALE, x_scale='jac')
+        values.update(zip(free, result.x))
+        rms = float(np.sqrt(np.mean(result.fun**2)))
+    return values, [n for n in names if n not in free], rms, count
+
+
+def parse_plane(value, origin):
+    '''Plane a,b,c,d in UTM meters, moved to the session's local coordinates'''
+    a, b, c, d = (float(v) for v in value.split(','))
+    norm = np.linalg.norm([a, b, c])
+    return np.array([a, b, c, d + a * origin[0] + b * origin[1]]) / norm
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the mounting constants of a recorder")
+    parser.add_argument('sensor', choices=list(SENSORS))
+    parser.add_argument('session', help="session folder of a pass over flat ground or known targets")
+    parser.add_argument('--plane', action='append', default=[], help="known target plane a,b,c,d in UTM meters")
+    parser.add_argument('--no-ground', action='store_true', help="only fit the --plane targets")
+    parser.add_argument('--ground-height', type=float, default=0, help="meters, height of the ground in the recorder's heights")
+    parser.add_argument('--params', nargs='+', help="constants to calibrate, all observable ones by default")
+    parser.add_argument('--max-points', type=int, default=MAX_POINTS)
+    parser.add_argument('--output', default=CALIBRATION_FILE)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    loader, model = MODELS[args.sensor]
+    # Starting from the constants the session was recorded with, when it has its session.json
+    initial = session_config(args.session, args.sensor,
+                             {**recorder_constants(args.sensor), **load_calibration(args.output, args.sensor)})
+    data, projection, origin = loader(args.session, initial, np.random.default_rng(0), args.max_points)
+    planes = [parse_plane(value, origin) for value in args.plane]
+    if not args.no_ground:
+        planes.append(np.array([0, 0, 1, -args.ground_height]))
+    names = args.params or list(SENSORS[args.sensor][2])
+    try:
+        values, fixed, rms, count = calibrate(model, data, np.array(planes), initial, names)
+    except ValueError as e:
+        parser.error(str(e))
+
+    calibration = {'sensor': args.sensor, 'session': os.path.abspath(args.session), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'parameters': {name: round(value, 6) for name, value in values.items()}, 'initial': initial,
+                   'not_observable': fixed, 'rms': rms, 'points': count, 'utm_epsg': projection.epsg}
+    for path in (args.output, os.path.join(args.session, CALIBRATION_FILE)):
+        with open(path, 'w') as f:
+            json.dump(calibration, f, indent=2)
+    for name in names:
+        print(f"{name}: {initial[name]:g} -> {values[name]:.4f}" + (" (not observable)" if name in fixed else ""))
+    print(f"{count} points, rms {rms * 1000:.1f} mm, {time.perf_counter() - start_time:.1f}s, saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+'''Catalog of the recorded sessions: time range, UTM bounding box, point counts and sensors of every data_* folder,
+in a SQLite database with an R*Tree index on easting, northing and time
+
+    python catalog.py update data dump
+    python catalog.py query --near 34.9073,-120.4480,50 --since 2024-07-16
+    python catalog.py query --area 733100,3865700,733200,3865800 --sensor realsense
+
+Folders are only read again when their files changed, so updating a catalog of hundreds of sessions costs the new
+ones. The R*Tree stores 32 bit floats rounded outwards, its candidates are checked against the exact bounds.'''
+import os
+import re
+import time
+import sqlite3
+import argparse
+import datetime
+from contextlib import closing
+import numpy as np
+import utm
+
+from cloud_io import load_gps, load_text, map_bin
+from config import read_metadata
+from projection import utm_zone, utm_epsg
+
+CATALOG_FILE = 'sessions.db'
+SESSION_PATTERN = re.compile(r'data_(\d{8}_\d{6})$')
+RECENT_SESSIONS = 10  # listed by the recorders when asking which session to plot
+
+# File of a session and the sensor it comes from
+SENSOR_FILES = {'gps_data.txt': 'gps', 'lidar_data.txt': 'lidar', 'pointcloud_data.npy': 'realsense',
+                'imu_data.txt': 'imu'}
+COLUMNS = ('folder', 'signature', 'profile', 'sensors', 'start', 'end', 'utm_epsg', 'min_easting', 'min_northing',
+           'max_easting', 'max_northing', 'gps_fixes', 'points')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY, folder TEXT UNIQUE NOT NULL, signature TEXT, profile TEXT, sensors TEXT,
+    start REAL, end REAL, utm_epsg INTEGER, min_easting REAL, min_northing REAL, max_easting REAL, max_northing REAL,
+    gps_fixes INTEGER, points INTEGER);
+CREATE VIRTUAL TABLE IF NOT EXISTS session_index USING rtree(
+    id, min_easting, max_easting, min_northing, max_northing, start, end);
+CREATE INDEX IF NOT EXISTS sessions_start ON sessions (start);
+'''
+
+
+def connect(path=CATALOG_FILE):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    return db
+
+
+def is_session(folder):
+    return os.path.isdir(folder) and SESSION_PATTERN.search(os.path.basename(os.path.normpath(folder))) is not None
+
+
+def signature(folder):
+    '''Size and last modification of the files of a folder, a changed session has a changed signature'''
+    size, modified = 0, 0
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            stat = entry.stat()
+            size += stat.st_size
+            modified = max(modified, stat.st_mtime_ns)
+        elif entry.is_dir():
+            for child in os.scandir(entry.path):
+                if child.is_file():
+                    stat = child.stat()
+                    size += stat.st_size
+                    modified = max(modified, stat.st_mtime_ns)
+    return f"{size}:{modified}"
+
+
+def processed_points(folder):
+    '''UTM points of a session, (easting, northing) columns only, None when it has no processed data'''
+    bins = os.path.join(folder, 'processed_data')
+    if os.path.isdir(bins):
+        parts = [np.asarray(map_bin(os.path.join(bins, f)))[:, :2] for f in sorted(os.listdir(bins)) if f.endswith('.bin')]
+        return np.vstack(parts) if parts else None
+    for name in ('processed_data.bin', 'processed_data.txt'):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.path.getsize(path):
+            if name.endswith('.bin'):
+                return np.asarray(map_bin(path))[:, :2]
+            # The lidar writes x,y,z, the RealSense timestamp,x,y,z
+            return load_text(path, columns=[-3, -2])
+    return None
+
+
+def index_session(folder):
+    '''Catalog row of a session folder'''
+    folder = os.path.abspath(folder)
+    metadata = read_metadata(folder)
+    started = SESSION_PATTERN.search(os.path.basename(folder)).group(1)
+    start = end = time.mktime(time.strptime(started, '%Y%m%d_%H%M%S'))
+    sensors = sorted(sensor for name, sensor in SENSOR_FILES.items()
+                     if os.path.isfile(os.path.join(folder, name)) and os.path.getsize(os.path.join(folder, name)))
+
+    epsg, bounds, gps_fixes, points = None, (None,) * 4, 0, 0
+    gps_path = os.path.join(folder, 'gps_data.txt')
+    gps = load_gps(gps_path) if os.path.isfile(gps_path) and os.path.getsize(gps_path) else np.empty((0, 0))
+    if len(gps):
+        # GPS timestamps are seconds since the recorder started, as the folder name
+        gps_fixes = len(gps)
+        start, end = start + gps[0, 0], start + gps[-1, 0]
+        epsg = utm_epsg(*utm_zone(gps[0, 1], gps[0, 2]))
+    cloud = processed_points(folder)
+    if cloud is not None and len(cloud):
+        points = len(cloud)
+        bounds = (*cloud.min(axis=0), *cloud.max(axis=0))
+    elif len(gps):
+        zone_number, northern = utm_zone(gps[0, 1], gps[0, 2])
+        easting, northing, _, _ = utm.from_latlon(gps[:, 1], gps[:, 2], force_zone_number=zone_number,
+                                                  force_northern=northern)
+        bounds = (easting.min(), northing.min(), easting.max(), northing.max())
+    return {'folder': folder, 'signature': signature(folder), 'profile': metadata.get('profile'),
+            'sensors': ','.join(sensors), 'start': start, 'end': end, 'utm_epsg': epsg,
+            'min_easting': bounds[0], 'min_northing': bounds[1], 'max_easting': bounds[2], 'max_northing': bounds[3],
+            'gps_fixes': gps_fixes, 'points': points}
+
+
+def forget(db, folder):
+    db.execute('DELETE FROM session_index WHERE id IN (SELECT id FROM sessions WHERE folder = ?)', (folder,))
+    db.execute('DELETE FROM sessions WHERE folder = ?', (folder,))
+
+
+def store(db, row):
+    forget(db, row['folder'])
+    cursor = db.execute(f"INSERT INTO sessions ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                        [row[c] for c in COLUMNS])
+    if row['min_easting'] is not None:
+        db.execute('INSERT INTO session_index VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (cursor.lastrowid, row['min_easting'], row['max_easting'], row['min_northing'],
+                    row['max_northing'], row['start'], row['end']))
+
+
+def update(db, roots=('.',)):
+    '''Indexes the new and changed session folders in roots (or roots themselves) and drops the removed ones,
+    returns (indexed, removed) counts'''
+    folders = set()
+    for root in roots:
+        if is_session(root):
+            folders.add(os.path.abspath(root))
+        elif os.path.isdir(root):
+            folders.update(os.path.abspath(entry.path) for entry in os.scandir(root) if is_session(entry.path))
+    known = dict(db.execute('SELECT folder, signature FROM sessions').fetchall())
+
+    indexed = 0
+    for folder in sorted(folders):
+        if known.get(folder) != signature(folder):
+            try:
+                store(db, index_session(folder))
+                indexed += 1
+            except (ValueError, IndexError, OSError) as e:
+                print(f"Skipping {folder}: {e}")
+    scanned = {os.path.abspath(root) for root in roots}
+    removed = [folder for folder in known if folder not in folders and
+               (os.path.dirname(folder) in scanned or folder in scanned) and not os.path.isdir(folder)]
+    for folder in removed:
+        forget(db, folder)
+    db.commit()
+    return indexed, len(removed)
+
+
+def add_session(folder, path=CATALOG_FILE):
+    '''Indexes one session, e.g. by its recorder once it is closed, so choose_session does not have to scan'''
+    with closing(connect(path)) as db:
+        try:
+            store(db, index_session(os.path.abspath(folder)))
+            db.commit()
+        except (ValueError, IndexError, OSError) as e:
+            print(f"Skipping {folder}: {e}")
+
+
+def query(db, area=None, epsg=None, since=None, until=None, sensor=None, limit=None):
+    '''Sessions overlapping area (min easting, min northing, max easting, max northing) in epsg and the time range
+    [since, until] in epoch seconds, most recent first'''
+    sql, conditions, values = 'SELECT s.* FROM sessions s', [], []
+    if area is not None:
+        # The R*Tree narrows down the candidates, the exact bounds decide
+        sql += ' JOIN session_index i ON i.id = s.id'
+        conditions += ['i.max_easting >= ? AND i.min_easting <= ? AND i.max_northing >= ? AND i.min_northing <= ?',
+                       's.max_easting >= ? AND s.min_easting <= ? AND s.max_northing >= ? AND s.min_northing <= ?']
+        values += [area[0], area[2], area[1], area[3]] * 2
+    for column, bound, operator in (('end', since, '>='), ('start', until, '<=')):
+        if bound is not None:
+            conditions.append(f's.{column} {operator} ?' + (f' AND i.{column} {operator} ?' if area is not None else ''))
+            values += [bound] * (2 if area is not None else 1)
+    if epsg is not None:
+        conditions.append('s.utm_epsg = ?')
+        values.append(epsg)
+    if sensor is not None:
+        conditions.append("(',' || s.sensors || ',') LIKE ?")
+        values.append(f"%,{sensor},%")
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY s.start DESC' + (f' LIMIT {int(limit)}' if limit else '')
+    return [dict(row) for row in db.execute(sql, values)]
+
+
+def query_near(db, lat, lon, radius, limit=None, **filters):
+    '''Sessions within radius meters of a position, in whichever UTM zone they were recorded'''
+    sessions = []
+    for (epsg,) in db.execute('SELECT DISTINCT utm_epsg FROM sessions WHERE utm_epsg IS NOT NULL').fetchall():
+        easting, northing, _, _ = utm.from_latlon(lat, lon, force_zone_number=epsg % 100,
+                                                  force_northern=epsg < 32700)
+        sessions += query(db, (easting - radius, northing - radius, easting + radius, northing + radius), epsg,
+                          **filters)
+    return sorted(sessions, key=lambda s: -s['start'])[:limit]
+
+
+def describe(session):
+    start = datetime.datetime.fromtimestamp(session['start'])
+    duration = session['end'] - session['start']
+    return (f"{session['folder']}  {start:%Y-%m-%d %H:%M:%S} {duration:7.0f}s  {session['sensors'] or '-':<22} "
+            f"{session['points']:>9} points  {session['gps_fixes']:>6} fixes")
+
+
+def choose_session(roots=('.',), profile=None, recent=RECENT_SESSIONS):
+    '''Asks for a session among the most recent ones of profile or a path, None for an invalid answer. roots are only
+    scanned when there is no catalog yet or when asked, the recorders index their own sessions.'''
+    refresh = not os.path.exists(CATALOG_FILE)
+    while True:
+        with closing(connect()) as db:
+            if refresh:
+                update(db, roots)
+            sessions = [s for s in query(db) if profile is None or s['profile'] in (profile, None)][:recent]
+        for i, session in enumerate(sessions, 1):
+            print(f"{i:>3}. {describe(session)}")
+        answer = input("Enter the number of a session, the path to the data folder or U to rescan the folders: ").strip()
+        if answer.upper() != 'U':
+            break
+        refresh = True
+    if answer.isdigit() and 1 <= int(answer) <= len(sessions):
+        return sessions[int(answer) - 1]['folder']
+    return answer if os.path.exists(answer) else None
+
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the recorded sessions and find them by area or time")
+    parser.add_argument('--catalog', default=CATALOG_FILE)
+    commands = parser.add_subparsers(dest='command', required=True)
+    update_parser = commands.add_parser('update', help="index new and changed session folders")
+    update_parser.add_argument('roots', nargs='*', default=['.'], help="folders holding data_* sessions, or sessions")
+    query_parser = commands.add_parser('query', help="sessions overlapping an area and time range")
+    query_parser.add_argument('--area', help="min_easting,min_northing,max_easting,max_northing in UTM meters")
+    query_parser.add_argument('--epsg', type=int, help="UTM zone of --area, e.g. 32610")
+    query_parser.add_argument('--near', help="lat,lon[,radius in meters]")
+    query_parser.add_argument('--since', type=parse_time, help="e.g. 2024-07-16 or 2024-07-16T17:00")
+    query_parser.add_argument('--until', type=parse_time)
+    query_parser.add_argument('--sensor', choices=sorted(set(SENSOR_FILES.values())))
+    query_parser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    with closing(connect(args.catalog)) as db:
+        if args.command == 'update':
+            start_time = time.perf_counter()
+            indexed, removed = update(db, args.roots)
+            total = db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+            print(f"{indexed} sessions indexed, {removed} removed, {total} in {args.catalog} "
+                  f"({time.perf_counter() - start_time:.2f}s)")
+            return
+
+        start_time = time.perf_counter()
+        filters = {'since': args.since, 'until': args.until, 'sensor': args.sensor, 'limit': args.limit}
+        if args.near:
+            lat, lon, *radius = (float(v) for v in args.near.split(','))
+            sessions = query_near(db, lat, lon, radius[0] if radius else 0, **filters)
+        else:
+            area = tuple(float(v) for v in args.area.split(',')) if args.area else None
+            sessions = query(db, area, args.epsg, **filters)
+        elapsed = time.perf_counter() - start_time
+    for session in sessions:
+        print(describe(session))
+    print(f"{len(sessions)} sessions ({elapsed * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
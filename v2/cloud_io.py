@@ -0,0 +1,130 @@
+'''Bulk loaders for the point clouds and GPS logs written by the recorders.
+
+Text files are parsed in blocks by NumPy's C parser, binary ones (processing.save_bin_data .bin files and the
+pointcloud_data.npy frame logs) are mapped or read without parsing. Clouds come out as float32 relative to an origin
+kept in float64, UTM coordinates do not fit in float32 at millimeter precision.'''
+import io
+import os
+import pickle
+import numpy as np
+
+CHUNK_SIZE = 1 << 22  # bytes of text parsed at once
+BIN_HEADER = 4  # bytes, uint32 point count of processing.save_bin_data files
+
+
+def iter_text_blocks(path, chunk_size=CHUNK_SIZE):
+    '''Blocks of whole lines of a text file'''
+    with open(path, 'rb') as f:
+        rest = b''
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            if cut:
+                rest = block[cut:]
+                yield block[:cut]
+            else:
+                rest = block
+        if rest.strip():
+            yield rest
+
+
+def load_text(path, dtype=np.float64, origin=None, columns=None, chunk_size=CHUNK_SIZE):
+    '''Comma separated numeric rows as a 2D array. origin is subtracted from the selected columns in float64 before
+    the values are cast to dtype, columns selects and orders the columns to keep.'''
+    chunks = []
+    for block in iter_text_blocks(path, chunk_size):
+        values = np.loadtxt(io.BytesIO(block), delimiter=',', ndmin=2)
+        if columns is not None:
+            values = values[:, columns]
+        if origin is not None:
+            values -= origin
+        chunks.append(values.astype(dtype, copy=False))
+    if not chunks:
+        return np.empty((0, 0 if columns is None else len(columns)), dtype=dtype)
+    return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+
+def map_bin(path):
+    '''Points of a processing.save_bin_data file, mapped read-only instead of read'''
+    count = int(np.fromfile(path, dtype=np.uint32, count=1)[0])
+    if count == 0:
+        return np.empty((0, 3))
+    return np.memmap(path, dtype=np.float64, mode='r', offset=BIN_HEADER, shape=(count, 3))
+
+
+def map_bin_colors(path):
+    '''uint8 RGB colors following the points of a processing.save_bin_data file, None if it has none'''
+    count = int(np.fromfile(path, dtype=np.uint32, count=1)[0])
+    offset = BIN_HEADER + count * 24
+    if count == 0 or os.path.getsize(path) < offset + count * 3:
+        return None
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(count, 3))
+
+
+def iter_npy_frames(path):
+    '''Entries of a file written with successive np.save calls, as pointcloud_data.npy'''
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield np.load(f, allow_pickle=True).item()
+            except (EOFError, ValueError, OSError, pickle.UnpicklingError):
+                # A session stopped mid-write ends with a truncated entry
+                return
+
+
+def first_point(path):
+    if path.endswith('.bin'):
+        points = map_bin(path)
+        return np.array(points[0]) if len(points) else None
+    if path.endswith('.npy'):
+        for entry in iter_npy_frames(path):
+            if len(entry['points']):
+                return np.asarray(entry['points'][0], dtype=np.float64)
+        return None
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                return np.array(line.split(b','), dtype=np.float64)[-3:]
+    return None
+
+
+def auto_origin(path):
+    '''Whole meter easting and northing of the first point, heights are left as they are'''
+    point = first_point(path)
+    return np.zeros(3) if point is None else np.array([np.floor(point[0]), np.floor(point[1]), 0.0])
+
+
+def load_cloud(path, dtype=np.float32, origin='auto', chunk_size=CHUNK_SIZE):
+    '''(points, origin) of a cloud file: x, y, z as the last three columns of a text file (a leading timestamp is
+    dropped), a .bin file or the points of every pointcloud_data.npy frame. points are relative to origin, which is
+    taken from the first point with 'auto', and None for absolute coordinates.'''
+    if isinstance(origin, str):
+        origin = auto_origin(path)
+    offset = np.zeros(3) if origin is None else np.asarray(origin, dtype=np.float64)
+
+    if path.endswith('.bin'):
+        mapped = map_bin(path)
+        points = np.empty(mapped.shape, dtype=dtype)
+        step = max(chunk_size // 24, 1)
+        for start in range(0, len(mapped), step):
+            points[start:start + step] = mapped[start:start + step] - offset
+    elif path.endswith('.npy'):
+        frames = [np.asarray(entry['points'], dtype=np.float64).reshape(-1, 3) - offset
+                  for entry in iter_npy_frames(path)]
+        points = np.concatenate(frames).astype(dtype, copy=False) if frames else np.empty((0, 3), dtype=dtype)
+    else:
+        points = load_text(path, dtype, offset, [-3, -2, -1], chunk_size)
+    return points, origin
+
+
+def load_gps(path):
+    '''Rows of a GPS text file (timestamp, lat, lon, heading for gps_data.txt), in float64'''
+    return load_text(path, np.float64)
+
+
+def load_colors(path):
+    '''uint8 RGB rows of a processed_colors.bin, one per line of the session's processed_data.txt'''
+    return np.fromfile(path, dtype=np.uint8).reshape(-1, 3)
@@ -0,0 +1,141 @@
+'''Settings of the recorders and tools, instead of editing their constants for every deployment.
+
+The constants at the top of a script are its defaults. Over them, in order:
+    calibration.json written by calibrate.py (its mounting constants)
+    the section of the script's profile in config.json, or the file named by TRIC_CONFIG, after its "common" section
+    TRIC_<NAME> then TRIC_<PROFILE>_<NAME> environment variables, e.g. TRIC_LIDAR_LIDAR_PORT=/dev/ttyUSB0
+
+    {"common": {"GPS_PORT": "/dev/ttyACM0"},
+     "lidar": {"LIDAR_PORT": "/dev/ttyUSB0", "SENSOR_HEIGHT": 950},
+     "realsense": {"DEPTH_WIDTH": 848, "DEPTH_HEIGHT": 480}}
+
+Values keep the type of the constant they replace. The settings a session was recorded with are written to its
+session.json, which is itself a valid configuration file: TRIC_CONFIG=data_20240716_171504/session.json records (or
+replays) with the same settings.'''
+import os
+import json
+import time
+import platform
+
+CONFIG_FILE = 'config.json'
+CALIBRATION_FILE = 'calibration.json'
+METADATA_FILE = 'session.json'
+ENV_PREFIX = 'TRIC_'
+TRUE = ('1', 'true', 'yes', 'on')
+FALSE = ('0', 'false', 'no', 'off')
+NONE = ('none', 'null', '')
+
+
+def load_calibration(path, sensor):
+    '''Calibrated constants of sensor in path, empty if there are none'''
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        calibration = json.load(f)
+    return calibration['parameters'] if calibration.get('sensor') == sensor else {}
+
+
+def config_path(environ=os.environ):
+    return environ.get(ENV_PREFIX + 'CONFIG', CONFIG_FILE)
+
+
+def read_config_file(path, profile):
+    '''Settings of profile in a configuration file or a session.json, empty if there is no file'''
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        content = json.load(f)
+    if 'config' in content:
+        if content.get('profile') != profile:
+            raise ValueError(f"{path} was recorded by the {content.get('profile')} profile, not {profile}")
+        return dict(content['config'])
+    return {**content.get('common', {}), **content.get(profile, {})}
+
+
+def convert(name, value, default):
+    '''value as the type of default, strings as read from the environment are parsed'''
+    if isinstance(value, str) and value.strip().lower() in NONE and not (isinstance(default, str) and value == ''):
+        return None
+    if isinstance(value, str) and not isinstance(default, str):
+        text = value.strip().lower()
+        if isinstance(default, bool):
+            if text not in TRUE + FALSE:
+                raise ValueError(f"{name} expects a boolean, got {value!r}")
+            return text in TRUE
+        try:
+            value = json.loads(value)
+        except ValueError:
+            # Settings without a default type, e.g. COLOR_MODE = None, take words as they are
+            if default is not None:
+                raise ValueError(f"{name} expects a value like {default!r}, got {value!r}") from None
+    if value is None or default is None:
+        return value
+    if isinstance(default, bool):
+        if not isinstance(value, bool):
+            raise ValueError(f"{name} expects a boolean, got {value!r}")
+        return value
+    if isinstance(default, (int, float)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{name} expects a number, got {value!r}")
+        # Measures written as whole numbers in the scripts, e.g. SENSOR_HEIGHT in mm, may be calibrated to fractions
+        return int(value) if isinstance(default, int) and value == int(value) else value
+    if isinstance(default, (list, tuple)):
+        if not isinstance(value, (list, tuple)):
+            raise ValueError(f"{name} expects a list, got {value!r}")
+        return type(default)(value)
+    if not isinstance(value, type(default)):
+        raise ValueError(f"{name} expects a {type(default).__name__}, got {value!r}")
+    return value
+
+
+def load_config(profile, defaults, path=None, environ=os.environ, strict=True):
+    '''Settings of profile over defaults, every one converted to the type of its default. With strict, settings
+    the defaults do not have are errors rather than ignored, e.g. a misspelled name.'''
+    overrides = read_config_file(path or config_path(environ), profile)
+    prefixes = (ENV_PREFIX, f"{ENV_PREFIX}{profile.upper()}_")
+    for prefix in prefixes:
+        for key, value in environ.items():
+            name = key[len(prefix):]
+            if key.startswith(prefix) and name in defaults:
+                overrides[name] = value
+
+    calibration_file = overrides.get('CALIBRATION_FILE', defaults.get('CALIBRATION_FILE', CALIBRATION_FILE))
+    calibration = load_calibration(calibration_file, profile)
+    config = {**defaults, **{name: value for name, value in calibration.items() if name in defaults}}
+    unknown = [name for name in overrides if name not in defaults]
+    if unknown and strict:
+        raise ValueError(f"Unknown {profile} settings: {', '.join(unknown)}")
+    for name, value in overrides.items():
+        if name in defaults:
+            config[name] = convert(name, value, defaults[name])
+    return config
+
+
+def write_metadata(folder, profile, config, defaults=None, **extra):
+    '''Writes the settings a session is recorded with to its session.json, returns its path'''
+    metadata = {'profile': profile, 'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(),
+                'config_file': os.path.abspath(config_path()) if os.path.isfile(config_path()) else None,
+                'config': config, **extra}
+    if defaults is not None:
+        metadata['changed'] = sorted(name for name in config if config[name] != defaults.get(name))
+    path = os.path.join(folder, METADATA_FILE)
+    with open(path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return path
+
+
+def read_metadata(folder):
+    '''Content of a session's session.json, empty for sessions recorded before it existed'''
+    path = os.path.join(folder, METADATA_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def session_config(folder, profile, defaults):
+    '''Settings a session of profile was recorded with, defaults for the ones it does not record'''
+    metadata = read_metadata(folder)
+    if metadata.get('profile') != profile:
+        return dict(defaults)
+    return {**defaults, **{name: value for name, value in metadata['config'].items() if name in defaults}}
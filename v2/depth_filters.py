@@ -0,0 +1,47 @@
+'''librealsense post-processing filters run on the depth frames before the point cloud is computed, so fewer points
+reach the host side processing. Decimation, threshold and hole filling work on depth, spatial and temporal on
+disparity as librealsense recommends; the chain inserts the transforms around them.'''
+import numpy as np
+
+FILTERS = ('decimation', 'threshold', 'spatial', 'temporal', 'hole_filling')
+DISPARITY_FILTERS = ('spatial', 'temporal')
+
+
+def valid_pixels(frame):
+    return int(np.count_nonzero(np.asanyarray(frame.get_data())))
+
+
+class FilterChain:
+    '''Filters of names applied in order, options maps a filter name to {rs.option name: value}'''
+    def __init__(self, rs, names, options=None):
+        unknown = [name for name in names if name not in FILTERS]
+        if unknown:
+            raise ValueError(f"Unknown depth filters {unknown}, expected some of {FILTERS}")
+        options = options or {}
+        constructors = {'decimation': rs.decimation_filter, 'threshold': rs.threshold_filter,
+                        'spatial': rs.spatial_filter, 'temporal': rs.temporal_filter,
+                        'hole_filling': rs.hole_filling_filter}
+        self.names = list(names)
+        self.stages = []
+        in_disparity = False
+        for name in self.names:
+            if (name in DISPARITY_FILTERS) != in_disparity:
+                in_disparity = not in_disparity
+                self.stages.append((None, rs.disparity_transform(in_disparity)))
+            stage = constructors[name]()
+            for option, value in options.get(name, {}).items():
+                stage.set_option(getattr(rs.option, option), value)
+            self.stages.append((name, stage))
+        if in_disparity:
+            self.stages.append((None, rs.disparity_transform(False)))
+
+    def process(self, frame, count=None):
+        '''Filtered depth frame, count(name, valid pixels) is called with the input and after every filter'''
+        if count is not None:
+            count('depth_pixels', valid_pixels(frame))
+        for name, stage in self.stages:
+            frame = stage.process(frame)
+            if name is not None and count is not None:
+                count(f'depth_pixels_after_{name}', valid_pixels(frame))
+        # Filters return generic frames, the point cloud needs a depth frame
+        return frame.as_depth_frame() if hasattr(frame, 'as_depth_frame') else frame
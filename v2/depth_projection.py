@@ -0,0 +1,75 @@
+'''Depth images to camera frame points (x right, y down, z forward, meters, as librealsense) through a table of
+per-pixel rays built once from the stream intrinsics. The depth range and the region of interest are cut on the raw
+uint16 image, only the remaining pixels are projected, and their colors are looked up in the color stream the same way.
+Lens distortion is ignored, D400 depth streams have none.'''
+import numpy as np
+
+MAX_RAW_DEPTH = np.iinfo(np.uint16).max
+
+
+class RayTable:
+    '''Rays of the pixels of a region of interest of one depth stream. roi is (left, top, right, bottom) as fractions
+    of the image, so it holds at every decimation. Only points between min_distance and max_distance meters of the
+    sensor along their ray are projected.'''
+    def __init__(self, intrinsics, depth_scale, min_distance=0, max_distance=None, roi=None):
+        left, top, right, bottom = roi or (0, 0, 1, 1)
+        self.key = self.key_of(intrinsics, depth_scale)
+        self.depth_scale = np.float32(depth_scale)
+        self.columns = slice(int(round(left * intrinsics.width)), int(round(right * intrinsics.width)))
+        self.rows = slice(int(round(top * intrinsics.height)), int(round(bottom * intrinsics.height)))
+        x = (np.arange(intrinsics.width)[self.columns] - intrinsics.ppx) / intrinsics.fx
+        y = (np.arange(intrinsics.height)[self.rows] - intrinsics.ppy) / intrinsics.fy
+        x, y = (a.ravel() for a in np.meshgrid(x, y))
+        self.rays = np.column_stack([x, y, np.ones_like(x)]).astype(np.float32)
+
+        # The range along a ray is depth * |ray|, its bounds become raw depth bounds per pixel
+        norms = np.sqrt(x**2 + y**2 + 1)
+        self.min_raw = np.clip(np.ceil(min_distance / norms / depth_scale), 1, MAX_RAW_DEPTH).astype(np.uint16)
+        if max_distance is None:
+            self.max_raw = np.full(len(norms), MAX_RAW_DEPTH, dtype=np.uint16)
+        else:
+            self.max_raw = np.clip(np.floor(max_distance / norms / depth_scale), 0, MAX_RAW_DEPTH).astype(np.uint16)
+
+    @staticmethod
+    def key_of(intrinsics, depth_scale):
+        return (intrinsics.width, intrinsics.height, intrinsics.fx, intrinsics.fy, intrinsics.ppx, intrinsics.ppy,
+                depth_scale)
+
+    def project(self, depth):
+        '''float32 points of the pixels of depth within the region and the range'''
+        crop = np.asarray(depth)[self.rows, self.columns].ravel()
+        keep = np.flatnonzero((crop >= self.min_raw) & (crop <= self.max_raw))
+        return self.rays[keep] * (crop[keep] * self.depth_scale)[:, np.newaxis]
+
+
+class ColorMap:
+    '''Pixels of a color stream the points of a depth stream fall on, the texture coordinates of rs.pointcloud.map_to
+    computed for the projected points only. extrinsics is the depth to color rs.extrinsics, None when the depth is
+    aligned to the color stream.'''
+    def __init__(self, intrinsics, extrinsics=None):
+        self.key = self.key_of(intrinsics, extrinsics)
+        self.width, self.height = intrinsics.width, intrinsics.height
+        self.focal = np.array([intrinsics.fx, intrinsics.fy], dtype=np.float32)
+        self.center = np.array([intrinsics.ppx, intrinsics.ppy], dtype=np.float32)
+        if extrinsics is None:
+            self.rotation, self.translation = None, None
+        else:
+            # librealsense stores the rotation column major
+            self.rotation = np.array(extrinsics.rotation, dtype=np.float32).reshape(3, 3).T
+            self.translation = np.array(extrinsics.translation, dtype=np.float32)
+
+    @staticmethod
+    def key_of(intrinsics, extrinsics=None):
+        return (intrinsics.width, intrinsics.height, intrinsics.fx, intrinsics.fy, intrinsics.ppx, intrinsics.ppy,
+                None if extrinsics is None else (tuple(extrinsics.rotation), tuple(extrinsics.translation)))
+
+    def colors(self, points, image, bgr=True):
+        '''uint8 RGB of every point, points beyond the edges of the color image take the color of the edge'''
+        points = np.asarray(points, dtype=np.float32)
+        if self.rotation is not None:
+            points = points @ self.rotation.T + self.translation
+        pixels = np.rint(points[:, :2] / points[:, 2:] * self.focal + self.center).astype(np.intp)
+        columns = np.clip(pixels[:, 0], 0, self.width - 1)
+        rows = np.clip(pixels[:, 1], 0, self.height - 1)
+        colors = np.asarray(image)[rows, columns]
+        return np.ascontiguousarray(colors[:, ::-1]) if bgr else colors
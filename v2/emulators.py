@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+'''Serial sensors emulated on pseudo-terminals, so the recorders and their parsers run without hardware
+
+    python emulators.py gnss rplidar
+    python emulators.py --speed 0 --stress 10 gnss ultrasonic rplidar cyglidar
+    python emulators.py --speed 2 --corrupt 1e-4 --garbage 0.01 --stress 10 --scan-mode boost rplidar
+
+Each device gets a /dev/pts port that any program opens like the real one, e.g. TRIC_GPS_PORT=/dev/pts/3 python
+main.py. Behind it a thread speaks the byte protocol of the device with the rover, terrain and sensor noise of
+v1/generate_data: NMEA fixes of the Emlid Reach, the distance lines of the Arduino ultrasonic array, the answers and
+scan packets of an RPLidar A1 and the 3D frames of a CygLidar D1. --speed scales the message rates and the line rate
+of the baud rate together, 0 writes as fast as the reader takes the bytes. Errors are injected per message: flipped
+bits, lost messages, garbage bytes before a message and messages cut short.
+
+--stress reads each device for that many seconds through the parsers the recorders use and reports the throughput.'''
+import os
+import sys
+import tty
+import time
+import struct
+import select
+import argparse
+import datetime
+import itertools
+import threading
+import numpy as np
+import serial
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', 'v1', 'generate_data'))
+import generate_data
+from lidar_driver import (RPLidarDriver, LidarError, checksum, packet_views, SYNC_BYTE, SYNC_BYTE2, STOP, RESET,
+                          SCAN, EXPRESS_SCAN, GET_INFO, GET_HEALTH, GET_SAMPLERATE, GET_LIDAR_CONF,
+                          INFO_TYPE, HEALTH_TYPE, SAMPLERATE_TYPE, CONF_TYPE, SCAN_TYPE, CAPSULE_TYPE,
+                          DENSE_CAPSULE_TYPE, CONF_SCAN_MODE_COUNT, CONF_SCAN_MODE_US_PER_SAMPLE,
+                          CONF_SCAN_MODE_ANS_TYPE, CONF_SCAN_MODE_TYPICAL, CONF_SCAN_MODE_NAME, PACKETS, SCAN_MODES)
+from processing import (parse_nmea, parse_fix_quality, split_cyglidar_frames, decode_cyglidar_3d, CYGLIDAR_HEADER,
+                        CYGLIDAR_3D_LENGTH, CYGLIDAR_DISTANCE_LIMIT)
+
+REALTIME = 1.0
+AS_FAST_AS_POSSIBLE = 0
+BITS_PER_BYTE = 10  # 8N1, a start and a stop bit around every byte
+BLOCK_SECONDS = 1.0  # seconds of device time simulated at once
+COALESCE_SECONDS = 0.002  # messages due within this are written together, fewer system calls for small packets
+WRITE_SIZE = 65536  # bytes written at once when writing as fast as possible
+IDLE_POLL = 0.05  # seconds between checks for commands while a device is not streaming
+MAX_GARBAGE = 16  # bytes
+READ_TIMEOUT = 1  # seconds
+
+GNSS_BAUD_RATE = 57600
+ULTRASONIC_BAUD_RATE = 9600
+RPLIDAR_BAUD_RATE = 115200
+CYGLIDAR_BAUD_RATE = 3000000
+
+# RPLidar A1M8 firmware 1.29: name, answer type and microseconds per sample of each scan mode
+RPLIDAR_MODES = [('Standard', SCAN_TYPE, 500), ('Express', CAPSULE_TYPE, 250), ('Boost', DENSE_CAPSULE_TYPE, 200)]
+RPLIDAR_INFO = bytes([0x18, 29, 1, 7]) + bytes(range(16))  # model, firmware minor and major, hardware, serial number
+
+CYGLIDAR_WIDTH = 160
+CYGLIDAR_HEIGHT = 60
+CYGLIDAR_HFOV = 120  # Degrees
+CYGLIDAR_RATE = 15  # frames per second
+CYGLIDAR_RUN_3D = 0x08  # payload header of the run 3D command and of the 3D frames
+CYGLIDAR_RUN_3D_COMMAND = bytes([0x5A, 0x77, 0xFF, 0x02, 0x00, 0x08, 0x00, 0x0A])
+CYGLIDAR_STOP_COMMAND = bytes([0x5A, 0x77, 0xFF, 0x02, 0x00, 0x02, 0x00, 0x00])
+
+
+class ErrorInjection:
+    '''Damage done to the messages of an emulator: corrupt is the probability of a flipped bit per byte, drop,
+    garbage and truncate the probabilities per message of losing it, of random bytes before it and of cutting it
+    short'''
+    def __init__(self, corrupt=0, drop=0, garbage=0, truncate=0, seed=None):
+        self.corrupt, self.drop, self.garbage, self.truncate = corrupt, drop, garbage, truncate
+        self.rng = np.random.default_rng(seed)
+        self.counts = {'flipped bits': 0, 'dropped messages': 0, 'garbage bytes': 0, 'truncated messages': 0}
+
+    @property
+    def active(self):
+        return any((self.corrupt, self.drop, self.garbage, self.truncate))
+
+    def apply(self, message):
+        if not self.active:
+            return message
+        rng = self.rng
+        if self.drop and rng.random() < self.drop:
+            self.counts['dropped messages'] += 1
+            return b''
+        if self.truncate and len(message) > 1 and rng.random() < self.truncate:
+            message = message[:rng.integers(1, len(message))]
+            self.counts['truncated messages'] += 1
+        if self.corrupt:
+            flips = rng.binomial(len(message), self.corrupt)
+            if flips:
+                data = np.frombuffer(message, dtype=np.uint8).copy()
+                np.bitwise_xor.at(data, rng.integers(0, len(data), flips),
+                                  np.left_shift(1, rng.integers(0, 8, flips)).astype(np.uint8))
+                message = data.tobytes()
+                self.counts['flipped bits'] += flips
+        if self.garbage and rng.random() < self.garbage:
+            garbage = rng.integers(0, 256, rng.integers(1, MAX_GARBAGE + 1), dtype=np.uint8).tobytes()
+            message = garbage + message
+            self.counts['garbage bytes'] += len(garbage)
+        return message
+
+
+class PtyEmulator:
+    '''A device on the slave side of a pseudo-terminal, a thread writes the messages of its stream on schedule and
+    answers what the host writes. A pty has flow control where a UART has none, so writes wait for the host to read
+    and a host too slow for the stream shows as lag, how far the device fell behind its schedule, not as lost bytes.'''
+    name = 'device'
+    baudrate = 115200
+    setting = None  # configuration setting of the recorders holding the port of this device
+
+    def __init__(self, speed=REALTIME, errors=None, seed=0, pattern='serpentine'):
+        self.speed = speed
+        self.errors = errors or ErrorInjection()
+        self.rng = np.random.default_rng(seed)
+        self.pattern = pattern
+        self.terrain = generate_data.Terrain(seed)
+        self.noise = dict(generate_data.NOISE)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.stream = None
+        self.generation = 0
+        self.replies = bytearray()
+        self.stats = {'messages': 0, 'bytes': 0, 'max lag': 0.0}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"{self.name} emulator", daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    @property
+    def line_rate(self):
+        '''Bytes per second the baud rate carries at the emulation speed, None when unlimited'''
+        return self.baudrate / BITS_PER_BYTE * self.speed if self.speed else None
+
+    def restart(self, stream):
+        '''Replaces the stream, a message being written is abandoned'''
+        self.stream = stream
+        self.generation += 1
+
+    def handle(self, data):
+        '''Bytes written by the host'''
+
+    def read_input(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        if data:
+            self.handle(data)
+
+    def poll_input(self, timeout):
+        if select.select([self.master], [], [], timeout)[0]:
+            self.read_input()
+
+    def write(self, data):
+        '''Writes data as the host reads it, reading its commands meanwhile'''
+        view = memoryview(data)
+        generation = self.generation
+        while view and not self.stopping.is_set() and self.generation == generation:
+            readable, writable, _ = select.select([self.master], [self.master], [], IDLE_POLL)
+            if readable:
+                self.read_input()
+            if writable and self.generation == generation:
+                try:
+                    written = os.write(self.master, view)
+                except BlockingIOError:
+                    continue
+                view = view[written:]
+                self.stats['bytes'] += written
+
+    def run(self):
+        due = time.monotonic()
+        while not self.stopping.is_set():
+            if self.replies:
+                reply = bytes(self.replies)
+                self.replies.clear()
+                self.write(reply)
+                continue
+            if self.stream is None:
+                self.poll_input(IDLE_POLL)
+                due = time.monotonic()
+                continue
+            now = time.monotonic()
+            if self.speed and due > now:
+                self.poll_input(due - now)
+                continue
+            self.poll_input(0)
+            if self.replies or self.stream is None:
+                continue
+            if self.speed:
+                self.stats['max lag'] = max(self.stats['max lag'], now - due)
+
+            # Messages due together go out in one write, each spaced by its interval or its time on the line
+            chunks, size, interval = [], 0, 0.0
+            limit = COALESCE_SECONDS if self.speed else float('inf')
+            while interval < limit and size < WRITE_SIZE:
+                message, seconds = next(self.stream)
+                chunks.append(self.errors.apply(message))
+                size += len(chunks[-1])
+                interval += max(seconds, len(message) * BITS_PER_BYTE / self.baudrate)
+            self.stats['messages'] += len(chunks)
+            self.write(b''.join(chunks))
+            if self.speed:
+                due += interval / self.speed
+
+    def trajectory(self, t):
+        return generate_data.simulate_trajectory(t, self.pattern)
+
+
+class GnssEmulator(PtyEmulator):
+    '''Emlid Reach: GNZDA, GNGGA and GNRMC sentences of every fix of the simulated rover, from the current UTC time'''
+    name = 'gnss'
+    baudrate = GNSS_BAUD_RATE
+    setting = 'GPS_PORT'
+
+    def __init__(self, rate=generate_data.GPS_RATE, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.start_time = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        self.restart(self.fixes())
+
+    def fixes(self):
+        count = max(int(BLOCK_SECONDS * self.rate), 1)
+        for first in itertools.count(0, count):
+            t = np.arange(first, first + count) / self.rate
+            x, y, heading = self.trajectory(t)
+            lat, lon = generate_data.local_to_latlon(x + self.rng.normal(0, self.noise['gps'], count),
+                                                     y + self.rng.normal(0, self.noise['gps'], count))
+            heading = (heading + self.rng.normal(0, self.noise['heading'], count)) % 360
+            sentences = generate_data.nmea_sentences(t, lat, lon, heading, generate_data.ROVER_SPEED,
+                                                     self.terrain(x, y), self.start_time)
+            for fix in zip(*sentences):
+                yield ('\r\n'.join(fix) + '\r\n').encode('ascii'), 1 / self.rate
+
+
+class UltrasonicEmulator(PtyEmulator):
+    '''Arduino ultrasonic array: a line of the seven distances (cm) to the ground, as the sketch prints them'''
+    name = 'ultrasonic'
+    baudrate = ULTRASONIC_BAUD_RATE
+
+    def __init__(self, rate=generate_data.ULTRASONIC_RATE, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.restart(self.lines())
+
+    def lines(self):
+        count = max(int(BLOCK_SECONDS * self.rate), 1)
+        for first in itertools.count(0, count):
+            t = np.arange(first, first + count) / self.rate
+            distances = generate_data.ultrasonic_distances(self.terrain, t, self.pattern, self.rng, self.noise)
+            for row in distances.astype(int).tolist():
+                yield (', '.join(map(str, row)) + '\r\n').encode('ascii'), 1 / self.rate
+
+
+def rplidar_descriptor(size, answer_type, continuous=False):
+    return bytes([SYNC_BYTE, SYNC_BYTE2]) + struct.pack('<I', size | (1 << 30 if continuous else 0)) + bytes([answer_type])
+
+
+def encode_nodes(new_scan, quality, angle, distance):
+    '''Standard scan nodes of measures, the inverse of lidar_driver.decode_nodes'''
+    nodes = np.empty((len(angle), 5), dtype=np.uint8)
+    angle_q6 = np.round(np.asarray(angle) * 64).astype(np.uint16) & 0x7FFF
+    distance_q2 = np.clip(np.round(np.asarray(distance) * 4), 0, 0xFFFF).astype(np.uint16)
+    new_scan = np.asarray(new_scan, dtype=np.uint8)
+    nodes[:, 0] = (np.minimum(quality, 63).astype(np.uint8) << 2) | ((new_scan ^ 1) << 1) | new_scan
+    nodes[:, 1] = ((angle_q6 & 0x7F) << 1) | 1
+    nodes[:, 2] = angle_q6 >> 7
+    nodes[:, 3] = distance_q2 & 0xFF
+    nodes[:, 4] = distance_q2 >> 8
+    return nodes
+
+
+def encode_capsules(start, distance, dense=False, first=False):
+    '''Express capsules, or dense ones, of the start angles (degrees) and the 32 (40) distances (mm) of each, the
+    inverse of lidar_driver.decode_capsules for evenly spaced samples, which need no angle compensation. first sets
+    the start flag of the first capsule, sent once a scan starts.'''
+    count = len(start)
+    capsules = np.zeros((count, PACKETS[DENSE_CAPSULE_TYPE if dense else CAPSULE_TYPE][0]), dtype=np.uint8)
+    start_q6 = np.round(np.asarray(start) * 64).astype(np.uint16) % (360 * 64)
+    if first and count:
+        start_q6[0] |= 0x8000
+    capsules[:, 2] = start_q6 & 0xFF
+    capsules[:, 3] = start_q6 >> 8
+    millimeters = np.round(np.asarray(distance)).reshape(count, -1)
+    if dense:
+        capsules[:, 4:] = np.clip(millimeters, 0, 0xFFFF).astype('<u2').view(np.uint8)
+    else:
+        # Two 14 bit distances per 5 byte cabin, their compensation bits left at zero
+        pairs = (np.clip(millimeters, 0, 0x3FFF).astype(np.uint16) << 2).reshape(count, 16, 2)
+        cabins = np.zeros((count, 16, 5), dtype=np.uint8)
+        cabins[:, :, 0], cabins[:, :, 1] = pairs[:, :, 0] & 0xFF, pairs[:, :, 0] >> 8
+        cabins[:, :, 2], cabins[:, :, 3] = pairs[:, :, 1] & 0xFF, pairs[:, :, 1] >> 8
+        capsules[:, 4:] = cabins.reshape(count, 80)
+    sums = np.bitwise_xor.reduce(capsules[:, 2:], axis=1)
+    capsules[:, 0] = 0xA0 | (sums & 0x0F)
+    capsules[:, 1] = 0x50 | (sums >> 4)
+    return capsules
+
+
+class RPLidarEmulator(PtyEmulator):
+    '''RPLidar A1: answers the info, health, sample rate and configuration requests of its scan modes, streams the
+    nodes or capsules of the simulated lidar from a scan request until a stop or reset'''
+    name = 'rplidar'
+    baudrate = RPLIDAR_BAUD_RATE
+    setting = 'LIDAR_PORT'
+
+    def __init__(self, health=(0, 0), **kwargs):
+        super().__init__(**kwargs)
+        self.health = health
+        self.input = bytearray()
+
+    def reply(self, answer_type, data):
+        self.replies += rplidar_descriptor(len(data), answer_type) + data
+
+    def handle(self, data):
+        self.input += data
+        while len(self.input) >= 2:
+            if self.input[0] != SYNC_BYTE:
+                del self.input[:1]
+                continue
+            command = self.input[1]
+            if command & 0x80:
+                # Requests with a payload carry its size and a checksum
+                if len(self.input) < 3 or len(self.input) < 4 + self.input[2]:
+                    return
+                end = 3 + self.input[2]
+                payload, valid = bytes(self.input[3:end]), checksum(self.input[:end]) == self.input[end]
+                del self.input[:end + 1]
+                if not valid:
+                    continue
+            else:
+                payload = b''
+                del self.input[:2]
+            self.command(command, payload)
+
+    def command(self, command, payload):
+        if command in (STOP, RESET):
+            self.restart(None)
+        elif command == GET_INFO:
+            self.reply(INFO_TYPE, RPLIDAR_INFO)
+        elif command == GET_HEALTH:
+            self.reply(HEALTH_TYPE, struct.pack('<BH', *self.health))
+        elif command == GET_SAMPLERATE:
+            self.reply(SAMPLERATE_TYPE, struct.pack('<HH', RPLIDAR_MODES[0][2], RPLIDAR_MODES[1][2]))
+        elif command == GET_LIDAR_CONF and len(payload) >= 4:
+            kind = struct.unpack('<I', payload[:4])[0]
+            mode = struct.unpack('<H', payload[4:6])[0] if len(payload) >= 6 else 0
+            value = self.configuration(kind, mode)
+            if value is not None:
+                self.reply(CONF_TYPE, payload[:4] + value)
+        elif command == SCAN:
+            self.scan(0)
+        elif command == EXPRESS_SCAN and payload:
+            # Mode 0 of the legacy express scan is the express mode itself
+            self.scan(payload[0] or 1)
+
+    def configuration(self, kind, mode):
+        if kind == CONF_SCAN_MODE_COUNT:
+            return struct.pack('<H', len(RPLIDAR_MODES))
+        if kind == CONF_SCAN_MODE_TYPICAL:
+            return struct.pack('<H', 2)
+        if mode >= len(RPLIDAR_MODES):
+            return None
+        name, answer_type, us_per_sample = RPLIDAR_MODES[mode]
+        if kind == CONF_SCAN_MODE_US_PER_SAMPLE:
+            return struct.pack('<I', us_per_sample * 256)
+        if kind == CONF_SCAN_MODE_ANS_TYPE:
+            return bytes([answer_type])
+        if kind == CONF_SCAN_MODE_NAME:
+            return name.encode('ascii') + b'\0'
+        return None
+
+    def scan(self, mode):
+        name, answer_type, us_per_sample = RPLIDAR_MODES[mode]
+        self.restart(self.packets(answer_type, us_per_sample / 1e6))
+        self.replies += rplidar_descriptor(PACKETS[answer_type][0], answer_type, continuous=True)
+
+    def packets(self, answer_type, period):
+        size, samples = PACKETS[answer_type]
+        count = max(int(BLOCK_SECONDS / period / samples), 1) * samples
+        for first in itertools.count(0, count):
+            t = np.arange(first - 1, first + count) * period
+            new_scan, quality, angle, distance = generate_data.lidar_measures(self.terrain, t[1:], self.pattern,
+                                                                              self.rng, self.noise)
+            if answer_type == SCAN_TYPE:
+                revolution = np.floor(generate_data.LIDAR_ROTATION * t)
+                data = encode_nodes(np.diff(revolution) > 0, quality, angle, distance)
+            else:
+                start = (360 * generate_data.LIDAR_ROTATION * t[1::samples]) % 360
+                data = encode_capsules(start, distance, answer_type == DENSE_CAPSULE_TYPE, first == 0)
+            _, packets = packet_views(data.tobytes(), size)
+            for packet in packets:
+                yield packet.tobytes(), samples * period
+
+
+def cyglidar_frame(payload_header, data):
+    body = struct.pack('<H', len(data) + 1) + bytes([payload_header]) + data
+    return CYGLIDAR_HEADER + body + bytes([checksum(body)])
+
+
+def pack_12bit(distances):
+    '''Pairs of 12 bit distances in 3 bytes, the inverse of processing.decode_cyglidar_3d'''
+    pairs = np.asarray(distances, dtype=np.uint16).reshape(-1, 2)
+    packed = np.empty((len(pairs), 3), dtype=np.uint8)
+    packed[:, 0] = pairs[:, 0] >> 4
+    packed[:, 1] = ((pairs[:, 0] & 0x0F) << 4) | (pairs[:, 1] >> 8)
+    packed[:, 2] = pairs[:, 1] & 0xFF
+    return packed.tobytes()
+
+
+class CygLidarEmulator(PtyEmulator):
+    '''CygLidar D1 in 3D mode: 160x60 distance images (mm) of the simulated terrain from a run 3D command until a
+    stop command'''
+    name = 'cyglidar'
+    baudrate = CYGLIDAR_BAUD_RATE
+
+    def __init__(self, rate=CYGLIDAR_RATE, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.input = bytearray()
+        fx = (CYGLIDAR_WIDTH / 2) / np.tan(np.radians(CYGLIDAR_HFOV / 2))
+        self.intrinsics = {'width': CYGLIDAR_WIDTH, 'height': CYGLIDAR_HEIGHT, 'fx': fx, 'fy': fx,
+                           'ppx': CYGLIDAR_WIDTH / 2, 'ppy': CYGLIDAR_HEIGHT / 2}
+
+    def handle(self, data):
+        self.input += data
+        commands, _ = split_cyglidar_frames(self.input)
+        for payload in commands:
+            if payload[0] == CYGLIDAR_RUN_3D:
+                if self.stream is None:
+                    self.restart(self.frames())
+            else:
+                # Stop, and the 2D and 1D modes which are not emulated
+                self.restart(None)
+
+    def frames(self):
+        for index in itertools.count():
+            x, y, heading = self.trajectory(np.array([index / self.rate]))
+            depth = generate_data.depth_frame(self.terrain, x[0], y[0], heading[0], self.intrinsics, self.rng,
+                                              self.noise)
+            data = pack_12bit(np.minimum(depth, CYGLIDAR_DISTANCE_LIMIT))
+            yield cyglidar_frame(CYGLIDAR_RUN_3D, data), 1 / self.rate
+
+
+EMULATORS = {emulator.name: emulator for emulator in
+             (GnssEmulator, UltrasonicEmulator, RPLidarEmulator, CygLidarEmulator)}
+
+
+def read_gnss(emulator, seconds):
+    '''(sentences, unit, errors) read with the line parsing of the recorders, a sentence failing its checksum that
+    parse_nmea still accepted counts as an error'''
+    sentences = errors = 0
+    deadline = time.monotonic() + seconds
+    with serial.Serial(emulator.port, emulator.baudrate, timeout=READ_TIMEOUT) as ser:
+        while time.monotonic() < deadline:
+            raw = ser.readline().strip()
+            if not raw:
+                continue
+            line = raw.decode('ascii', errors='replace')
+            sentences += 1
+            try:
+                data_type, _ = parse_nmea(line)
+                if data_type == "GNGGA":
+                    parse_fix_quality(line)
+            except (ValueError, IndexError):
+                errors += 1
+                continue
+            body, _, received = raw[1:].partition(b'*')
+            if received != f"{checksum(body):02X}".encode('ascii'):
+                errors += 1
+    return sentences, 'sentences', errors
+
+
+def read_ultrasonic(emulator, seconds):
+    lines = errors = 0
+    deadline = time.monotonic() + seconds
+    with serial.Serial(emulator.port, emulator.baudrate, timeout=READ_TIMEOUT) as ser:
+        while time.monotonic() < deadline:
+            line = ser.readline()[:-1].decode('ascii', errors='replace')
+            if not line:
+                continue
+            lines += 1
+            try:
+                if len([int(value) for value in line.split(',')]) != len(generate_data.ULTRASONIC_OFFSETS):
+                    errors += 1
+            except ValueError:
+                errors += 1
+    return lines, 'lines', errors
+
+
+def read_rplidar(emulator, seconds, scan_mode='express'):
+    '''(samples, unit, bytes dropped by the driver to resynchronize)'''
+    samples = 0
+    lidar = RPLidarDriver(emulator.port, emulator.baudrate, timeout=READ_TIMEOUT)
+    try:
+        deadline = time.monotonic() + seconds
+        batches = lidar.iter_batches(scan_mode)
+        try:
+            for batch in batches:
+                samples += len(batch)
+                if time.monotonic() >= deadline:
+                    break
+        except LidarError as e:
+            print(f"rplidar: {e}")
+        dropped = lidar.decoder.dropped_bytes if lidar.decoder else 0
+        batches.close()
+        lidar.stop()
+        lidar.stop_motor()
+    finally:
+        lidar.disconnect()
+    return samples, 'samples', dropped
+
+
+def read_cyglidar(emulator, seconds):
+    '''(frames, unit, bytes dropped to find the frames)'''
+    frames = dropped = 0
+    buffer = bytearray()
+    deadline = time.monotonic() + seconds
+    with serial.Serial(emulator.port, emulator.baudrate, timeout=READ_TIMEOUT) as ser:
+        ser.write(CYGLIDAR_RUN_3D_COMMAND)
+        while time.monotonic() < deadline:
+            buffer += ser.read(max(ser.in_waiting, 1))
+            payloads, skipped = split_cyglidar_frames(buffer)
+            dropped += skipped
+            for payload in payloads:
+                if payload[0] == CYGLIDAR_RUN_3D and len(payload) == CYGLIDAR_3D_LENGTH + 1:
+                    decode_cyglidar_3d(payload[1:])
+                    frames += 1
+        ser.write(CYGLIDAR_STOP_COMMAND)
+    return frames, 'frames', dropped
+
+
+READERS = {'gnss': read_gnss, 'ultrasonic': read_ultrasonic, 'rplidar': read_rplidar, 'cyglidar': read_cyglidar}
+
+
+def stress(emulator, seconds, **options):
+    start = time.monotonic()
+    count, unit, errors = READERS[emulator.name](emulator, seconds, **options)
+    elapsed = time.monotonic() - start
+    line_rate = f"{emulator.line_rate / 1000:.1f} kB/s" if emulator.line_rate else "unlimited"
+    print(f"{emulator.name:<12}{count / elapsed:>12.0f} {unit}/s{emulator.stats['bytes'] / elapsed / 1000:>12.1f} kB/s"
+          f" of {line_rate:<14}{errors:>8} errors  max lag {emulator.stats['max lag'] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate the serial sensors on pseudo-terminals.")
+    parser.add_argument('devices', nargs='+', choices=list(EMULATORS))
+    parser.add_argument('--speed', type=float, default=REALTIME,
+                        help="1 for the real rates, 2 for twice as fast, 0 for as fast as the reader takes the bytes")
+    parser.add_argument('--rate', type=float, help="messages per second of the gnss, ultrasonic and cyglidar devices")
+    parser.add_argument('--pattern', default='serpentine', help="rover path of generate_data")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corrupt', type=float, default=0, help="probability of a flipped bit per byte")
+    parser.add_argument('--drop', type=float, default=0, help="probability of losing a message")
+    parser.add_argument('--garbage', type=float, default=0, help="probability of random bytes before a message")
+    parser.add_argument('--truncate', type=float, default=0, help="probability of cutting a message short")
+    parser.add_argument('--stress', type=float, metavar='SECONDS', help="read each device for that long and report")
+    parser.add_argument('--scan-mode', choices=SCAN_MODES, default='express', help="RPLidar scan mode read by --stress")
+    args = parser.parse_args()
+
+    def create(name):
+        errors = ErrorInjection(args.corrupt, args.drop, args.garbage, args.truncate, args.seed)
+        options = {} if args.rate is None or name == 'rplidar' else {'rate': args.rate}
+        return EMULATORS[name](speed=args.speed, errors=errors, seed=args.seed, pattern=args.pattern, **options)
+
+    emulators = []
+    try:
+        if args.stress:
+            # One device at a time, so none fills its port before it is read
+            for name in args.devices:
+                emulators.append(create(name).start())
+                stress(emulators[-1], args.stress, **({'scan_mode': args.scan_mode} if name == 'rplidar' else {}))
+        else:
+            emulators = [create(name).start() for name in args.devices]
+            for emulator in emulators:
+                hint = f"  TRIC_{emulator.setting}={emulator.port}" if emulator.setting else ""
+                print(f"{emulator.name:<12}{emulator.port:<14}{emulator.baudrate:>9} baud{hint}")
+            print("Ctrl+C to stop")
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for emulator in emulators:
+            emulator.close()
+            injected = ', '.join(f"{value} {key}" for key, value in emulator.errors.counts.items() if value)
+            print(f"{emulator.name}: {emulator.stats['messages']} messages, {emulator.stats['bytes']} bytes"
+                  + (f", injected {injected}" if injected else ""))
+
+
+if __name__ == '__main__':
+    main()
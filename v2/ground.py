@@ -0,0 +1,101 @@
+'''Ground plane segmentation of point clouds, batched RANSAC scored in NumPy or a plane through the lowest point of
+each grid cell. Planes are (a, b, c, d) with a*x + b*y + c*z + d = 0, (a, b, c) a unit normal pointing up.'''
+import numpy as np
+
+THRESHOLD = 0.03  # meters from the plane for a point to be ground
+HYPOTHESES = 256  # planes scored at once
+SCORE_SAMPLES = 2048  # points the hypotheses are scored on, the best one is refined on every point
+MAX_TILT = 30  # Degrees, steeper planes are walls or obstacles rather than ground
+GRID_CELL = 0.5  # meters
+MIN_POINTS = 10
+
+
+def plane_through(points):
+    '''Least squares plane of points, normal up'''
+    center = points.mean(axis=0)
+    _, _, vt = np.linalg.svd(points - center, full_matrices=False)
+    normal = vt[2] if vt[2][2] >= 0 else -vt[2]
+    return np.append(normal, -normal @ center)
+
+
+def distances(points, plane):
+    '''Signed distances of points above the plane'''
+    return points @ plane[:3] + plane[3]
+
+
+def fit_ransac(points, threshold=THRESHOLD, hypotheses=HYPOTHESES, max_tilt=MAX_TILT, rng=None):
+    '''(plane, inlier mask) of the dominant near horizontal plane, None for the plane if there is none'''
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < MIN_POINTS:
+        return None, np.zeros(len(points), dtype=bool)
+    rng = np.random.default_rng(0) if rng is None else rng
+    samples = points[rng.choice(len(points), min(SCORE_SAMPLES, len(points)), replace=False)]
+
+    # Every hypothesis at once: planes through random triplets, scored on the same sample
+    triplets = points[rng.integers(0, len(points), (hypotheses, 3))]
+    normals = np.cross(triplets[:, 1] - triplets[:, 0], triplets[:, 2] - triplets[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    valid = lengths > 1e-9
+    normals[valid] /= lengths[valid, None]
+    normals *= np.where(normals[:, 2:] < 0, -1, 1)
+    valid &= normals[:, 2] >= np.cos(np.radians(max_tilt))
+    if not valid.any():
+        return None, np.zeros(len(points), dtype=bool)
+    normals = normals[valid]
+    offsets = -np.einsum('ij,ij->i', normals, triplets[valid, 0])
+    scores = (np.abs(samples @ normals.T + offsets) <= threshold).sum(axis=0)
+    best = np.argmax(scores)
+    plane = np.append(normals[best], offsets[best])
+
+    # Refined on the inliers of the full cloud, then the inliers of the refined plane
+    inliers = np.abs(distances(points, plane)) <= threshold
+    if inliers.sum() >= MIN_POINTS:
+        refined = plane_through(points[inliers])
+        if refined[2] >= np.cos(np.radians(max_tilt)):
+            plane = refined
+            inliers = np.abs(distances(points, plane)) <= threshold
+    return plane, inliers
+
+
+def fit_grid(points, threshold=THRESHOLD, cell=GRID_CELL, max_tilt=MAX_TILT):
+    '''(plane, inlier mask) of a plane through the lowest point of each cell, refitted once without the cells above
+    it, e.g. the ones only holding an obstacle'''
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < MIN_POINTS:
+        return None, np.zeros(len(points), dtype=bool)
+    keys = np.floor(points[:, :2] / cell).astype(np.int64)
+    keys -= keys.min(axis=0)
+    flat = keys[:, 0] * (keys[:, 1].max() + 1) + keys[:, 1]
+    # Sorting by cell then height puts the lowest point of every cell first
+    order = np.lexsort((points[:, 2], flat))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = flat[order][1:] != flat[order][:-1]
+    lowest = points[order[first]]
+    if len(lowest) < 3:
+        return None, np.zeros(len(points), dtype=bool)
+    plane = plane_through(lowest)
+    residuals = distances(lowest, plane)
+    kept = residuals <= max(3 * np.median(np.abs(residuals)), threshold)
+    if kept.sum() >= 3:
+        plane = plane_through(lowest[kept])
+    if plane[2] < np.cos(np.radians(max_tilt)):
+        return None, np.zeros(len(points), dtype=bool)
+    return plane, np.abs(distances(points, plane)) <= threshold
+
+
+METHODS = {'ransac': fit_ransac, 'grid': fit_grid}
+
+
+def segment_ground(points, method='ransac', threshold=THRESHOLD):
+    '''(plane, inlier mask) with the method of METHODS'''
+    return METHODS[method](points, threshold)
+
+
+def ground_height(plane, x=0.0, y=0.0):
+    '''Height of the plane at (x, y)'''
+    return -(plane[0] * x + plane[1] * y + plane[3]) / plane[2]
+
+
+def plane_tilt(plane):
+    '''Angle between the plane and the horizontal in degrees'''
+    return np.degrees(np.arccos(np.clip(plane[2], -1, 1)))
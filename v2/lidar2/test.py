@@ -1,7 +1,12 @@
+import os
+import sys
 import serial
 import cv2
 import numpy as np
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processing import decode_cyglidar_3d
+
 RUN_3D       =  [0x5A, 0x77, 0xFF, 0x02, 0x00, 0x08, 0x00, 0x0A]
 COMMAND_STOP =  [0x5A, 0x77, 0xFF, 0x02, 0x00, 0x02, 0x00, 0x00]
 
@@ -29,23 +34,7 @@ def Visualize(receivedData):
     cv2.waitKey(1)
 
 def Get3DDistanceDataFromReceivedData(receivedData):
-    global dataLength3D,normalizeDistanceLimit
-    index = 0
-    distanceData = [0 for i in range(int(dataLength3D / 3 * 2))]
-    for i in range(0, dataLength3D-2, 3):
-        pixelFirst = receivedData[i] << 4 | receivedData[i+1] >> 4
-        pixelSecond = (receivedData[i+1] & 0xf) << 8 | receivedData[i+2]
-
-        if pixelFirst > normalizeDistanceLimit:
-            pixelFirst = normalizeDistanceLimit
-        if pixelSecond > normalizeDistanceLimit:
-            pixelSecond = normalizeDistanceLimit
-        
-        distanceData[index] = pixelFirst
-        index += 1
-        distanceData[index] = pixelSecond
-        index += 1
-    return distanceData
+    return decode_cyglidar_3d(receivedData, dataLength3D, normalizeDistanceLimit)
 
 def DistanceDataToNormalizedNumpyArray(distanceData):
     global normalizeDistanceLimit
@@ -0,0 +1,390 @@
+'''Slamtec RPLidar A1/A2 driver reading scans straight from the serial port in standard, express and boost modes.
+
+The rplidar package decodes one sample at a time into a Python tuple and only runs the standard scan, about 2000
+samples per second on an A1. Here the serial stream is read in blocks and every complete packet in a block is decoded
+at once with NumPy: standard scan nodes (5 bytes, 1 sample), express capsules (84 bytes, 32 samples with their angle
+compensation) and dense capsules (84 bytes, 40 samples), which together cover the Express and Boost modes of the A1
+and A2. Measures come out as MEASURE_DTYPE arrays in the angles (degrees) and distances (mm) of rplidar.
+
+    lidar = RPLidarDriver('/dev/ttyUSB0')
+    for batch in lidar.iter_batches('boost'):
+        batch['angle'], batch['distance']
+
+A capsule is only decoded once the next one arrives, its sample angles are interpolated between their start angles,
+as the Slamtec SDK does. Ultra capsules (A3 Sensitivity and Stability modes) are not decoded.'''
+import time
+import struct
+import logging
+import numpy as np
+import serial
+
+BAUD_RATE = 115200
+TIMEOUT = 1  # seconds
+MOTOR_PWM = 660  # A2 motor speed, the A1 motor is switched by DTR
+
+SYNC_BYTE = 0xA5
+SYNC_BYTE2 = 0x5A
+STOP = 0x25
+RESET = 0x40
+SCAN = 0x20
+EXPRESS_SCAN = 0x82
+GET_INFO = 0x50
+GET_HEALTH = 0x52
+GET_SAMPLERATE = 0x59
+GET_LIDAR_CONF = 0x84
+SET_PWM = 0xF0
+
+DESCRIPTOR_SIZE = 7
+INFO_TYPE = 0x04
+HEALTH_TYPE = 0x06
+SAMPLERATE_TYPE = 0x15
+CONF_TYPE = 0x20
+SCAN_TYPE = 0x81
+CAPSULE_TYPE = 0x82
+ULTRA_CAPSULE_TYPE = 0x84
+DENSE_CAPSULE_TYPE = 0x85
+
+CONF_SCAN_MODE_COUNT = 0x70
+CONF_SCAN_MODE_US_PER_SAMPLE = 0x71
+CONF_SCAN_MODE_ANS_TYPE = 0x75
+CONF_SCAN_MODE_TYPICAL = 0x7C
+CONF_SCAN_MODE_NAME = 0x7F
+
+HEALTH_STATUSES = {0: 'Good', 1: 'Warning', 2: 'Error'}
+SCAN_MODES = ('standard', 'express', 'boost')
+# Packet size and samples per packet of the answer types decoded here
+PACKETS = {SCAN_TYPE: (5, 1), CAPSULE_TYPE: (84, 32), DENSE_CAPSULE_TYPE: (84, 40)}
+CAPSULE_QUALITY = 15  # capsules carry no quality, samples with a distance get the one of a full standard return
+
+MEASURE_DTYPE = np.dtype([('timestamp', '<f8'), ('new_scan', '?'), ('quality', 'u1'), ('angle', '<f8'),
+                          ('distance', '<f8')])
+
+
+class LidarError(Exception):
+    pass
+
+
+def checksum(data):
+    return int(np.bitwise_xor.reduce(np.frombuffer(bytes(data), dtype=np.uint8))) if len(data) else 0
+
+
+def packet_views(buffer, size):
+    '''(number of whole packets, (n, size) uint8 view) of a bytearray'''
+    count = len(buffer) // size
+    return count, np.frombuffer(buffer, dtype=np.uint8, count=count * size).reshape(count, size)
+
+
+def valid_nodes(nodes):
+    '''Standard scan nodes whose start flag and its inverse disagree and whose check bit is set'''
+    return (((nodes[:, 0] ^ (nodes[:, 0] >> 1)) & 1) == 1) & ((nodes[:, 1] & 1) == 1)
+
+
+def valid_capsules(capsules):
+    '''Capsules with both sync nibbles whose checksum, split over the low nibbles, matches their payload'''
+    expected = (capsules[:, 0] & 0x0F) | ((capsules[:, 1] & 0x0F) << 4)
+    return (((capsules[:, 0] >> 4) == 0xA) & ((capsules[:, 1] >> 4) == 0x5)
+            & (np.bitwise_xor.reduce(capsules[:, 2:], axis=1) == expected))
+
+
+def decode_nodes(nodes):
+    '''(new_scan, quality, angle, distance) of standard scan nodes'''
+    new_scan = (nodes[:, 0] & 1).astype(bool)
+    quality = nodes[:, 0] >> 2
+    angle = ((nodes[:, 1].astype(np.uint16) >> 1) | (nodes[:, 2].astype(np.uint16) << 7)) / 64.0
+    distance = (nodes[:, 3].astype(np.uint16) | (nodes[:, 4].astype(np.uint16) << 8)) / 4.0
+    return new_scan, quality, angle, distance
+
+
+def start_angles(capsules):
+    return ((capsules[:, 2].astype(np.uint16) | (capsules[:, 3].astype(np.uint16) << 8)) & 0x7FFF) / 64.0
+
+
+def decode_capsules(capsules, next_start, dense=False):
+    '''(new_scan, quality, angle, distance) of consecutive express capsules, or dense ones holding 40 plain
+    distances, next_start is the start angle of the capsule following each one, their samples are spread evenly up
+    to it'''
+    count = len(capsules)
+    start = start_angles(capsules)
+    if dense:
+        distance = capsules[:, 4:].copy().view('<u2').astype(np.float64)
+        offset = np.zeros_like(distance)
+    else:
+        cabins = capsules[:, 4:].reshape(count, 16, 5).astype(np.uint16)
+        first = cabins[:, :, 0] | (cabins[:, :, 1] << 8)
+        second = cabins[:, :, 2] | (cabins[:, :, 3] << 8)
+        # 6 bit compensation in 1/8 degree, its two high bits in the low bits of the distance
+        offset = np.stack([(cabins[:, :, 4] & 0x0F) | ((first & 0x3) << 4),
+                           (cabins[:, :, 4] >> 4) | ((second & 0x3) << 4)], axis=2).reshape(count, 32) / 8.0
+        distance = np.stack([first >> 2, second >> 2], axis=2).reshape(count, 32).astype(np.float64)
+    samples = distance.shape[1]
+    step = ((next_start - start) % 360) / samples
+    raw = start[:, np.newaxis] + step[:, np.newaxis] * np.arange(samples)
+    new_scan = (raw % 360) < step[:, np.newaxis]
+    angle = (raw - offset) % 360
+    quality = np.where(distance > 0, CAPSULE_QUALITY, 0).astype(np.uint8)
+    return new_scan.ravel(), quality.ravel(), angle.ravel(), distance.ravel()
+
+
+class PacketDecoder:
+    '''Decodes the packets of one answer type from the bytes of a scan as they arrive'''
+    def __init__(self, answer_type):
+        if answer_type == ULTRA_CAPSULE_TYPE:
+            raise LidarError("Ultra capsules (A3 Sensitivity and Stability modes) are not supported, "
+                             "choose the standard, express or boost mode")
+        if answer_type not in PACKETS:
+            raise LidarError(f"Unknown scan answer type 0x{answer_type:02X}")
+        self.answer_type = answer_type
+        self.size, self.samples = PACKETS[answer_type]
+        self.buffer = bytearray()
+        self.previous = None
+        self.dropped_bytes = 0
+
+    @property
+    def pending(self):
+        '''Samples received but not decoded yet, the ones of the capsule waiting for the next'''
+        return 0 if self.previous is None or self.answer_type == SCAN_TYPE else self.samples
+
+    def valid(self, packets):
+        return valid_nodes(packets) if self.answer_type == SCAN_TYPE else valid_capsules(packets)
+
+    def resynchronize(self):
+        '''Drops the bytes before the next valid packet, one followed by another valid one when it has arrived'''
+        for offset in range(1, len(self.buffer) - self.size + 1):
+            count, packets = packet_views(self.buffer[offset:offset + 2 * self.size], self.size)
+            if self.valid(packets).all():
+                break
+        else:
+            offset = len(self.buffer) - self.size + 1
+        del self.buffer[:offset]
+        self.dropped_bytes += offset
+        self.previous = None
+
+    def feed(self, data):
+        '''(new_scan, quality, angle, distance) arrays of the packets completed by data'''
+        self.buffer += data
+        decoded = []
+        while len(self.buffer) >= self.size:
+            count, packets = packet_views(self.buffer, self.size)
+            valid = self.valid(packets)
+            good = count if valid.all() else int(np.argmin(valid))
+            if good:
+                decoded.append(self.decode(packets[:good].copy()))
+            del packets
+            del self.buffer[:good * self.size]
+            if good < count:
+                self.resynchronize()
+            else:
+                break
+        decoded = [d for d in decoded if d is not None]
+        if not decoded:
+            return None
+        return tuple(np.concatenate(column) for column in zip(*decoded))
+
+    def decode(self, packets):
+        if self.answer_type == SCAN_TYPE:
+            return decode_nodes(packets)
+        # A set start flag marks the first capsule after the scan started, there is no previous one to finish
+        restart = np.flatnonzero(packets[:, 3] & 0x80)
+        if len(restart):
+            self.previous = None
+            packets = packets[restart[-1]:]
+        capsules = packets if self.previous is None else np.vstack([self.previous, packets])
+        self.previous = capsules[-1:].copy()
+        if len(capsules) < 2:
+            return None
+        return decode_capsules(capsules[:-1], start_angles(capsules[1:]), self.answer_type == DENSE_CAPSULE_TYPE)
+
+
+class RPLidarDriver:
+    '''One RPLidar on a serial port, with the methods of rplidar.RPLidar the recorders use'''
+    def __init__(self, port, baudrate=BAUD_RATE, timeout=TIMEOUT):
+        self.port = port
+        self.serial = serial.Serial(port, baudrate, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
+                                    timeout=timeout)
+        self.motor_running = False
+        self.scanning = False
+        self.decoder = None
+
+    def send(self, command, payload=None):
+        request = bytes([SYNC_BYTE, command])
+        if payload is not None:
+            request += bytes([len(payload)]) + payload
+            request += bytes([checksum(request)])
+        self.serial.write(request)
+
+    def read_descriptor(self):
+        '''(size, single response, answer type) of the answer to the last command'''
+        descriptor = self.serial.read(DESCRIPTOR_SIZE)
+        if len(descriptor) != DESCRIPTOR_SIZE or descriptor[0] != SYNC_BYTE or descriptor[1] != SYNC_BYTE2:
+            raise LidarError(f"Invalid response descriptor {descriptor.hex()} from {self.port}")
+        size_and_mode = struct.unpack('<I', descriptor[2:6])[0]
+        return size_and_mode & 0x3FFFFFFF, (size_and_mode >> 30) == 0, descriptor[6]
+
+    def request(self, command, answer_type, payload=None):
+        '''Payload of the single response to a command'''
+        self.send(command, payload)
+        size, single, kind = self.read_descriptor()
+        if kind != answer_type or not single:
+            raise LidarError(f"Unexpected answer type 0x{kind:02X} to command 0x{command:02X}")
+        data = self.serial.read(size)
+        if len(data) != size:
+            raise LidarError(f"Answer to command 0x{command:02X} cut short, {len(data)} of {size} bytes")
+        return data
+
+    def get_info(self):
+        data = self.request(GET_INFO, INFO_TYPE)
+        return {'model': data[0], 'firmware': (data[2], data[1]), 'hardware': data[3],
+                'serialnumber': data[4:].hex().upper()}
+
+    def get_health(self):
+        status, error_code = struct.unpack('<BH', self.request(GET_HEALTH, HEALTH_TYPE))
+        return HEALTH_STATUSES.get(status, 'Unknown'), error_code
+
+    def get_sample_times(self):
+        '''Microseconds per sample of the standard and express scans, as the firmware reports them'''
+        return struct.unpack('<HH', self.request(GET_SAMPLERATE, SAMPLERATE_TYPE))
+
+    def get_conf(self, kind, mode=None):
+        payload = struct.pack('<I', kind) + (b'' if mode is None else struct.pack('<H', mode))
+        data = self.request(GET_LIDAR_CONF, CONF_TYPE, payload)
+        if struct.unpack('<I', data[:4])[0] != kind:
+            raise LidarError(f"Configuration 0x{kind:02X} answered for another entry")
+        return data[4:]
+
+    def get_scan_modes(self):
+        '''[{'id', 'name', 'us_per_sample', 'answer_type'}] of the modes the firmware lists, empty for firmware
+        without the configuration command (A1 before 1.24), which still runs the express scan as its mode 0'''
+        try:
+            count = struct.unpack('<H', self.get_conf(CONF_SCAN_MODE_COUNT))[0]
+        except LidarError:
+            self.clear_input()
+            return []
+        modes = []
+        for mode in range(count):
+            modes.append({'id': mode,
+                          'name': self.get_conf(CONF_SCAN_MODE_NAME, mode).split(b'\0')[0].decode('ascii', 'replace'),
+                          'us_per_sample': struct.unpack('<I', self.get_conf(CONF_SCAN_MODE_US_PER_SAMPLE, mode))[0] / 256,
+                          'answer_type': self.get_conf(CONF_SCAN_MODE_ANS_TYPE, mode)[0]})
+        return modes
+
+    def clear_input(self):
+        self.serial.reset_input_buffer()
+
+    def set_pwm(self, pwm):
+        self.send(SET_PWM, struct.pack('<H', pwm))
+
+    def set_dtr(self, state):
+        try:
+            self.serial.dtr = state
+        except OSError:
+            # Pseudo-terminals and some adapters have no modem lines, only the A2 PWM reaches the motor then
+            logging.debug(f"{self.port} has no DTR line")
+
+    def start_motor(self):
+        # The A1 motor runs while DTR is low, the A2 one at the PWM duty
+        self.set_dtr(False)
+        self.set_pwm(MOTOR_PWM)
+        self.motor_running = True
+
+    def stop_motor(self):
+        self.set_pwm(0)
+        time.sleep(0.001)
+        self.set_dtr(True)
+        self.motor_running = False
+
+    def stop(self):
+        self.send(STOP)
+        time.sleep(0.001)
+        self.scanning = False
+        self.clear_input()
+
+    def reset(self):
+        self.send(RESET)
+        time.sleep(0.002)
+        self.scanning = False
+        self.clear_input()
+
+    def disconnect(self):
+        self.serial.close()
+
+    def start(self, scan_mode='express'):
+        '''Starts a scan, returns the microseconds per sample'''
+        if scan_mode not in SCAN_MODES:
+            raise ValueError(f"scan_mode should be one of {SCAN_MODES}, not {scan_mode!r}")
+        if not self.motor_running:
+            self.start_motor()
+        status, error_code = self.get_health()
+        if status == 'Error':
+            raise LidarError(f"RPLidar hardware error {error_code}, power it off and on again")
+        if status == 'Warning':
+            logging.warning(f"RPLidar health warning {error_code}")
+
+        standard_us, express_us = self.get_sample_times()
+        if scan_mode == 'standard':
+            self.send(SCAN)
+            us_per_sample = standard_us
+        else:
+            modes = {mode['name'].lower(): mode for mode in self.get_scan_modes()}
+            if scan_mode in modes:
+                mode = modes[scan_mode]
+            elif scan_mode == 'express' and not modes:
+                mode = {'id': 0, 'us_per_sample': express_us}
+            else:
+                raise LidarError(f"{self.port} has no {scan_mode} scan mode, it has {', '.join(modes) or 'express'}")
+            self.send(EXPRESS_SCAN, bytes([mode['id'], 0, 0, 0, 0]))
+            us_per_sample = mode['us_per_sample']
+        size, single, answer_type = self.read_descriptor()
+        self.decoder = PacketDecoder(answer_type)
+        if size != self.decoder.size:
+            raise LidarError(f"Scan packets of {size} bytes, expected {self.decoder.size}")
+        self.scanning = True
+        return us_per_sample
+
+    def iter_batches(self, scan_mode='express'):
+        '''MEASURE_DTYPE arrays of the samples decoded from each read of the port. Timestamps (time.time) are
+        spread back from the read by the sample period, a capsule's samples one capsule earlier as it is decoded
+        when the next one arrives.'''
+        period = self.start(scan_mode) / 1e6
+        try:
+            while True:
+                data = self.serial.read(max(self.serial.in_waiting, self.decoder.size))
+                if not data:
+                    raise LidarError(f"No scan data from {self.port} within {self.serial.timeout}s")
+                read_time = time.time()
+                decoded = self.decoder.feed(data)
+                if decoded is None:
+                    continue
+                new_scan, quality, angle, distance = decoded
+                batch = np.empty(len(angle), dtype=MEASURE_DTYPE)
+                batch['timestamp'] = read_time - (np.arange(len(angle))[::-1] + self.decoder.pending) * period
+                batch['new_scan'], batch['quality'], batch['angle'], batch['distance'] = decoded
+                yield batch
+        finally:
+            if self.decoder and self.decoder.dropped_bytes:
+                logging.warning(f"{self.decoder.dropped_bytes} bytes from {self.port} dropped to resynchronize")
+
+    def iter_measures(self, scan_mode='express'):
+        '''(new_scan, quality, angle, distance) tuples as rplidar.RPLidar.iter_measures, for quick tools'''
+        for batch in self.iter_batches(scan_mode):
+            yield from zip(batch['new_scan'].tolist(), batch['quality'].tolist(), batch['angle'].tolist(),
+                           batch['distance'].tolist())
+
+    def iter_scans(self, scan_mode='express', min_len=5):
+        '''MEASURE_DTYPE arrays of the measured samples of each full revolution'''
+        return split_scans(self.iter_batches(scan_mode), min_len)
+
+
+def split_scans(batches, min_len=5):
+    '''Measures of batches regrouped by revolution, from one new_scan flag to the next, without the unmeasured ones'''
+    parts = []
+    for batch in batches:
+        previous = 0
+        for start in np.flatnonzero(batch['new_scan']):
+            parts.append(batch[previous:start])
+            scan = np.concatenate(parts)
+            scan = scan[scan['distance'] > 0]
+            if len(scan) > min_len:
+                yield scan
+            parts = []
+            previous = start
+        parts.append(batch[previous:])
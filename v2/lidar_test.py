@@ -1,17 +1,19 @@
 import sys
-from rplidar import RPLidar
+from lidar_driver import RPLidarDriver
+from config import load_config
 
-PORT_NAME = 'COM3'
+SETTINGS = load_config('lidar', {'LIDAR_PORT': 'COM3', 'LIDAR_SCAN_MODE': 'express'}, strict=False)  # see config.py
+PORT_NAME = SETTINGS['LIDAR_PORT']
 
 def record_measurements(path):
-    lidar = RPLidar(PORT_NAME)
+    lidar = RPLidarDriver(PORT_NAME)
     outfile = open(path, 'w')
     try:
         print('Recording measurements... Press Crl+C to stop.')
-        for measurement in lidar.iter_measures():
-            if measurement[1] > 0:
-                line = '\t'.join(str(v) for v in measurement)
-                outfile.write(line + '\n')
+        for batch in lidar.iter_batches(SETTINGS['LIDAR_SCAN_MODE']):
+            batch = batch[batch['quality'] > 0]
+            outfile.write(''.join(f"{n}\t{q}\t{a}\t{d}\n" for n, q, a, d in zip(
+                batch['new_scan'].tolist(), batch['quality'].tolist(), batch['angle'].tolist(), batch['distance'].tolist())))
     except KeyboardInterrupt:
         print('Stoping.')
     lidar.stop()
@@ -0,0 +1,179 @@
+'''Live matplotlib views whose redraw time stays the same however long they run
+
+The acquisition only writes into preallocated buffers from its own thread: a TrailBuffer for a trajectory, a
+ScanBuffer for the latest lidar revolution. A LiveView renders them on a timer of the figure's canvas, at its own rate
+and whatever the rate of the sensors: it restores the background cached at the last full draw, draws the animated
+artists over it and blits, so axes, ticks and grid are not rendered again. A full draw only happens when the window
+is resized or when a growing view leaves its limits, which then double, so a few times over a whole survey.
+
+    trail = TrailBuffer()
+    fig, ax = plt.subplots()
+    view = LiveView(fig)
+    view.add(ax.scatter([], []), trail, grow=True)
+    threading.Thread(target=acquire, args=(trail,), daemon=True).start()  # calls trail.append(x, y)
+    plt.show()
+'''
+import time
+import threading
+import collections
+import numpy as np
+
+TRAIL_POINTS = 4096  # points of history displayed, older ones are decimated to stay within
+SCAN_POINTS = 8192  # samples of a revolution displayed, more than a boost mode revolution
+RENDER_INTERVAL = 50  # ms between two redraws
+RENDER_TIMES = 256  # latest redraw times kept for the statistics
+MIN_SPAN = 1.0  # data units, smallest half width of a growing view
+
+
+class TrailBuffer:
+    '''History of 2D points in a preallocated array. When it is full, every other point is dropped and only one point
+    in stride is kept from then on, twice as many as before, so the whole history stays evenly decimated.'''
+    def __init__(self, capacity=TRAIL_POINTS):
+        self.capacity = capacity - capacity % 2
+        self.points = np.empty((self.capacity, 2))
+        self.display = np.empty((self.capacity + 1, 2))
+        self.count = 0
+        self.stride = 1
+        self.skipped = 0
+        self.latest = None
+        self.total = 0
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def append(self, x, y):
+        with self.lock:
+            self.total += 1
+            self.version += 1
+            self.latest = x, y
+            self.skipped += 1
+            if self.skipped < self.stride:
+                return
+            self.skipped = 0
+            if self.count == self.capacity:
+                self.points[:self.capacity // 2] = self.points[::2]
+                self.count = self.capacity // 2
+                self.stride *= 2
+            self.points[self.count] = x, y
+            self.count += 1
+
+    def snapshot(self):
+        '''(points, None), the decimated history followed by the latest point, valid until the next snapshot'''
+        with self.lock:
+            count = self.count
+            self.display[:count] = self.points[:count]
+            if self.skipped:
+                self.display[count] = self.latest
+                count += 1
+        return self.display[:count], None
+
+
+class ScanBuffer:
+    '''Latest revolution of a lidar as polar offsets (angle in radians, distance) and qualities, in preallocated arrays'''
+    def __init__(self, capacity=SCAN_POINTS):
+        self.capacity = capacity
+        self.offsets = np.empty((capacity, 2))
+        self.values = np.empty(capacity)
+        self.display_offsets = np.empty((capacity, 2))
+        self.display_values = np.empty(capacity)
+        self.count = 0
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def write(self, angle, distance, quality):
+        '''Replaces the scan by the given one, angle in degrees'''
+        count = min(len(angle), self.capacity)
+        with self.lock:
+            np.radians(angle[:count], out=self.offsets[:count, 0])
+            self.offsets[:count, 1] = distance[:count]
+            self.values[:count] = quality[:count]
+            self.count = count
+            self.version += 1
+
+    def snapshot(self):
+        '''(offsets, values) of the latest scan, valid until the next snapshot'''
+        with self.lock:
+            count = self.count
+            self.display_offsets[:count] = self.offsets[:count]
+            self.display_values[:count] = self.values[:count]
+        return self.display_offsets[:count], self.display_values[:count]
+
+
+class LiveView:
+    '''Renders scatter artists of a figure from their buffers with blitting, on a timer of the figure's canvas'''
+    def __init__(self, fig, interval=RENDER_INTERVAL):
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.layers = []
+        self.background = None
+        self.render_times = collections.deque(maxlen=RENDER_TIMES)
+        self.full_draws = 0
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.timer = self.canvas.new_timer(interval=interval)
+        self.timer.add_callback(self.render)
+        self.timer.start()
+
+    def add(self, artist, buffer, grow=False):
+        '''Displays buffer in the scatter artist, growing the limits of its axes to keep the data in view if grow'''
+        artist.set_animated(True)
+        self.layers.append([artist, buffer, grow, None])
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.full_draws += 1
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist, *_ in self.layers:
+            self.fig.draw_artist(artist)
+
+    def render(self):
+        '''Updates the artists whose buffer changed since the last render and blits them'''
+        start = time.perf_counter()
+        changed = grown = False
+        for layer in self.layers:
+            artist, buffer, grow, version = layer
+            if buffer.version == version:
+                continue
+            layer[3] = buffer.version
+            offsets, values = buffer.snapshot()
+            artist.set_offsets(offsets)
+            if values is not None:
+                artist.set_array(values)
+            if grow and len(offsets):
+                grown |= grow_limits(artist.axes, offsets)
+            changed = True
+        if not changed:
+            return
+        if grown or self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+        self.canvas.blit(self.fig.bbox)
+        self.canvas.flush_events()
+        self.render_times.append(time.perf_counter() - start)
+
+    def stats(self):
+        '''Median and maximum of the latest redraw times in ms, and the number of full draws'''
+        times = np.array(self.render_times) * 1000
+        if not len(times):
+            return {'median ms': 0.0, 'max ms': 0.0, 'full draws': self.full_draws}
+        return {'median ms': float(np.median(times)), 'max ms': float(times.max()), 'full draws': self.full_draws}
+
+    def stop(self):
+        self.timer.stop()
+
+
+def grow_limits(ax, points):
+    '''Doubles the limits of ax around points if some are outside, returns whether they changed'''
+    low, high = points.min(axis=0), points.max(axis=0)
+    (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+    if x0 <= low[0] and high[0] <= x1 and y0 <= low[1] and high[1] <= y1:
+        return False
+    low = np.minimum(low, (x0, y0))
+    high = np.maximum(high, (x1, y1))
+    center = (low + high) / 2
+    half = np.maximum(high - low, MIN_SPAN)
+    ax.set_xlim(center[0] - half[0], center[0] + half[0])
+    ax.set_ylim(center[1] - half[1], center[1] + half[1])
+    return True
@@ -6,14 +6,22 @@ import plotly.graph_objs as go
 import plotly.express as px
 from scipy.interpolate import griddata
 from scipy.ndimage import gaussian_filter
-from rplidar import RPLidar
-import utm
+from lidar_driver import RPLidarDriver
 import math
-import msvcrt
-# import pyransac3d as pyrsc
+from processing import parse_nmea, parse_fix_quality, georeference_lidar_point
+from pose_estimator import PoseEstimator
+from cloud_io import load_text
+from ground import segment_ground
+from metrics import Metrics, start_reporting
+from obstacles import ObstacleDetector, parse_address
+from streaming import StreamPublisher
+from projection import to_utm
+from config import load_config, write_metadata
+from catalog import choose_session, add_session
 
 GPS_PORT = 'COM4'
 LIDAR_PORT = 'COM3'
+LIDAR_SCAN_MODE = 'express'  # 'standard', 'express' or 'boost', about 2000, 4000 and 8000 samples per second on an A1
 GPS_BAUD_RATE = 57600
 LIDAR_MAX_ANGLE = 45  # Degrees to each side
 SENSOR_HEIGHT = 973  # mm
@@ -23,117 +31,121 @@ MIN_HEIGHT = 0  # mm
 ANGLE_FROM_GPS = 0  # Degrees
 DISTANCE_FROM_GPS = 0  # mm
 LIDAR_ORIENTATION = 0  # Degrees
-
-# def find_floor_plane(data):
-#     plane = pyrsc.Plane()
-#     best_eq, best_inliers = plane.fit(data, thresh=1.7) # 1
-#     return best_eq, best_inliers
+DETECT_OBSTACLES = True  # alerts for the steps, holes and obstacles measured around the rover
+STEP_HEIGHT = 80  # mm between neighbouring 10 cm cells
+OBSTACLE_HEIGHT = 200  # mm above the ground
+HOLE_DEPTH = 200  # mm below the ground
+ALERT_ADDRESS = None  # 'host:port' the alerts are also sent to as JSON datagrams, None for the console only
+STREAM_PORT = None  # port the processed points and the trajectory are streamed on (see streaming.py), None to disable
+STREAM_TRANSPORT = 'tcp'  # 'tcp' or 'udp'
+MAX_FIX_AGE = 1.0  # seconds, measures are not georeferenced from an older fix
+METRICS_PORT = 8765  # None to disable the HTTP endpoint
+METRICS_INTERVAL = 10  # seconds between lines of metrics.jsonl, None to disable
+METRICS_SAMPLING = 4  # one batch of measures in N is timed
+CALIBRATION_FILE = 'calibration.json'  # written by calibrate.py, its constants replace the ones above
+
+# The constants above are defaults, replaced by calibration.json, config.json and TRIC_* variables (see config.py)
+DEFAULTS = {name: value for name, value in globals().items() if name.isupper()}
+CONFIG = load_config('lidar', DEFAULTS)
+globals().update(CONFIG)
 
 class DataRecorder:
     def __init__(self):
         self.gps_ser = serial.Serial(GPS_PORT, GPS_BAUD_RATE, timeout=1)
-        self.lidar = RPLidar(LIDAR_PORT)
+        self.lidar = RPLidarDriver(LIDAR_PORT)
         self.start_time = time.time()
         self.session_folder = f"data_{time.strftime('%Y%m%d_%H%M%S')}"
         os.makedirs(self.session_folder, exist_ok=True)
+        metadata_path = write_metadata(self.session_folder, 'lidar', CONFIG, DEFAULTS)
+        changed = {name: value for name, value in CONFIG.items() if value != DEFAULTS[name]}
+        print(f"Settings saved in {metadata_path}" + (f", changed from the defaults: {changed}" if changed else ""))
         self.gps_file = open(os.path.join(self.session_folder, 'gps_data.txt'), 'w')
         self.lidar_file = open(os.path.join(self.session_folder, 'lidar_data.txt'), 'w')
         self.processed_file = open(os.path.join(self.session_folder, 'processed_data.txt'), 'w')
         self.current_position = None
         self.last_direction = 0
-        self.gps_history = []
+        self.poses = PoseEstimator()
+        self.metrics = Metrics()
+        self.detector = ObstacleDetector(self.alert, parse_address(ALERT_ADDRESS), step_height=STEP_HEIGHT / 1000,
+                                         obstacle_height=OBSTACLE_HEIGHT / 1000,
+                                         hole_depth=HOLE_DEPTH / 1000) if DETECT_OBSTACLES else None
+        self.stream = None
+        if STREAM_PORT is not None:
+            self.stream = StreamPublisher(STREAM_PORT, STREAM_TRANSPORT).start()
+            self.metrics.gauge('stream', self.stream.stats)
+            print(f"Streaming the points over {STREAM_TRANSPORT.upper()} on port {self.stream.port}")
 
     def parse_nmea_data(self, data):
-        data = data.strip().split(',')
-        data_type = data[0][1:]
+        try:
+            data_type, value = parse_nmea(data)
+        except ValueError:
+            return None
 
         if data_type == "GNGGA":
-            try:
-                lat = float(data[2][:2]) + float(data[2][2:]) / 60
-                if data[3] == 'S':
-                    lat = -lat
-                lon = float(data[4][:3]) + float(data[4][3:]) / 60
-                if data[5] == 'W':
-                    lon = -lon
-                return lat, lon
-            except ValueError:
-                return None
+            return value
 
-        elif data_type == "GNRMC" and data[8]:
-            print("Direction changed:", data[8])
-            self.last_direction = float(data[8])
+        elif data_type == "GNRMC" and value is not None:
+            print("Direction changed:", value)
+            self.last_direction = value
 
         return None
 
     def record_gps(self):
-        if self.gps_ser.in_waiting:
+        while self.gps_ser.in_waiting:
             line = self.gps_ser.readline().decode('ascii', errors='ignore')
             parsed_data = self.parse_nmea_data(line)
             if isinstance(parsed_data, tuple) and len(parsed_data) == 2:
                 lat, lon = parsed_data
                 timestamp = time.time() - self.start_time
                 self.current_position = (lat, lon)
-                self.gps_history.append((timestamp, (lat, lon)))
+                self.poses.update_gnss(timestamp, lat, lon, *parse_fix_quality(line))
+                if self.stream:
+                    self.stream.pose(self.start_time + timestamp, *to_utm(lat, lon), self.last_direction)
                 self.gps_file.write(f"{timestamp},{lat},{lon},{self.last_direction}\n")
                 self.gps_file.flush()
 
-                if len(self.gps_history) > 10:
-                    self.gps_history.pop(0)
-
-    def process_lidar_point(self, timestamp, angle, distance):
-        interpolated_position = self.interpolate_position(timestamp)
-        if interpolated_position is None or distance == 0 or self.last_direction is None:
+    def process_lidar_points(self, timestamps, angles, distances):
+        '''(easting, northing, height) arrays of a batch of measures, NaN for the ones without a recent enough
+        position, None if no measure has one'''
+        lat, lon = self.interpolate_positions(timestamps)
+        valid = (distances != 0) & ~np.isnan(lat)
+        if not valid.all():
             print("Invalid data for processing.")
+            self.metrics.count('invalid', int((~valid).sum()))
+        if self.last_direction is None or not valid.any():
             return None
 
-        adjusted_angle = (angle + LIDAR_ORIENTATION) % 360
-
-        # if not (0 <= adjusted_angle <= LIDAR_MAX_ANGLE or 360 - LIDAR_MAX_ANGLE <= adjusted_angle <= 360):
-        #     print("Angle out of range:", adjusted_angle)
-        #     return None
-
-        lat, lon = interpolated_position
-
-        # Calculate elevation and horizontal distance
-        # The elevation difference is the vertical component of the measured distance
-        delta_y = SENSOR_HEIGHT - distance * np.sin(np.deg2rad(SENSOR_TILT)) * np.cos(np.deg2rad(adjusted_angle))
-        d_forward = distance * np.cos(np.deg2rad(SENSOR_TILT))
-        d_lateral = d_forward * np.tan(np.deg2rad(adjusted_angle))
-        # The horizontal distance is the horizontal component of the measured distance
-        x = np.sqrt(d_forward**2 + d_lateral**2)
-
-        easting, northing, _, _ = utm.from_latlon(lat, lon)
-
-        lidar_offset_angle = np.deg2rad(self.last_direction + ANGLE_FROM_GPS)
-        lidar_offset_easting = DISTANCE_FROM_GPS * np.sin(lidar_offset_angle) / 1000
-        lidar_offset_northing = DISTANCE_FROM_GPS * np.cos(lidar_offset_angle) / 1000
-
-        final_angle = np.deg2rad(self.last_direction + ANGLE_FROM_GPS + adjusted_angle)
-        adjusted_easting = easting + lidar_offset_easting + x * np.sin(final_angle) / 1000
-        adjusted_northing = northing + lidar_offset_northing + x * np.cos(final_angle) / 1000
-
-        # print("Adjusted Easting:", adjusted_easting, "Adjusted Northing:", adjusted_northing, "Height:", delta_y)
-
-        return adjusted_easting, adjusted_northing, delta_y
-
-    def interpolate_position(self, timestamp):
-        if len(self.gps_history) < 2:
-            return self.current_position
-
-        for i in range(1, len(self.gps_history)):
-            prev_time, prev_pos = self.gps_history[i-1]
-            curr_time, curr_pos = self.gps_history[i]
-            
-            if prev_time <= timestamp <= curr_time:
-                t = (timestamp - prev_time) / (curr_time - prev_time)
-                lat = prev_pos[0] + t * (curr_pos[0] - prev_pos[0])
-                lon = prev_pos[1] + t * (curr_pos[1] - prev_pos[1])
-                return (lat, lon)
-
-        return self.current_position
+        points = np.full((3, len(timestamps)), np.nan)
+        points[:, valid] = georeference_lidar_point(lat[valid], lon[valid], self.last_direction, angles[valid],
+                                                    distances[valid], SENSOR_HEIGHT, SENSOR_TILT, LIDAR_ORIENTATION,
+                                                    ANGLE_FROM_GPS, DISTANCE_FROM_GPS)
+        return points
+
+    def alert(self, alert):
+        latency = alert.detected - alert.measured
+        self.metrics.record('alert_latency', latency)
+        self.metrics.count(f'{alert.kind}_alerts')
+        print(f"{alert.kind.capitalize()} at {alert.easting:.1f}, {alert.northing:.1f}: height {alert.height * 1000:.0f} mm, "
+              f"{alert.difference * 1000:.0f} mm from its neighbours, {latency * 1000:.1f} ms after its measure")
+
+    def interpolate_positions(self, timestamps):
+        # Extrapolated along the filtered velocity instead of holding the last fix, NaN once the fix is too old.
+        # A batch spans milliseconds, the positions are interpolated between the poses at its ends.
+        stale = np.broadcast_to(self.poses.fix_age(timestamps) > MAX_FIX_AGE, timestamps.shape)
+        if stale.any():
+            self.metrics.count('stale', int(stale.sum()))
+        if stale.all():
+            return np.full(len(timestamps), np.nan), np.full(len(timestamps), np.nan)
+        first, last = self.poses.latlon_at(timestamps[0]), self.poses.latlon_at(timestamps[-1])
+        span = (timestamps - timestamps[0]) / max(timestamps[-1] - timestamps[0], 1e-9)
+        lat = first[0] + span * (last[0] - first[0])
+        lon = first[1] + span * (last[1] - first[1])
+        lat[stale], lon[stale] = np.nan, np.nan
+        return lat, lon
 
     def close(self):
         print("Closing connections and files...")
+        self.stop_reporting()
         self.gps_ser.close()
         self.lidar.stop()
         self.lidar.stop_motor()
@@ -141,30 +153,68 @@ class DataRecorder:
         self.gps_file.close()
         self.lidar_file.close()
         self.processed_file.close()
+        if self.detector:
+            self.detector.close()
+        if self.stream:
+            self.stream.close()
         print("All connections and files closed.")
+        for name, summary in self.metrics.snapshot()['stages'].items():
+            print(f"{name}: {summary}")
 
     def record_data(self):
+        self.stop_reporting = start_reporting(self.metrics, self.session_folder, METRICS_PORT, METRICS_INTERVAL)
+        acquire = self.metrics.histogram('acquire')
         try:
             print("Recording data... Press Ctrl+C to stop.")
-            for measurement in self.lidar.iter_measures():
-                self.record_gps()
-                timestamp = time.time() - self.start_time
-                
-                new_scan, quality, angle, distance = measurement
+            batches = 0
+            acquire_start = time.perf_counter()
+            for batch in self.lidar.iter_batches(LIDAR_SCAN_MODE):
+                sample = batches % METRICS_SAMPLING == 0
+                if sample:
+                    acquire.record(time.perf_counter() - acquire_start)
+                batches += 1
+                self.metrics.count('measures', len(batch))
+                with self.metrics.stage('gps', sample):
+                    self.record_gps()
+                timestamps = batch['timestamp'] - self.start_time
+                angles, distances = batch['angle'], batch['distance']
                 
-                adjusted_angle = (angle + LIDAR_ORIENTATION) % 360
-                # print(adjusted_angle)
+                adjusted_angles = (angles + LIDAR_ORIENTATION) % 360
                 
                 # change depending on opinion
-                if quality == 15 and distance > MIN_DISTANCE and (0 <= adjusted_angle <= LIDAR_MAX_ANGLE or 360 - LIDAR_MAX_ANGLE <= adjusted_angle <= 360):
-                    self.lidar_file.write(f"{timestamp},{new_scan},{quality},{adjusted_angle},{distance}\n")
-                    self.lidar_file.flush()
-                    processed_point = self.process_lidar_point(timestamp, angle, distance)
-                    if processed_point and processed_point[2] >= MIN_HEIGHT:
-                        self.processed_file.write(f"{processed_point[0]},{processed_point[1]},{processed_point[2]}\n")
-                        self.processed_file.flush()
-                        if 0 <= adjusted_angle <= 2 or 360 - 2 <= adjusted_angle <= 360:
-                            print("Height:", processed_point[2], "Angle:", adjusted_angle)
+                keep = ((batch['quality'] == 15) & (distances > MIN_DISTANCE)
+                        & ((adjusted_angles <= LIDAR_MAX_ANGLE) | (adjusted_angles >= 360 - LIDAR_MAX_ANGLE)))
+                self.metrics.count('filtered', int(len(batch) - keep.sum()))
+                if keep.any():
+                    timestamps, angles, distances = timestamps[keep], angles[keep], distances[keep]
+                    adjusted_angles = adjusted_angles[keep]
+                    with self.metrics.stage('write_raw', sample):
+                        self.lidar_file.write(''.join(
+                            f"{t},{n},{q},{a},{d}\n" for t, n, q, a, d in zip(
+                                timestamps.tolist(), batch['new_scan'][keep].tolist(), batch['quality'][keep].tolist(),
+                                adjusted_angles.tolist(), distances.tolist())))
+                        self.lidar_file.flush()
+                    with self.metrics.stage('georeference', sample):
+                        processed_points = self.process_lidar_points(timestamps, angles, distances)
+                    if processed_points is not None and self.detector:
+                        with self.metrics.stage('detect', sample):
+                            self.detector.update(processed_points[0], processed_points[1], processed_points[2] / 1000,
+                                                 timestamps + self.start_time)
+                    if processed_points is not None:
+                        high = processed_points[2] >= MIN_HEIGHT
+                        with self.metrics.stage('write', sample):
+                            self.processed_file.write(''.join(
+                                f"{x},{y},{z}\n" for x, y, z in zip(*(c[high].tolist() for c in processed_points))))
+                            self.processed_file.flush()
+                        self.metrics.count('points', int(high.sum()))
+                        if self.stream:
+                            with self.metrics.stage('stream', sample):
+                                self.stream.points(self.start_time + timestamps[-1], np.column_stack(
+                                    [processed_points[0][high], processed_points[1][high], processed_points[2][high] / 1000]))
+                        ahead = np.flatnonzero(high & ((adjusted_angles <= 2) | (adjusted_angles >= 360 - 2)))
+                        if len(ahead):
+                            print("Height:", processed_points[2][ahead[-1]], "Angle:", adjusted_angles[ahead[-1]])
+                acquire_start = time.perf_counter()
 
         except KeyboardInterrupt:
             print("Stopping data recording...")
@@ -174,7 +224,7 @@ class DataRecorder:
 def plot_data(data_folder):
     print("Plotting data...")
     try:
-        processed_data = np.loadtxt(os.path.join(data_folder, 'processed_data.txt'), delimiter=',')
+        processed_data = load_text(os.path.join(data_folder, 'processed_data.txt'))
 
         if processed_data.size == 0 or processed_data.ndim == 1:
             print("Insufficient data for plotting.")
@@ -182,9 +232,10 @@ def plot_data(data_folder):
 
         x, y, z = processed_data[:, 0], processed_data[:, 1], processed_data[:, 2]
 
-        # # # Find floor plane
-        # floor_eq, floor_inliers = find_floor_plane(processed_data)
-        # print("Floor plane equation (Ax + By + Cz + D = 0):", floor_eq)
+        # Relative to the first point, UTM coordinates are too large for a precise plane fit, heights are in mm
+        floor_eq, floor_inliers = segment_ground(np.column_stack([x - x[0], y - y[0], z / 1000]))
+        if floor_eq is not None:
+            print(f"Floor plane equation (Ax + By + Cz + D = 0): {np.round(floor_eq, 4)}, {floor_inliers.mean():.0%} of the points")
 
         x_rel = x - np.min(x)
         y_rel = y - np.min(y)
@@ -274,6 +325,7 @@ def main():
     if key == 'R':
         recorder = DataRecorder()
         recorder.record_data()
+        add_session(recorder.session_folder)
         
         if os.path.getsize(os.path.join(recorder.session_folder, 'processed_data.txt')) > 0:
             plot_data(recorder.session_folder)
@@ -281,8 +333,8 @@ def main():
             print("No data was recorded. Unable to generate plots.")
 
     elif key == 'P':
-        folder = input("Enter the path to the data folder: ")
-        if os.path.exists(folder):
+        folder = choose_session(profile='lidar')
+        if folder:
             plot_data(folder)
         else:
             print("Invalid folder path.")
@@ -0,0 +1,246 @@
+'''Per-stage latency histograms, counters and gauges for the recorders, served as JSON over HTTP or dumped periodically
+
+    curl http://localhost:8765/metrics
+'''
+import os
+import json
+import math
+import time
+import threading
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SUB_BUCKETS = 32  # per power of two, about 3% relative precision
+LOWEST = 1e-6  # seconds
+HIGHEST = 3600  # seconds
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    '''HDR-style log-linear histogram of durations in seconds, recording is O(1) and allocation free'''
+    def __init__(self, lowest=LOWEST, highest=HIGHEST):
+        self.lowest = lowest
+        self.magnitudes = int(math.ceil(math.log2(highest / lowest))) + 1
+        self.counts = [0] * (self.magnitudes * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, value):
+        ratio = value / self.lowest
+        if ratio < 1:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(ratio)
+            index = min((exponent - 1) * SUB_BUCKETS + int((mantissa * 2 - 1) * SUB_BUCKETS), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def bucket_value(self, index):
+        exponent, sub_bucket = divmod(index, SUB_BUCKETS)
+        return self.lowest * 2 ** exponent * (1 + (sub_bucket + 0.5) / SUB_BUCKETS)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        target = max(math.ceil(p / 100 * self.count), 1)
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(max(self.bucket_value(index), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        summary = {'count': self.count, 'mean_ms': round(self.total / self.count * 1000, 3),
+                   'min_ms': round(self.min * 1000, 3), 'max_ms': round(self.max * 1000, 3)}
+        for p in PERCENTILES:
+            summary[f"p{p:g}_ms"] = round(self.percentile(p) * 1000, 3)
+        return summary
+
+
+class Stage:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.record(time.perf_counter() - self.start)
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Baseline:
+    '''Time, CPU time and counters a reporter's next rates and CPU percentage are measured from'''
+    def __init__(self, counters=None):
+        self.update(dict(counters or {}))
+
+    def update(self, counters):
+        self.time, self.cpu, self.counters = time.perf_counter(), sum(os.times()[:2]), counters
+
+
+class Metrics:
+    '''Registry of stage histograms, counters and gauges. Each stage should be recorded from a single thread.'''
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.start_time = time.time()
+        self.start = Baseline()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, LatencyHistogram())
+        return histogram
+
+    def stage(self, name, sample=True):
+        '''Times a with block, not when sample is false so per-measure loops can time one iteration in N'''
+        return Stage(self.histogram(name)) if sample else NULL_STAGE
+
+    def record(self, name, seconds):
+        # NumPy scalars would leak into the summaries, and their repr into the logs
+        self.histogram(name).record(float(seconds))
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        '''Sets a gauge, value may be a callable sampled at snapshot time (e.g. queue.qsize)'''
+        self.gauges[name] = value
+
+    def baseline(self):
+        '''Baseline of a reporter taking periodic snapshots, from now'''
+        return Baseline(self.counters)
+
+    def snapshot(self, baseline=None):
+        '''Current state, rates and CPU since baseline, which is moved to now, or since the start without one'''
+        now, cpu = time.perf_counter(), sum(os.times()[:2])
+        last = baseline or self.start
+        interval = max(now - last.time, 1e-9)
+        last_cpu, last_counters = last.cpu, last.counters
+        counters = dict(self.counters)
+        if baseline:
+            baseline.update(counters)
+        gauges = {}
+        for name, value in list(self.gauges.items()):
+            try:
+                gauges[name] = value() if callable(value) else value
+            except Exception as e:
+                gauges[name] = str(e)
+        return {
+            'time': round(time.time(), 3),
+            'uptime': round(time.time() - self.start_time, 3),
+            'cpu_percent': round((cpu - last_cpu) / interval * 100, 1),
+            'stages': {name: histogram.summary() for name, histogram in list(self.histograms.items())},
+            'counters': counters,
+            'rates': {name: round((value - last_counters.get(name, 0)) / interval, 2) for name, value in counters.items()},
+            'gauges': gauges,
+        }
+
+
+class MetricsServer:
+    '''Serves the current snapshot as JSON on http://host:port/metrics, rates averaged since the start. A poll has no
+    side effect on the other reporters.'''
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+        registry = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(registry.snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        logging.info(f"Metrics available on http://{self.server.server_address[0]}:{self.port}/metrics")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsDumper:
+    '''Appends one compact JSON snapshot per interval to a file'''
+    def __init__(self, metrics, path, interval):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        # Its own baseline, the rates of each line cover the interval since the previous one whoever else polls
+        baseline = self.metrics.baseline()
+        with open(self.path, 'a') as f:
+            while not self.stop_event.wait(self.interval):
+                f.write(json.dumps(self.metrics.snapshot(baseline), separators=(',', ':')) + '\n')
+                f.flush()
+            f.write(json.dumps(self.metrics.snapshot(baseline), separators=(',', ':')) + '\n')
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+def start_reporting(metrics, session_folder, port=None, interval=None):
+    '''Starts the HTTP endpoint and/or the periodic dump, returns a function stopping both'''
+    reporters = []
+    if port is not None:
+        try:
+            server = MetricsServer(metrics, port)
+            server.start()
+            reporters.append(server)
+        except OSError as e:
+            logging.warning(f"Unable to serve metrics on port {port}: {str(e)}")
+    if interval:
+        dumper = MetricsDumper(metrics, os.path.join(session_folder, 'metrics.jsonl'), interval)
+        dumper.start()
+        reporters.append(dumper)
+
+    def stop():
+        for reporter in reporters:
+            reporter.stop()
+    return stop
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+'''Merges N captures into one tiled cloud in a shared UTM frame
+
+    python mosaic.py data/data_20240716_171504 data/data_20240716_173012 --refine
+    python mosaic.py scan1.txt+gps1.txt scan2.txt+gps2.txt --max-height 0.4 --output mosaic
+
+A capture is a session folder or a cloud file already in UTM (x, y, z, optionally after a timestamp), or a cloud
+relative to the GPS antenna (x right, y forward, z up) followed by '+' and its lat,lon,heading file.
+Captures are placed in parallel, optionally registered onto the overlapping captures placed before them, and cut into
+tiles on disk. Every tile is then deduplicated on a voxel grid on its own, so memory is bounded by one capture per
+worker while placing and by one tile per worker while merging. The tiles are written as processed_data/*.bin, which
+plot.py reads as it is.'''
+import os
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+
+from cloud_io import load_cloud, load_gps, map_bin, first_point
+from processing import save_bin_data
+from projection import Projection
+from registration import voxel_filter, register, is_plausible, transform_points, pose_matrix
+from pool import default_workers
+
+TILE_SIZE = 20  # meters
+VOXEL_SIZE = 0.05  # meters, points of every capture falling in the same voxel are merged into their centroid
+REFINE_VOXEL_SIZE = 0.1  # meters, resolution of the clouds kept in memory for the refinement
+NEIGHBOR_MARGIN = 1.0  # meters, added to the capture bounds when looking for overlapping captures
+MAX_CORRECTION = 1.0  # meters, fixes of separate captures disagree more than those of consecutive frames
+
+
+def parse_capture(argument):
+    '''(cloud path, GPS path or None) of a command line capture'''
+    cloud_path, _, gps_path = argument.partition('+')
+    if os.path.isdir(cloud_path):
+        for name in ('processed_data.bin', 'processed_data', 'processed_data.txt'):
+            if os.path.exists(os.path.join(cloud_path, name)):
+                cloud_path = os.path.join(cloud_path, name)
+                break
+        else:
+            raise ValueError(f"{argument} contains no processed_data.bin, processed_data folder or processed_data.txt")
+    return cloud_path, gps_path or None
+
+
+def read_points(cloud_path, origin, northing_first=False):
+    '''Points of a capture in float64, relative to origin'''
+    if northing_first:
+        origin = origin[[1, 0, 2]]
+    if os.path.isdir(cloud_path):
+        parts = [np.asarray(map_bin(os.path.join(cloud_path, f))) - origin
+                 for f in sorted(os.listdir(cloud_path)) if f.endswith('.bin')]
+        points = np.vstack(parts) if parts else np.empty((0, 3))
+    else:
+        points = load_cloud(cloud_path, np.float64, origin)[0]
+    if northing_first:
+        points = points[:, [1, 0, 2]]
+    return points
+
+
+def gps_pose(gps_path, projection, origin):
+    '''4x4 transform from the antenna frame to the shared frame, heading clockwise from north'''
+    lat, lon, heading = load_gps(gps_path)[0][:3]
+    easting, northing = projection.forward(lat, lon)
+    return pose_matrix(easting - origin[0], northing - origin[1], 0, -heading)
+
+
+def shared_frame(captures, northing_first=False):
+    '''(projection or None, origin) of the mosaic, from the first GPS fix or else the first point of the first cloud'''
+    for _, gps_path in captures:
+        if gps_path:
+            lat, lon = load_gps(gps_path)[0][:2]
+            projection = Projection(lat, lon)
+            easting, northing = projection.forward(lat, lon)
+            return projection, np.array([np.floor(easting), np.floor(northing), 0.0])
+    cloud_path = captures[0][0]
+    if os.path.isdir(cloud_path):
+        cloud_path = os.path.join(cloud_path, sorted(f for f in os.listdir(cloud_path) if f.endswith('.bin'))[0])
+    point = first_point(cloud_path)
+    if northing_first:
+        point = point[[1, 0, 2]]
+    return None, np.array([np.floor(point[0]), np.floor(point[1]), 0.0])
+
+
+def place(capture, projection, origin, max_height=None, northing_first=False, correction=None):
+    '''Points of a capture in the shared frame, relative to origin'''
+    cloud_path, gps_path = capture
+    if gps_path:
+        points = read_points(cloud_path, np.zeros(3), northing_first)
+    else:
+        points = read_points(cloud_path, origin, northing_first)
+    if max_height is not None:
+        points = points[points[:, 2] <= max_height]
+    if gps_path:
+        points = transform_points(points, gps_pose(gps_path, projection, origin))
+    if correction is not None:
+        points = transform_points(points, correction)
+    return points
+
+
+def place_coarse(args):
+    '''Refinement cloud and (min, max) bounds of a placed capture'''
+    points = place(*args)
+    if not len(points):
+        return np.empty((0, 3)), None
+    return voxel_filter(points, REFINE_VOXEL_SIZE), (points.min(axis=0), points.max(axis=0))
+
+
+def overlaps(a, b, margin=NEIGHBOR_MARGIN):
+    return a is not None and b is not None and np.all(a[0][:2] - margin <= b[1][:2]) and np.all(b[0][:2] - margin <= a[1][:2])
+
+
+def refine(clouds, bounds, max_correction=MAX_CORRECTION):
+    '''Corrections registering every capture onto the overlapping captures before it, as (transform, rmse, fitness)'''
+    results = []
+    corrected = []
+    for i, (cloud, box) in enumerate(zip(clouds, bounds)):
+        correction, rmse, fitness = np.eye(4), np.inf, 0.0
+        neighbors = [j for j in range(i) if overlaps(box, bounds[j])]
+        # Only the part over the neighbors is registered, the fitness then measures the fit rather than the overlap
+        inside = np.zeros(len(cloud), dtype=bool)
+        for j in neighbors:
+            inside |= np.all((cloud[:, :2] >= bounds[j][0][:2] - NEIGHBOR_MARGIN) &
+                             (cloud[:, :2] <= bounds[j][1][:2] + NEIGHBOR_MARGIN), axis=1)
+        if inside.any():
+            # Centered on the overlap, rotations are estimated about its middle rather than the mosaic origin
+            source = cloud[inside]
+            center = np.array([*source[:, :2].mean(axis=0), 0.0])
+            transform, rmse, fitness = register(source - center, np.vstack([corrected[j] for j in neighbors]) - center)
+            if is_plausible(transform, fitness, max_correction):
+                correction = pose_matrix(*center) @ transform @ pose_matrix(*-center)
+        corrected.append(transform_points(cloud, correction))
+        results.append((correction, rmse, fitness))
+    return results
+
+
+def tile_capture(args):
+    '''Cuts a placed capture into tiles and saves each piece voxel filtered, returns the names of its tiles'''
+    index, capture, projection, origin, max_height, northing_first, correction, fragments_folder = args
+    points = place(capture, projection, origin, max_height, northing_first, correction)
+    tiles = np.floor((points[:, :2] + origin[:2]) / TILE_SIZE).astype(np.int64)
+    names = []
+    for tile in np.unique(tiles, axis=0):
+        name = f"tile_{tile[0] * TILE_SIZE}_{tile[1] * TILE_SIZE}"
+        folder = os.path.join(fragments_folder, name)
+        os.makedirs(folder, exist_ok=True)
+        piece = points[np.all(tiles == tile, axis=1)]
+        np.save(os.path.join(folder, f"{index}.npy"), voxel_filter(piece, VOXEL_SIZE).astype(np.float32))
+        names.append(name)
+    return names
+
+
+def merge_tile(args):
+    '''Deduplicates the pieces of one tile and writes it in UTM, returns (name, point count)'''
+    name, fragments_folder, tiles_folder, origin = args
+    folder = os.path.join(fragments_folder, name)
+    pieces = [np.load(os.path.join(folder, f)) for f in sorted(os.listdir(folder))]
+    points = voxel_filter(np.vstack(pieces).astype(np.float64), VOXEL_SIZE)
+    save_bin_data(os.path.join(tiles_folder, f"{name}.bin"), points + origin)
+    return name, len(points)
+
+
+def build_mosaic(captures, output, refine_placement=False, max_height=None, northing_first=False,
+                 max_correction=MAX_CORRECTION, workers=None):
+    '''Writes the tiles of the captures in output/processed_data, returns [(tile name, point count)]'''
+    projection, origin = shared_frame(captures, northing_first)
+    corrections = [None] * len(captures)
+    with multiprocessing.Pool(workers or default_workers()) as pool:
+        if refine_placement:
+            placed = pool.map(place_coarse, [(capture, projection, origin, max_height, northing_first)
+                                             for capture in captures])
+            results = refine([cloud for cloud, _ in placed], [box for _, box in placed], max_correction)
+            corrections = [correction for correction, _, _ in results]
+            with open(os.path.join(output, 'corrections.txt'), 'w') as f:
+                for (cloud_path, _), (correction, rmse, fitness) in zip(captures, results):
+                    f.write(f"{cloud_path},{fitness:.3f},{rmse:.5f}," + ','.join(f"{v:.6f}" for v in correction[:3].ravel()) + "\n")
+
+        fragments_folder = os.path.join(output, 'fragments')
+        tiles_folder = os.path.join(output, 'processed_data')
+        os.makedirs(tiles_folder, exist_ok=True)
+        try:
+            names = set()
+            for capture_names in pool.imap_unordered(tile_capture, [
+                    (i, capture, projection, origin, max_height, northing_first, corrections[i], fragments_folder)
+                    for i, capture in enumerate(captures)]):
+                names.update(capture_names)
+            tiles = sorted(pool.imap_unordered(merge_tile, [(name, fragments_folder, tiles_folder, origin)
+                                                            for name in names]))
+        finally:
+            shutil.rmtree(fragments_folder, ignore_errors=True)
+
+    with open(os.path.join(output, 'tiles.txt'), 'w') as f:
+        for name, count in tiles:
+            easting, northing = name.split('_')[1:]
+            f.write(f"{name},{easting},{northing},{TILE_SIZE},{count}\n")
+    return tiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge captures into one tiled cloud in a shared UTM frame")
+    parser.add_argument('captures', nargs='+', help="session folder, UTM cloud file, or cloud+gps files")
+    parser.add_argument('--output', default='mosaic')
+    parser.add_argument('--refine', action='store_true', help="register every capture onto the overlapping ones")
+    parser.add_argument('--max-height', type=float, help="meters, higher points are dropped")
+    parser.add_argument('--northing-first', action='store_true', help="cloud columns are northing, easting, height")
+    parser.add_argument('--max-correction', type=float, default=MAX_CORRECTION, help="meters")
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    captures = [parse_capture(argument) for argument in args.captures]
+    os.makedirs(args.output, exist_ok=True)
+    tiles = build_mosaic(captures, args.output, args.refine, args.max_height, args.northing_first,
+                         args.max_correction, args.workers)
+    print(f"{len(captures)} captures merged into {len(tiles)} tiles, {sum(count for _, count in tiles)} points, "
+          f"in {os.path.join(args.output, 'processed_data')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+'''Online detection of steps, holes and obstacles around the rover, from the points as they are georeferenced
+
+The heights are kept in a rolling grid of cells around the rover, indexed modulo its size: a cell of the world lands
+on a fixed slot of the grid, which is reset when another cell of the world (the rover moved on) or an old measure
+is found there, so the grid never has to be shifted. Each batch of points updates the mean height of its cells, then
+only those cells are checked, against the thresholds and against their eight neighbours. The cost of a batch does not
+depend on the grid size or on the length of the session.
+
+Alerts are Alert tuples passed to the callbacks and sent as JSON datagrams to an optional UDP address, with the time
+of the newest measure of their cell so the end-to-end latency can be measured against the time they are emitted.
+
+    detector = ObstacleDetector(callback=print, address=('127.0.0.1', 8766))
+    detector.update(easting, northing, height, timestamps)  # meters, time.time() seconds
+'''
+import json
+import time
+import socket
+import logging
+import collections
+import numpy as np
+
+GRID_SIZE = 128  # cells per side of the rolling grid, 12.8 m at the default cell size
+CELL_SIZE = 0.1  # meters
+STEP_HEIGHT = 0.08  # meters between the mean heights of neighbouring cells
+OBSTACLE_HEIGHT = 0.2  # meters above the ground
+HOLE_DEPTH = 0.2  # meters below the ground
+MIN_POINTS = 3  # measures in a cell before it is checked, so a single outlier does not raise an alert
+MAX_CELL_AGE = 2.0  # seconds, older cells are reset before their next measure
+ALERT_COOLDOWN = 1.0  # seconds before a cell raises the same alert again
+
+OBSTACLE = 'obstacle'
+HOLE = 'hole'
+STEP = 'step'
+KINDS = (OBSTACLE, HOLE, STEP)
+
+NEIGHBOURS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+Alert = collections.namedtuple('Alert', ['kind', 'easting', 'northing', 'height', 'difference', 'measured',
+                                         'detected'])
+
+
+def parse_address(address):
+    '''(host, port) of a 'host:port' string, None for None or an empty string'''
+    if not address:
+        return None
+    host, _, port = str(address).rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class ObstacleDetector:
+    '''Rolling height grid updated by batches of points, raising alerts for the cells above the thresholds'''
+    def __init__(self, callback=None, address=None, grid_size=GRID_SIZE, cell_size=CELL_SIZE, step_height=STEP_HEIGHT,
+                 obstacle_height=OBSTACLE_HEIGHT, hole_depth=HOLE_DEPTH, min_points=MIN_POINTS,
+                 max_cell_age=MAX_CELL_AGE, cooldown=ALERT_COOLDOWN):
+        self.callbacks = [callback] if callback else []
+        self.address = address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if address else None
+        self.grid_size = grid_size
+        self.cell_size = cell_size
+        self.step_height = step_height
+        self.obstacle_height = obstacle_height
+        self.hole_depth = hole_depth
+        self.min_points = min_points
+        self.max_cell_age = max_cell_age
+        self.cooldown = cooldown
+        cells = grid_size * grid_size
+        # World cell of each slot, its sum of heights, measures, newest measure and last alert
+        self.keys = np.full((cells, 2), np.iinfo(np.int64).min, dtype=np.int64)
+        self.sums = np.zeros(cells)
+        self.counts = np.zeros(cells, dtype=np.int64)
+        self.times = np.full(cells, -np.inf)
+        self.alerted = np.full(cells, -np.inf)
+        self.alerts = {kind: 0 for kind in KINDS}
+
+    def slots(self, cx, cy):
+        return (cy % self.grid_size) * self.grid_size + cx % self.grid_size
+
+    def update(self, easting, northing, height, timestamps):
+        '''Adds a batch of points (arrays in meters, NaN skipped) measured at timestamps (time.time() seconds, one per
+        point or one for all), returns the alerts raised'''
+        easting, northing, height = (np.asarray(values, dtype=np.float64).ravel() for values in (easting, northing, height))
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), height.shape)
+        valid = ~(np.isnan(easting) | np.isnan(northing) | np.isnan(height))
+        if not valid.all():
+            easting, northing, height, timestamps = easting[valid], northing[valid], height[valid], timestamps[valid]
+        if not len(height):
+            return []
+
+        cx = np.floor(easting / self.cell_size).astype(np.int64)
+        cy = np.floor(northing / self.cell_size).astype(np.int64)
+        slots = self.slots(cx, cy)
+        now = timestamps.max()
+        reset = ((self.keys[slots, 0] != cx) | (self.keys[slots, 1] != cy)
+                 | (self.times[slots] < now - self.max_cell_age))
+        if reset.any():
+            stale = slots[reset]
+            self.keys[stale, 0], self.keys[stale, 1] = cx[reset], cy[reset]
+            self.sums[stale] = 0
+            self.counts[stale] = 0
+            self.times[stale] = -np.inf
+            self.alerted[stale] = -np.inf
+        np.add.at(self.sums, slots, height)
+        np.add.at(self.counts, slots, 1)
+        np.maximum.at(self.times, slots, timestamps)
+
+        touched, first = np.unique(slots, return_index=True)
+        ready = (self.counts[touched] >= self.min_points) & (self.times[touched] - self.alerted[touched] >= self.cooldown)
+        if not ready.any():
+            return []
+        touched, cx, cy = touched[ready], cx[first[ready]], cy[first[ready]]
+        return self.check(touched, cx, cy, now)
+
+    def check(self, touched, cx, cy, now):
+        means = self.sums[touched] / self.counts[touched]
+        difference = np.zeros(len(touched))
+        for dx, dy in NEIGHBOURS:
+            neighbours = self.slots(cx + dx, cy + dy)
+            known = ((self.keys[neighbours, 0] == cx + dx) & (self.keys[neighbours, 1] == cy + dy)
+                     & (self.counts[neighbours] >= self.min_points)
+                     & (self.times[neighbours] >= now - self.max_cell_age))
+            gap = np.abs(means - self.sums[neighbours] / np.maximum(self.counts[neighbours], 1))
+            difference = np.maximum(difference, np.where(known, gap, 0))
+
+        kinds = np.select([means > self.obstacle_height, means < -self.hole_depth, difference > self.step_height],
+                          [0, 1, 2], -1)
+        raised = np.flatnonzero(kinds >= 0)
+        if not len(raised):
+            return []
+        detected = time.time()
+        self.alerted[touched[raised]] = now
+        alerts = [Alert(KINDS[kind], (x + 0.5) * self.cell_size, (y + 0.5) * self.cell_size, height, gap, measured,
+                        detected)
+                  for kind, x, y, height, gap, measured in zip(
+                      kinds[raised].tolist(), cx[raised].tolist(), cy[raised].tolist(), means[raised].tolist(),
+                      difference[raised].tolist(), self.times[touched[raised]].tolist())]
+        for alert in alerts:
+            self.emit(alert)
+        return alerts
+
+    def emit(self, alert):
+        self.alerts[alert.kind] += 1
+        for callback in self.callbacks:
+            callback(alert)
+        if self.socket:
+            try:
+                self.socket.sendto(json.dumps(alert._asdict()).encode('utf-8'), self.address)
+            except OSError as e:
+                logging.warning(f"Alert not sent to {self.address}: {e}")
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
@@ -3,41 +3,55 @@ import numpy as np
 import plotly.graph_objs as go
 from scipy.interpolate import griddata
 from scipy.spatial import Delaunay
-from plyfile import PlyData, PlyElement
+from cloud_io import map_bin, map_bin_colors
 
 MAX_ELEVATION = 0.5
 MIN_ELEVATION = -0.05
 DOWNSAMPLE_FACTOR = 100  # 1 for no downsampling
 Z_SCALE_FACTOR = 0.05  # 1 for big
+HEX_BYTES = np.array([f'{i:02x}' for i in range(256)])  # two hex digits of every byte value
 
 def load_data(data_path):
+    '''(points, uint8 RGB colors or None if some of the files have none)'''
     bin_file = os.path.join(data_path, 'processed_data.bin')
     folder = os.path.join(data_path, 'processed_data')
     
     if os.path.isfile(bin_file):
-        processed_data = load_bin_data(bin_file)
+        all_files = [bin_file]
     elif os.path.isdir(folder):
         all_files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.bin')]
-        processed_data = []
-        for file in all_files:
-            data = load_bin_data(file)
-            processed_data.append(data)
-        processed_data = np.vstack(processed_data)
     else:
         raise ValueError("Provided path does not contain 'processed_data.bin' or 'processed_data' folder.")
+    processed_data = np.vstack([map_bin(file) for file in all_files])
+    colors = [map_bin_colors(file) for file in all_files]
+    colors = None if any(c is None for c in colors) else np.vstack(colors)
     
-    return processed_data
-
-def load_bin_data(file_path):
-    with open(file_path, 'rb') as f:
-        num_points = np.fromfile(f, dtype=np.uint32, count=1)[0]
-        data = np.fromfile(f, dtype=np.float64, count=num_points * 3).reshape((num_points, 3))
-    return data
-
-def save_as_ply(file_path, x, y, z):
-    vertices = np.array([x, y, z], dtype=np.float32).T
-    vertices = [tuple(vertex) for vertex in vertices]
-    vertex_elements = np.array(vertices, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
+    return processed_data, colors
+
+def css_colors(colors):
+    '''CSS '#rrggbb' strings of uint8 RGB rows, formatted in bulk instead of one Python string per point'''
+    colors = np.asarray(colors, dtype=np.uint8)
+    red, green, blue = (HEX_BYTES[colors[:, channel]] for channel in range(3))
+    return np.char.add(np.char.add(np.char.add('#', red), green), blue)
+
+def point_marker(z, colors, size, colorscale, title):
+    '''Markers in the points' own colors when they have some, by elevation otherwise'''
+    if colors is not None:
+        return dict(size=size, color=css_colors(colors), opacity=1)
+    return dict(size=size, color=z, colorscale=colorscale, opacity=1, colorbar=dict(title=title))
+
+def save_as_ply(file_path, x, y, z, colors=None):
+    '''Triangulated surface of the points, with colors as red, green and blue uint8 vertex properties'''
+    # Imported here, the recorders use the plots without writing PLY files
+    from plyfile import PlyData, PlyElement
+
+    properties = [('x', 'f4'), ('y', 'f4'), ('z', 'f4')]
+    if colors is not None:
+        properties += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertex_elements = np.empty(len(x), dtype=properties)
+    vertex_elements['x'], vertex_elements['y'], vertex_elements['z'] = x, y, z
+    if colors is not None:
+        vertex_elements['red'], vertex_elements['green'], vertex_elements['blue'] = np.asarray(colors, dtype=np.uint8).T
 
     points2D = np.vstack([x, y]).T
     tri = Delaunay(points2D)
@@ -52,16 +66,19 @@ def save_as_ply(file_path, x, y, z):
 def plot_data(data_folder, max_elevation, min_elevation, downsample_factor):
     print("Plotting data...")
     try:
-        processed_data = load_data(data_folder)
+        processed_data, colors = load_data(data_folder)
 
         if processed_data.size == 0 or processed_data.ndim == 1:
             print("Insufficient data for plotting.")
             return
 
-        processed_data = processed_data[(processed_data[:, 2] >= min_elevation) & (processed_data[:, 2] <= max_elevation)]
+        within = (processed_data[:, 2] >= min_elevation) & (processed_data[:, 2] <= max_elevation)
+        processed_data = processed_data[within]
+        colors = colors[within] if colors is not None else None
 
         if downsample_factor > 1:
             processed_data = processed_data[::downsample_factor]
+            colors = colors[::downsample_factor] if colors is not None else None
 
         x, y, z = processed_data[:, 0], processed_data[:, 1], processed_data[:, 2]
 
@@ -83,13 +100,7 @@ def plot_data(data_folder, max_elevation, min_elevation, downsample_factor):
             y=y_rel,
             z=z,
             mode='markers',
-            marker=dict(
-                size=2,
-                color=z,
-                colorscale='Balance',
-                opacity=1,
-                colorbar=dict(title='Elevation (m)')
-            ),
+            marker=point_marker(z, colors, 2, 'Balance', 'Elevation (m)'),
             name='All Points'
         ))
 
@@ -113,13 +124,7 @@ def plot_data(data_folder, max_elevation, min_elevation, downsample_factor):
             x=x_rel,
             y=y_rel,
             mode='markers',
-            marker=dict(
-                size=2,
-                color=z,
-                colorscale='Balance',
-                opacity=1,
-                colorbar=dict(title='Elevation (mm)')
-            )
+            marker=point_marker(z, colors, 2, 'Balance', 'Elevation (mm)')
         )])
         fig_2d.update_layout(
             xaxis_title='Relative Easting (m)',
@@ -129,7 +134,7 @@ def plot_data(data_folder, max_elevation, min_elevation, downsample_factor):
         )
         fig_2d.write_html(os.path.join(data_folder, '2d_scatter_plot.html'))
 
-        save_as_ply(os.path.join(data_folder, 'point_cloud.ply'), x_rel, y_rel, z)
+        save_as_ply(os.path.join(data_folder, 'point_cloud.ply'), x_rel, y_rel, z, colors)
 
         print(f"Plots and 3D file saved in {data_folder}")
     except Exception as e:
@@ -0,0 +1,135 @@
+'''Process pool running a point cloud function on frames handed over through shared memory, results in submission order'''
+import os
+import time
+import queue
+import heapq
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+SLOTS_PER_WORKER = 2
+SLOT_BYTES = 3 * 8 + 3  # per point, float64 coordinates then uint8 RGB colors
+
+
+def slot_arrays(buffer, capacity, count):
+    '''(points, colors) views of the first count points of a slot'''
+    return (np.ndarray((count, 3), dtype=np.float64, buffer=buffer.buf),
+            np.ndarray((count, 3), dtype=np.uint8, buffer=buffer.buf, offset=capacity * 3 * 8))
+
+
+def default_workers():
+    return max((os.cpu_count() or 1) - 2, 1)
+
+
+def worker_loop(tasks, results, slots, capacity, function, kwargs):
+    buffers = [shared_memory.SharedMemory(name=name) for name in slots]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, slot, count, colored, args = task
+            start = time.perf_counter()
+            try:
+                points, colors = slot_arrays(buffers[slot], capacity, count)
+                if colored:
+                    result, result_colors = function(points, *args, colors=colors, **kwargs)
+                else:
+                    result = function(points, *args, **kwargs)
+                result = np.asarray(result, dtype=np.float64).reshape(-1, 3)
+                if len(result) > capacity:
+                    raise ValueError(f"{len(result)} result points do not fit in a slot of {capacity}")
+                # The input is no longer needed, the result goes back in the same slot
+                points, colors = slot_arrays(buffers[slot], capacity, len(result))
+                points[:] = result
+                if colored:
+                    colors[:] = result_colors
+                results.put((index, slot, len(result), time.perf_counter() - start, None))
+            except Exception as e:
+                results.put((index, slot, 0, time.perf_counter() - start, f"{type(e).__name__}: {e}"))
+    finally:
+        for buffer in buffers:
+            buffer.close()
+
+
+class FramePool:
+    '''Runs function(points, *args, **kwargs) on worker processes. Point arrays of up to capacity points are
+    copied once into a free shared memory slot, only the slot number and the small arguments are pickled.
+    submit blocks while every slot is in use, get returns the results in the order they were submitted.
+    Frames submitted with uint8 colors are passed to function as colors=, which then returns (points, colors).'''
+    def __init__(self, function, capacity, workers=None, slots=None, **kwargs):
+        self.capacity = int(capacity)
+        workers = workers or default_workers()
+        slots = slots or workers * SLOTS_PER_WORKER
+        self.buffers = [shared_memory.SharedMemory(create=True, size=self.capacity * SLOT_BYTES) for _ in range(slots)]
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.processes = [multiprocessing.Process(target=worker_loop, daemon=True,
+                                                  args=(self.tasks, self.results, [b.name for b in self.buffers],
+                                                        self.capacity, function, kwargs))
+                          for _ in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.submitted = 0
+        self.next_index = 0
+        self.pending = []
+        self.colored = set()
+
+    def in_flight(self):
+        return self.submitted - self.next_index
+
+    def submit(self, points, *args, timeout=None, colors=None):
+        '''Queues a frame, returns False if no slot freed up within timeout'''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if len(points) > self.capacity:
+            raise ValueError(f"{len(points)} points do not fit in a slot of {self.capacity}")
+        try:
+            slot = self.free_slots.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        slot_points, slot_colors = slot_arrays(self.buffers[slot], self.capacity, len(points))
+        slot_points[:] = points
+        if colors is not None:
+            slot_colors[:] = colors
+            self.colored.add(self.submitted)
+        self.tasks.put((self.submitted, slot, len(points), colors is not None, args))
+        self.submitted += 1
+        return True
+
+    def get(self, timeout=None):
+        '''(result points, worker seconds) of the next frame in submission order, ((points, colors), seconds) for
+        frames submitted with colors. Raises queue.Empty on timeout and RuntimeError if the function failed on that
+        frame.'''
+        while not self.pending or self.pending[0][0] != self.next_index:
+            try:
+                heapq.heappush(self.pending, self.results.get(timeout=timeout or 1))
+            except queue.Empty:
+                if timeout is not None:
+                    raise
+                if not any(process.is_alive() for process in self.processes):
+                    raise RuntimeError("Every processing worker exited")
+        index, slot, count, seconds, error = heapq.heappop(self.pending)
+        self.next_index += 1
+        points, colors = slot_arrays(self.buffers[slot], self.capacity, count)
+        result = (points.copy(), colors.copy()) if index in self.colored else points.copy()
+        self.colored.discard(index)
+        self.free_slots.put(slot)
+        if error:
+            raise RuntimeError(error)
+        return result, seconds
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                logging.warning("Terminating a processing worker that did not stop")
+                process.terminate()
+        for buffer in self.buffers:
+            buffer.close()
+            buffer.unlink()
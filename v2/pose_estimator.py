@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+'''Extended Kalman filter fusing GNSS fixes with the RealSense IMU (and optionally odometry velocities) into
+continuous poses, so points can still be georeferenced while the RTK fix degrades or drops out.
+
+Offline, against a recorded or generated session:
+
+    python pose_estimator.py --nmea data/nmea_data.txt --imu data/imu_data.txt --truth data/truth.txt --outage 20 30
+'''
+import math
+import bisect
+import argparse
+import threading
+from collections import deque
+import numpy as np
+
+EARTH_RADIUS = 6378137.0  # m
+
+# Position standard deviation (m) by GGA fix quality: 1 single, 2 DGPS, 4 RTK fixed, 5 RTK float
+FIX_SIGMA = {1: 2.5, 2: 0.8, 4: 0.02, 5: 0.3}
+DEFAULT_FIX_SIGMA = 2.5
+HEADING_SIGMA = 2.0  # Degrees, GNRMC course over ground
+MIN_HEADING_SPEED = 0.3  # m/s, the course is meaningless below this
+ACCEL_NOISE = 0.5  # m/s2
+GYRO_NOISE = 0.01  # rad/s
+GYRO_BIAS_WALK = 1e-4  # rad/s per sqrt(s)
+ACCEL_BIAS_WALK = 1e-3  # m/s2 per sqrt(s)
+NO_IMU_ACCEL_NOISE = 1.0  # m/s2, constant velocity model when there is no IMU
+NO_IMU_YAW_NOISE = 0.3  # rad/s
+HISTORY = 10  # seconds of poses kept for lookups
+
+# State: x, y (m east/north of the first fix), vx, vy (m/s), heading (rad clockwise from north),
+# gyro bias (rad/s), forward and left accel biases (m/s2)
+X, Y, VX, VY, HEADING, GYRO_BIAS, FORWARD_BIAS, LEFT_BIAS = range(8)
+
+
+def realsense_imu_to_body(accel, gyro):
+    '''Forward and left accelerations and clockwise yaw rate from RealSense camera axes (x right, y down, z forward)'''
+    return accel[2], -accel[0], gyro[1]
+
+
+def wrap_angle(angle):
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+class LocalFrame:
+    '''Equirectangular east/north meters around an origin, accurate to millimeters over a field'''
+    def __init__(self, lat, lon):
+        self.lat0 = lat
+        self.lon0 = lon
+        self.cos_lat0 = math.cos(math.radians(lat))
+
+    def to_local(self, lat, lon):
+        return (math.radians(lon - self.lon0) * EARTH_RADIUS * self.cos_lat0,
+                math.radians(lat - self.lat0) * EARTH_RADIUS)
+
+    def to_latlon(self, x, y):
+        return (self.lat0 + math.degrees(y / EARTH_RADIUS),
+                self.lon0 + math.degrees(x / (EARTH_RADIUS * self.cos_lat0)))
+
+
+class PoseEstimator:
+    '''Thread safe, measurements must be fed in time order (timestamps in seconds, any common clock)'''
+    def __init__(self, imu_to_body=realsense_imu_to_body):
+        self.imu_to_body = imu_to_body
+        self.state = np.zeros(8)
+        self.covariance = np.diag([1e6, 1e6, 1.0, 1.0, math.pi**2, 0.01**2, 0.1**2, 0.1**2])
+        self.frame = None
+        self.time = None
+        self.last_fix_time = None
+        self.imu_time = None
+        self.heading_known = False
+        self.history = deque()
+        self.lock = threading.Lock()
+
+    @property
+    def initialized(self):
+        return self.frame is not None
+
+    def fix_age(self, timestamp):
+        return math.inf if self.last_fix_time is None else timestamp - self.last_fix_time
+
+    def predict(self, timestamp, forward=0.0, left=0.0, yaw_rate=0.0, imu=False):
+        dt = timestamp - self.time
+        if dt <= 0:
+            return
+        s, P = self.state, self.covariance
+        h = s[HEADING]
+        sin_h, cos_h = math.sin(h), math.cos(h)
+        F = np.eye(8)
+        F[X, VX] = F[Y, VY] = dt
+        Q = np.zeros((8, 8))
+        if imu:
+            a_forward, a_left = forward - s[FORWARD_BIAS], left - s[LEFT_BIAS]
+            ax = a_forward * sin_h - a_left * cos_h
+            ay = a_forward * cos_h + a_left * sin_h
+            s[X] += s[VX] * dt + 0.5 * ax * dt**2
+            s[Y] += s[VY] * dt + 0.5 * ay * dt**2
+            s[VX] += ax * dt
+            s[VY] += ay * dt
+            s[HEADING] = wrap_angle(h + (yaw_rate - s[GYRO_BIAS]) * dt)
+            F[VX, HEADING], F[VY, HEADING] = ay * dt, -ax * dt
+            F[VX, FORWARD_BIAS], F[VX, LEFT_BIAS] = -sin_h * dt, cos_h * dt
+            F[VY, FORWARD_BIAS], F[VY, LEFT_BIAS] = -cos_h * dt, -sin_h * dt
+            F[HEADING, GYRO_BIAS] = -dt
+            Q[VX, VX] = Q[VY, VY] = (ACCEL_NOISE * dt)**2
+            Q[HEADING, HEADING] = (GYRO_NOISE * dt)**2
+            Q[GYRO_BIAS, GYRO_BIAS] = GYRO_BIAS_WALK**2 * dt
+            Q[FORWARD_BIAS, FORWARD_BIAS] = Q[LEFT_BIAS, LEFT_BIAS] = ACCEL_BIAS_WALK**2 * dt
+        else:
+            s[X] += s[VX] * dt
+            s[Y] += s[VY] * dt
+            Q[VX, VX] = Q[VY, VY] = NO_IMU_ACCEL_NOISE**2 * dt
+            Q[HEADING, HEADING] = NO_IMU_YAW_NOISE**2 * dt
+        self.covariance = F @ P @ F.T + Q
+        self.time = timestamp
+
+    def correct(self, residual, H, R):
+        P = self.covariance
+        S = H @ P @ H.T + R
+        K = np.linalg.solve(S, H @ P).T
+        self.state += K @ residual
+        self.state[HEADING] = wrap_angle(self.state[HEADING])
+        I_KH = np.eye(8) - K @ H
+        self.covariance = I_KH @ P @ I_KH.T + K @ R @ K.T
+
+    def record(self):
+        self.history.append((self.time, self.state[X], self.state[Y], self.state[HEADING], self.state[VX], self.state[VY]))
+        while self.history and self.history[0][0] < self.time - HISTORY:
+            self.history.popleft()
+
+    def advance(self, timestamp):
+        # Without recent IMU samples the filter falls back to a constant velocity model
+        if self.imu_time is None or timestamp - self.imu_time > 0.1:
+            self.predict(timestamp)
+
+    def update_imu(self, timestamp, accel, gyro):
+        forward, left, yaw_rate = self.imu_to_body(accel, gyro)
+        with self.lock:
+            if not self.initialized:
+                return
+            self.predict(timestamp, forward, left, yaw_rate, imu=True)
+            self.imu_time = timestamp
+            self.record()
+
+    def update_gnss(self, timestamp, lat, lon, quality=None, hdop=None):
+        if quality == 0:
+            return
+        sigma = FIX_SIGMA.get(quality, DEFAULT_FIX_SIGMA) * (max(hdop, 1.0) if hdop else 1.0)
+        with self.lock:
+            if not self.initialized:
+                self.frame = LocalFrame(lat, lon)
+                self.time = timestamp
+            self.advance(timestamp)
+            x, y = self.frame.to_local(lat, lon)
+            H = np.zeros((2, 8))
+            H[0, X] = H[1, Y] = 1
+            self.correct(np.array([x, y]) - self.state[:2], H, np.eye(2) * sigma**2)
+            self.last_fix_time = timestamp
+            self.record()
+
+    def update_heading(self, timestamp, heading, sigma=HEADING_SIGMA):
+        '''GNRMC course over ground in degrees, ignored while the rover is too slow for it to be meaningful'''
+        with self.lock:
+            if not self.initialized:
+                return
+            self.advance(timestamp)
+            heading = math.radians(heading)
+            if not self.heading_known:
+                self.state[HEADING] = wrap_angle(heading)
+                self.covariance[HEADING, HEADING] = math.radians(sigma)**2
+                self.heading_known = True
+            elif math.hypot(self.state[VX], self.state[VY]) >= MIN_HEADING_SPEED:
+                H = np.zeros((1, 8))
+                H[0, HEADING] = 1
+                self.correct(np.array([wrap_angle(heading - self.state[HEADING])]), H, np.eye(1) * math.radians(sigma)**2)
+            self.record()
+
+    def update_velocity(self, timestamp, vx, vy, sigma):
+        '''East/north velocity (m/s), e.g. from frame to frame depth odometry'''
+        with self.lock:
+            if not self.initialized:
+                return
+            self.advance(timestamp)
+            H = np.zeros((2, 8))
+            H[0, VX] = H[1, VY] = 1
+            self.correct(np.array([vx, vy]) - self.state[VX:VY + 1], H, np.eye(2) * sigma**2)
+            self.record()
+
+    def pose_at(self, timestamp):
+        '''(x, y, heading degrees) at timestamp, interpolated within the history and extrapolated past it'''
+        with self.lock:
+            if not self.history:
+                return None
+            times = [entry[0] for entry in self.history]
+            index = bisect.bisect_left(times, timestamp)
+            if index >= len(times):
+                t, x, y, h, vx, vy = self.history[-1]
+                dt = timestamp - t
+                return x + vx * dt, y + vy * dt, math.degrees(h) % 360
+            if index == 0:
+                t, x, y, h = self.history[0][:4]
+                return x, y, math.degrees(h) % 360
+            t0, x0, y0, h0 = self.history[index - 1][:4]
+            t1, x1, y1, h1 = self.history[index][:4]
+            f = (timestamp - t0) / (t1 - t0) if t1 > t0 else 1.0
+            heading = h0 + f * wrap_angle(h1 - h0)
+            return x0 + f * (x1 - x0), y0 + f * (y1 - y0), math.degrees(heading) % 360
+
+    def latlon_at(self, timestamp):
+        '''(lat, lon, heading degrees) at timestamp, None before the first fix'''
+        pose = self.pose_at(timestamp)
+        if pose is None:
+            return None
+        lat, lon = self.frame.to_latlon(pose[0], pose[1])
+        return lat, lon, pose[2]
+
+    def position_sigma(self):
+        return math.sqrt(max(self.covariance[X, X], self.covariance[Y, Y]))
+
+
+def load_imu_log(path):
+    '''timestamp, ax, ay, az, gx, gy, gz rows as written by the RealSense recorder and generate_data.py'''
+    return np.loadtxt(path, delimiter=',', ndmin=2)
+
+
+def load_gnss_log(nmea_path=None, gps_path=None):
+    '''Time ordered (timestamp, kind, values) events from a raw NMEA capture or a gps_data.txt'''
+    from processing import parse_nmea, parse_fix_quality
+    events = []
+    if nmea_path:
+        with open(nmea_path, 'r') as f:
+            for line in f:
+                timestamp, sentence = line.rstrip('\n').split(',', 1)
+                try:
+                    data_type, value = parse_nmea(sentence)
+                except (ValueError, IndexError):
+                    continue
+                if data_type == 'GNGGA':
+                    events.append((float(timestamp), 'fix', value + parse_fix_quality(sentence)))
+                elif data_type == 'GNRMC' and value is not None:
+                    events.append((float(timestamp), 'heading', value))
+    else:
+        for timestamp, lat, lon, heading in np.loadtxt(gps_path, delimiter=',', ndmin=2):
+            events.append((timestamp, 'heading', heading))
+            events.append((timestamp, 'fix', (lat, lon, None, None)))
+    return events
+
+
+def run_offline(events, imu=None, outage=None, rate=20):
+    '''Feeds the events and IMU samples in time order and samples the pose rate times per second, each pose only
+    knowing the measurements before it as live. Returns an array of timestamp, lat, lon, heading, x, y.'''
+    estimator = PoseEstimator()
+    imu_times = imu[:, 0] if imu is not None else np.array([])
+    merged = [(t, 1, 'imu', i) for i, t in enumerate(imu_times)] + [(t, 0, kind, value) for t, kind, value in events]
+    merged.sort(key=lambda event: (event[0], event[1]))
+    merged.append((math.inf, 2, 'end', None))
+    poses = []
+    next_output = None
+    for timestamp, _, kind, value in merged:
+        while next_output is not None and next_output < min(timestamp, merged[-2][0]):
+            lat, lon, heading = estimator.latlon_at(next_output)
+            x, y, _ = estimator.pose_at(next_output)
+            poses.append((next_output, lat, lon, heading, x, y))
+            next_output += 1 / rate
+        if kind == 'end':
+            break
+        if kind == 'imu':
+            estimator.update_imu(timestamp, imu[value, 1:4], imu[value, 4:7])
+        elif outage and outage[0] <= timestamp < outage[1]:
+            continue
+        elif kind == 'fix':
+            estimator.update_gnss(timestamp, *value)
+        else:
+            estimator.update_heading(timestamp, value)
+        if next_output is None and estimator.initialized:
+            next_output = timestamp
+    return np.array(poses), estimator
+
+
+def compare_to_truth(poses, truth_path, outage=None):
+    '''Position errors against a generate_data.py truth.txt, whose local frame origin is the first true position'''
+    truth = np.loadtxt(truth_path, delimiter=',', ndmin=2)
+    poses = poses[(poses[:, 0] >= truth[0, 0]) & (poses[:, 0] <= truth[-1, 0])]
+    tx = np.interp(poses[:, 0], truth[:, 0], truth[:, 1]) - truth[0, 1]
+    ty = np.interp(poses[:, 0], truth[:, 0], truth[:, 2]) - truth[0, 2]
+    errors = np.hypot(poses[:, 4] - tx, poses[:, 5] - ty)
+    report = {'all': errors}
+    if outage:
+        inside = (poses[:, 0] >= outage[0]) & (poses[:, 0] < outage[1])
+        report['outage'] = errors[inside]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the GNSS/IMU pose filter offline on a recorded session.")
+    parser.add_argument('--nmea', help="raw 'timestamp,sentence' GPS capture (nmea_data.txt)")
+    parser.add_argument('--gps', help="gps_data.txt, when there is no raw capture")
+    parser.add_argument('--imu', help="imu_data.txt, the filter runs on GNSS only without it")
+    parser.add_argument('--truth', help="truth.txt of a generated session, to report position errors")
+    parser.add_argument('--outage', type=float, nargs=2, metavar=('START', 'END'), help="drop the GNSS between these times")
+    parser.add_argument('--rate', type=float, default=20, help="poses written per second")
+    parser.add_argument('--output', help="file the poses are written to")
+    args = parser.parse_args()
+    if not args.nmea and not args.gps:
+        parser.error("one of --nmea or --gps is required")
+
+    events = load_gnss_log(args.nmea, args.gps)
+    imu = load_imu_log(args.imu) if args.imu else None
+    poses, estimator = run_offline(events, imu, args.outage, args.rate)
+    print(f"{len(poses)} poses, gyro bias {estimator.state[GYRO_BIAS]:.5f} rad/s, "
+          f"position sigma {estimator.position_sigma():.3f} m")
+    if args.output:
+        np.savetxt(args.output, poses[:, :4], delimiter=',', fmt=['%.3f', '%.9f', '%.9f', '%.2f'])
+    if args.truth:
+        for name, errors in compare_to_truth(poses, args.truth, args.outage).items():
+            if len(errors):
+                print(f"{name}: mean error {errors.mean():.3f} m, max {errors.max():.3f} m, final {errors[-1]:.3f} m")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,41 @@
 #!/usr/bin/env python3
 '''Animates distances and measurment quality'''
-from rplidar import RPLidar
+from lidar_driver import RPLidarDriver
+from live_view import LiveView, ScanBuffer
+from config import load_config
+import threading
 import matplotlib.pyplot as plt
-import numpy as np
-import matplotlib.animation as animation
 
-PORT_NAME = 'COM3'
+SETTINGS = load_config('lidar', {'LIDAR_PORT': 'COM3', 'LIDAR_SCAN_MODE': 'express'}, strict=False)  # see config.py
+PORT_NAME = SETTINGS['LIDAR_PORT']
 DMAX = 4000
 IMIN = 0
 IMAX = 50
 
-def update_line(num, iterator, line):
-    scan = next(iterator)
-    offsets = np.array([(np.radians(meas[1]), meas[2]) for meas in scan])
-    line.set_offsets(offsets)
-    intens = np.array([meas[0] for meas in scan])
-    line.set_array(intens)
-    return line,
+def read_scans(lidar, scan, stop):
+    for measures in lidar.iter_scans(SETTINGS['LIDAR_SCAN_MODE']):
+        scan.write(measures['angle'], measures['distance'], measures['quality'])
+        if stop.is_set():
+            break
 
 def run():
-    lidar = RPLidar(PORT_NAME)
+    lidar = RPLidarDriver(PORT_NAME)
     fig = plt.figure()
     ax = plt.subplot(111, projection='polar')
-    line = ax.scatter([0, 0], [0, 0], s=5, c=[IMIN, IMAX],
-                           cmap=plt.cm.Greys_r, lw=0)
+    line = ax.scatter([], [], s=5, c=[], cmap=plt.cm.Greys_r, vmin=IMIN, vmax=IMAX, lw=0)
     ax.set_rmax(DMAX)
     ax.grid(True)
 
-    iterator = lidar.iter_scans()
-    ani = animation.FuncAnimation(fig, update_line,
-        fargs=(iterator, line), interval=50)
+    # Scans are read on their own thread, the plot is redrawn on a timer whatever the rotation speed
+    scan = ScanBuffer()
+    view = LiveView(fig)
+    view.add(line, scan)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_scans, args=(lidar, scan, stop), daemon=True)
+    reader.start()
     plt.show()
+    stop.set()
+    reader.join()
     lidar.stop()
     lidar.disconnect()
 
@@ -0,0 +1,206 @@
+'''Processing steps shared by the recorders and the offline tools, importable without any hardware library'''
+import numpy as np
+from projection import to_utm
+
+VOXEL_SIZE = 0.05  # meters
+
+CYGLIDAR_DISTANCE_LIMIT = 4080
+CYGLIDAR_3D_LENGTH = 14400
+CYGLIDAR_HEADER = bytes([0x5A, 0x77, 0xFF])  # normal mode, product code, default id
+
+
+def parse_latitude(value, hemisphere):
+    lat = float(value[:2]) + float(value[2:]) / 60
+    return -lat if hemisphere == 'S' else lat
+
+
+def parse_longitude(value, hemisphere):
+    lon = float(value[:3]) + float(value[3:]) / 60
+    return -lon if hemisphere == 'W' else lon
+
+
+def parse_nmea(line):
+    '''Sentence type and fields of an NMEA line, (lat, lon) for GNGGA and heading (or None) for GNRMC'''
+    fields = line.strip().split(',')
+    data_type = fields[0][1:]
+    if data_type == "GNGGA":
+        return data_type, (parse_latitude(fields[2], fields[3]), parse_longitude(fields[4], fields[5]))
+    if data_type == "GNRMC":
+        return data_type, float(fields[8]) if fields[8] else None
+    return data_type, None
+
+
+def parse_fix_quality(line):
+    '''(fix quality, HDOP) of a GNGGA line, None for the fields that are empty'''
+    fields = line.strip().split(',')
+    quality = int(fields[6]) if len(fields) > 6 and fields[6] else None
+    hdop = float(fields[8]) if len(fields) > 8 and fields[8] else None
+    return quality, hdop
+
+
+def lidar_offsets(heading, angle, distance, sensor_height, sensor_tilt, lidar_orientation=0, angle_from_gps=0,
+                  distance_from_gps=0):
+    '''Easting and northing offsets (m) from the GPS position and height (mm) of lidar measures, distances in mm.
+    Every argument may be an array, e.g. to evaluate whole sessions at once.'''
+    adjusted_angle = (angle + lidar_orientation) % 360
+
+    # The elevation difference is the vertical component of the measured distance
+    delta_y = sensor_height - distance * np.sin(np.deg2rad(sensor_tilt)) * np.cos(np.deg2rad(adjusted_angle))
+    d_forward = distance * np.cos(np.deg2rad(sensor_tilt))
+    d_lateral = d_forward * np.tan(np.deg2rad(adjusted_angle))
+    # The horizontal distance is the horizontal component of the measured distance
+    x = np.sqrt(d_forward**2 + d_lateral**2)
+
+    lidar_offset_angle = np.deg2rad(heading + angle_from_gps)
+    lidar_offset_easting = distance_from_gps * np.sin(lidar_offset_angle) / 1000
+    lidar_offset_northing = distance_from_gps * np.cos(lidar_offset_angle) / 1000
+
+    final_angle = np.deg2rad(heading + angle_from_gps + adjusted_angle)
+    return (lidar_offset_easting + x * np.sin(final_angle) / 1000,
+            lidar_offset_northing + x * np.cos(final_angle) / 1000,
+            delta_y)
+
+
+def georeference_lidar_point(lat, lon, heading, angle, distance, sensor_height, sensor_tilt,
+                             lidar_orientation=0, angle_from_gps=0, distance_from_gps=0):
+    '''Easting, northing and height of one lidar measure, distances in mm'''
+    easting, northing = to_utm(lat, lon)
+    d_easting, d_northing, delta_y = lidar_offsets(heading, angle, distance, sensor_height, sensor_tilt,
+                                                   lidar_orientation, angle_from_gps, distance_from_gps)
+    return easting + d_easting, northing + d_northing, delta_y
+
+
+def extract_vertices(vtx):
+    return np.array([(v[0], v[1], v[2]) for v in vtx])
+
+
+def voxel_downsample(pointcloud, voxel_size=VOXEL_SIZE, return_index=False):
+    '''Keeps the lowest point of every voxel, with return_index also the indices of the points kept'''
+    voxel_grid = {}
+    for index, point in enumerate(pointcloud):
+        voxel_key = tuple(np.floor(point / voxel_size).astype(int))
+        if voxel_key not in voxel_grid or point[2] < pointcloud[voxel_grid[voxel_key]][2]:
+            voxel_grid[voxel_key] = index
+    kept = np.fromiter(voxel_grid.values(), dtype=np.intp, count=len(voxel_grid))
+    points = np.asarray(pointcloud)[kept] if len(kept) else np.array([])
+    return (points, kept) if return_index else points
+
+
+def camera_to_local(points, heading, sensor_height, sensor_tilt, sensor_orientation=0, angle_from_gps=0,
+                    distance_from_gps=0):
+    '''Camera frame points to east, north and up meters from the GPS position, heights relative to the ground.
+    heading may hold one value per point, e.g. to evaluate whole sessions at once.'''
+    points = np.asarray(points, dtype=np.float64)
+    # Tilt about x followed by the orientation about z, as Rz(orientation + heading) @ Rx(tilt - 90)
+    tilt = np.radians(sensor_tilt - 90)
+    yaw = np.radians(sensor_orientation + heading)
+    tilted_y = np.cos(tilt) * points[:, 1] - np.sin(tilt) * points[:, 2]
+    tilted_z = np.sin(tilt) * points[:, 1] + np.cos(tilt) * points[:, 2]
+    transformed_points = np.empty(points.shape)
+    transformed_points[:, 0] = np.cos(yaw) * points[:, 0] - np.sin(yaw) * tilted_y
+    transformed_points[:, 1] = np.sin(yaw) * points[:, 0] + np.cos(yaw) * tilted_y
+    transformed_points[:, 2] = tilted_z
+
+    transformed_points[:, 0] += distance_from_gps * np.sin(np.radians(angle_from_gps + heading))
+    transformed_points[:, 1] += distance_from_gps * np.cos(np.radians(angle_from_gps + heading))
+    transformed_points[:, 2] += sensor_height
+    return transformed_points
+
+
+def georeference_pointcloud(points, lat, lon, heading, sensor_height, sensor_tilt, sensor_orientation=0,
+                            angle_from_gps=0, distance_from_gps=0, max_distance=None, correction=None, colors=None):
+    '''Moves camera frame points to UTM coordinates, heights relative to the ground.
+    correction is an optional 4x4 pose correction relative to the GPS position, e.g. from registration.py.
+    With colors, one row per point, (points, colors of the points kept) is returned.'''
+    easting, northing = to_utm(lat, lon)
+    transformed_points = camera_to_local(points, heading, sensor_height, sensor_tilt, sensor_orientation,
+                                         angle_from_gps, distance_from_gps)
+
+    if max_distance is not None:
+        within = np.linalg.norm(transformed_points, axis=1) <= max_distance
+        transformed_points = transformed_points[within]
+        if colors is not None:
+            colors = colors[within]
+
+    if correction is not None:
+        transformed_points = transformed_points @ correction[:3, :3].T + correction[:3, 3]
+
+    transformed_points[:, 0] += easting
+    transformed_points[:, 1] += northing
+
+    return transformed_points if colors is None else (transformed_points, colors)
+
+
+def process_pointcloud(pointcloud, lat, lon, heading, sensor_height, sensor_tilt, sensor_orientation=0,
+                       angle_from_gps=0, distance_from_gps=0, max_distance=None, voxel_size=VOXEL_SIZE, colors=None):
+    '''Downsamples a camera frame point cloud and moves it to UTM coordinates, with colors (points, colors)'''
+    points, kept = voxel_downsample(pointcloud, voxel_size, return_index=True)
+    return georeference_pointcloud(points, lat, lon, heading, sensor_height, sensor_tilt, sensor_orientation,
+                                   angle_from_gps, distance_from_gps, max_distance,
+                                   colors=None if colors is None else np.asarray(colors)[kept])
+
+
+def write_points(f, timestamp, points):
+    for point in points:
+        f.write(f"{timestamp},{point[0]},{point[1]},{point[2]}\n")
+
+
+def save_bin_data(file_path, points, colors=None):
+    '''Point count, float64 points, then uint8 RGB colors if there are any'''
+    with open(file_path, 'wb') as f:
+        np.array([len(points)], dtype=np.uint32).tofile(f)
+        np.asarray(points, dtype=np.float64).tofile(f)
+        if colors is not None:
+            np.asarray(colors, dtype=np.uint8).tofile(f)
+
+
+def load_bin_data(file_path):
+    with open(file_path, 'rb') as f:
+        num_points = np.fromfile(f, dtype=np.uint32, count=1)[0]
+        data = np.fromfile(f, dtype=np.float64, count=num_points * 3).reshape((num_points, 3))
+    return data
+
+
+def split_cyglidar_frames(buffer):
+    '''(payloads, dropped bytes) of the CygLidar frames complete at the start of a bytearray, removed from it. A frame
+    is the header, the little endian length of its payload, the payload (payload header then data) and the XOR of the
+    length and payload bytes. Bytes before a header and frames failing their checksum are dropped.'''
+    payloads, dropped = [], 0
+    while True:
+        start = buffer.find(CYGLIDAR_HEADER)
+        if start < 0:
+            # The last bytes may be the beginning of a header
+            start = max(len(buffer) - len(CYGLIDAR_HEADER) + 1, 0)
+        dropped += start
+        del buffer[:start]
+        if len(buffer) < 5:
+            return payloads, dropped
+        end = 5 + (buffer[3] | buffer[4] << 8)
+        if len(buffer) <= end:
+            return payloads, dropped
+        if np.bitwise_xor.reduce(np.frombuffer(buffer, dtype=np.uint8, count=end)[3:]) == buffer[end]:
+            payloads.append(bytes(buffer[5:end]))
+            del buffer[:end + 1]
+        else:
+            dropped += 1
+            del buffer[:1]
+
+
+def decode_cyglidar_3d(receivedData, dataLength3D=CYGLIDAR_3D_LENGTH, normalizeDistanceLimit=CYGLIDAR_DISTANCE_LIMIT):
+    '''Unpacks the 12 bit pixel pairs of a CygLidar 3D payload'''
+    index = 0
+    distanceData = [0 for i in range(int(dataLength3D / 3 * 2))]
+    for i in range(0, dataLength3D-2, 3):
+        pixelFirst = receivedData[i] << 4 | receivedData[i+1] >> 4
+        pixelSecond = (receivedData[i+1] & 0xf) << 8 | receivedData[i+2]
+
+        if pixelFirst > normalizeDistanceLimit:
+            pixelFirst = normalizeDistanceLimit
+        if pixelSecond > normalizeDistanceLimit:
+            pixelSecond = normalizeDistanceLimit
+
+        distanceData[index] = pixelFirst
+        index += 1
+        distanceData[index] = pixelSecond
+        index += 1
+    return distanceData
@@ -0,0 +1,141 @@
+'''Lat/lon to UTM for a survey: the zone is picked once, transformers are cached and positions near the origin go
+through a precomputed local polynomial instead of the full projection'''
+import functools
+import numpy as np
+import utm
+
+try:
+    from pyproj import Transformer
+except ImportError:
+    Transformer = None
+
+FAST_PATH_RADIUS = 5000  # meters around the origin served by the fast path
+FAST_PATH_TOLERANCE = 0.001  # meters, the fast path is disabled if it deviates more from the exact projection
+FAST_PATH_DEGREE = 3
+FIT_SAMPLES = 21  # per axis, the error is checked in between
+METERS_PER_DEGREE = 111320
+
+
+def utm_zone(lat, lon):
+    '''(zone number, northern) of a position, including the Norway and Svalbard exceptions'''
+    return utm.latlon_to_zone_number(lat, lon), lat >= 0
+
+
+def utm_epsg(zone_number, northern):
+    return (32600 if northern else 32700) + zone_number
+
+
+@functools.lru_cache(maxsize=None)
+def transformer(epsg):
+    return Transformer.from_crs("EPSG:4326", f"EPSG:{epsg}", always_xy=True)
+
+
+def monomials(u, v, degree=FAST_PATH_DEGREE):
+    return np.stack([u**i * v**(d - i) for d in range(degree + 1) for i in range(d + 1)], axis=-1)
+
+
+class Projection:
+    '''UTM projection of a survey around (lat, lon). Every position is projected in the zone of the origin, so a
+    session crossing a zone boundary stays continuous. Within radius meters of the origin, easting and northing come
+    from a polynomial fitted to the exact projection when it was built, max_error is its measured deviation.'''
+    def __init__(self, lat, lon, radius=FAST_PATH_RADIUS, tolerance=FAST_PATH_TOLERANCE):
+        self.zone_number, self.northern = utm_zone(lat, lon)
+        self.epsg = utm_epsg(self.zone_number, self.northern)
+        self.lat0, self.lon0 = float(lat), float(lon)
+        self.origin = tuple(float(v) for v in self.exact(lat, lon))
+        self.lat_range = radius / METERS_PER_DEGREE
+        self.lon_range = radius / (METERS_PER_DEGREE * max(np.cos(np.radians(lat)), 0.01))
+
+        # Fitted on a grid of the square around the origin, checked on the midpoints of that grid
+        u, v = (a.ravel() for a in np.meshgrid(np.linspace(-1, 1, FIT_SAMPLES), np.linspace(-1, 1, FIT_SAMPLES)))
+        easting, northing = self.exact(self.lat0 + u * self.lat_range, self.lon0 + v * self.lon_range)
+        targets = np.column_stack([easting - self.origin[0], northing - self.origin[1]])
+        self.coefficients = np.linalg.lstsq(monomials(u, v), targets, rcond=None)[0]
+        step = 1 / (FIT_SAMPLES - 1)
+        u, v = (a.ravel() for a in np.meshgrid(np.linspace(-1 + step, 1 - step, FIT_SAMPLES - 1),
+                                               np.linspace(-1 + step, 1 - step, FIT_SAMPLES - 1)))
+        easting, northing = self.exact(self.lat0 + u * self.lat_range, self.lon0 + v * self.lon_range)
+        errors = monomials(u, v) @ self.coefficients - np.column_stack([easting - self.origin[0],
+                                                                        northing - self.origin[1]])
+        self.max_error = float(np.hypot(errors[:, 0], errors[:, 1]).max())
+        self.fast_path = self.max_error <= tolerance
+        # horner[output][k] holds the coefficients of u**0..u**k in the v**(degree - k) term
+        self.horner = [[[0.0] * (k + 1) for k in range(FAST_PATH_DEGREE + 1)] for _ in range(2)]
+        terms = [(i, d - i) for d in range(FAST_PATH_DEGREE + 1) for i in range(d + 1)]
+        for (i, j), coefficients in zip(terms, self.coefficients):
+            for output in range(2):
+                self.horner[output][FAST_PATH_DEGREE - j][i] = float(coefficients[output])
+
+    def exact(self, lat, lon):
+        '''(easting, northing) from the full projection, pyproj when it is installed'''
+        if Transformer is not None:
+            return transformer(self.epsg).transform(lon, lat)
+        easting, northing, _, _ = utm.from_latlon(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64),
+                                                  force_zone_number=self.zone_number, force_northern=self.northern)
+        return easting, northing
+
+    def forward(self, lat, lon):
+        '''(easting, northing) of scalars or arrays of positions'''
+        if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+            return self.forward_scalar(float(lat), float(lon))
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        u = (lat - self.lat0) / self.lat_range
+        v = (lon - self.lon0) / self.lon_range
+        if not self.fast_path:
+            return self.exact(lat, lon)
+        near = (np.abs(u) <= 1) & (np.abs(v) <= 1)
+        if near.all():
+            return self.evaluate(u, v)
+        easting, northing = np.empty(lat.shape), np.empty(lat.shape)
+        easting[near], northing[near] = self.evaluate(u[near], v[near])
+        easting[~near], northing[~near] = self.exact(lat[~near], lon[~near])
+        return easting, northing
+
+    def evaluate(self, u, v):
+        # Horner in v of polynomials in u, updated in place to keep the temporaries of large arrays down
+        results = []
+        for origin, rows in zip(self.origin, self.horner):
+            total = None
+            for row in rows:
+                value = u * row[-1] + row[-2] if len(row) > 1 else u * 0 + row[0]
+                for c in row[-3::-1]:
+                    value *= u
+                    value += c
+                if total is None:
+                    total = value
+                else:
+                    total *= v
+                    total += value
+            total += origin
+            results.append(total)
+        return results[0], results[1]
+
+    def forward_scalar(self, lat, lon):
+        # Plain Python, a single position does not amortize the NumPy call overhead
+        u = (lat - self.lat0) / self.lat_range
+        v = (lon - self.lon0) / self.lon_range
+        if not self.fast_path or abs(u) > 1 or abs(v) > 1:
+            easting, northing = self.exact(lat, lon)
+            return float(easting), float(northing)
+        return tuple(float(value) for value in self.evaluate(u, v))
+
+    def covers(self, lat, lon):
+        return utm_zone(lat, lon) == (self.zone_number, self.northern) or (
+            abs(lat - self.lat0) <= self.lat_range and abs(lon - self.lon0) <= self.lon_range)
+
+
+_session = None
+
+
+def session_projection(lat, lon):
+    '''Projection of the running session, built on its first position. Later positions keep its zone, a new one
+    is only built for a position outside both its zone and its fast path, e.g. another survey in the same process.'''
+    global _session
+    if _session is None or not _session.covers(lat, lon):
+        _session = Projection(lat, lon)
+    return _session
+
+
+def to_utm(lat, lon):
+    '''(easting, northing) of scalars or arrays in the zone of the session'''
+    return session_projection(float(np.ravel(lat)[0]), float(np.ravel(lon)[0])).forward(lat, lon)
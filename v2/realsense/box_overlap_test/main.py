@@ -1,16 +1,14 @@
+import os
+import sys
 import numpy as np
 import plotly.graph_objs as go
-from pyproj import Transformer
 
-MAX_HEIGHT = 0.4
-
-def read_cloud_file(filename):
-    with open(filename, 'r') as f:
-        return np.array([list(map(float, line.strip().split(','))) for line in f])
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from registration import register, transform_points
+from projection import Projection
+from cloud_io import load_cloud, load_gps
 
-def read_gps_file(filename):
-    with open(filename, 'r') as f:
-        return list(map(float, f.read().strip().split(',')))
+MAX_HEIGHT = 0.4
 
 def rotate_points(points, angle_deg):
     angle_rad = np.radians(angle_deg)
@@ -21,29 +19,7 @@ def rotate_points(points, angle_deg):
     ])
     return np.dot(points, rotation_matrix.T)
 
-def main():
-    cloud1 = read_cloud_file('cloud1.txt')
-    cloud2 = read_cloud_file('cloud2.txt')
-    cloud1 = cloud1[cloud1[:, 2] <= MAX_HEIGHT]
-    cloud2 = cloud2[cloud2[:, 2] <= MAX_HEIGHT]
-
-    gps1 = read_gps_file('gps1.txt')
-    gps2 = read_gps_file('gps2.txt')
-
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:32610", always_xy=True)
-
-    x1, y1 = transformer.transform(gps1[1], gps1[0])
-    x2, y2 = transformer.transform(gps2[1], gps2[0])
-
-    cloud1 = rotate_points(cloud1, gps1[2])
-    cloud2 = rotate_points(cloud2, gps2[2])
-
-    cloud1 -= cloud1.mean(axis=0)
-    cloud2 -= cloud2.mean(axis=0)
-
-    translation = np.array([x2 - x1, y2 - y1, 0])
-    cloud2 += translation
-
+def plot_clouds(cloud1, cloud2, title, filename):
     trace1 = go.Scatter3d(
         x=cloud1[:, 0], y=cloud1[:, 1], z=cloud1[:, 2],
         mode='markers',
@@ -65,7 +41,7 @@ def main():
             zaxis=dict(title='Z (m)'),
             aspectmode='data'
         ),
-        title='Combined 3D Box Without Using GPS Data',
+        title=title,
         template='plotly_dark'
     )
 
@@ -73,7 +49,40 @@ def main():
     
     # fig.show()
     
-    fig.write_html("overlap_box_nogps.html")
+    fig.write_html(filename)
+
+def main():
+    # Both relative to the first point of cloud1, the clouds are centered below anyway
+    cloud1, origin = load_cloud('cloud1.txt')
+    cloud2, _ = load_cloud('cloud2.txt', origin=origin)
+    cloud1 = cloud1[cloud1[:, 2] <= MAX_HEIGHT]
+    cloud2 = cloud2[cloud2[:, 2] <= MAX_HEIGHT]
+
+    gps1 = load_gps('gps1.txt')[0]
+    gps2 = load_gps('gps2.txt')[0]
+
+    # Zone of the first capture rather than a fixed EPSG code
+    projection = Projection(gps1[0], gps1[1])
+    x1, y1 = projection.forward(gps1[0], gps1[1])
+    x2, y2 = projection.forward(gps2[0], gps2[1])
+
+    cloud1 = rotate_points(cloud1, gps1[2])
+    cloud2 = rotate_points(cloud2, gps2[2])
+
+    cloud1 -= cloud1.mean(axis=0)
+    cloud2 -= cloud2.mean(axis=0)
+
+    translation = np.array([x2 - x1, y2 - y1, 0])
+    cloud2 += translation
+
+    plot_clouds(cloud1, cloud2, 'Combined 3D Box Without Using GPS Data', "overlap_box_nogps.html")
+
+    # The GPS alignment above is the initial guess, ICP refines it
+    transform, rmse, fitness = register(cloud2, cloud1)
+    print(f"ICP correction (rmse {rmse:.4f} m, fitness {fitness:.2f}):\n{np.round(transform, 4)}")
+    cloud2 = transform_points(cloud2, transform)
+
+    plot_clouds(cloud1, cloud2, 'Combined 3D Box Registered With ICP', "overlap_box_icp.html")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,32 @@
 import serial
 import time
 import os
+import sys
 import numpy as np
 import plotly.graph_objs as go
-import utm
 import pyrealsense2 as rs
-from scipy.spatial.transform import Rotation
 import threading
-from queue import Queue
 import logging
 import queue
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processing import parse_nmea, parse_fix_quality, extract_vertices, voxel_downsample, georeference_pointcloud, process_pointcloud, write_points
+from metrics import Metrics, start_reporting
+from config import load_config, write_metadata
+from catalog import choose_session, add_session
+from buffers import BoundedQueue, FrameBuffer
+from pool import FramePool
+from depth_filters import FilterChain
+from depth_projection import RayTable, ColorMap
+from registration import FrameRegistration, transform_points
+from pose_estimator import PoseEstimator
+from projection import to_utm
+from cloud_io import load_text, load_colors
+from plot import point_marker, save_as_ply
+from ground import segment_ground, ground_height, plane_tilt
+from obstacles import ObstacleDetector, parse_address
+from streaming import StreamPublisher
+
 GPS_PORT = 'COM4'
 GPS_BAUD_RATE = 57600
 SENSOR_HEIGHT = 0.973  # meters
@@ -19,6 +35,53 @@ ANGLE_FROM_GPS = 0  # Degrees
 DISTANCE_FROM_GPS = 0  # meters
 SENSOR_ORIENTATION = 0  # Degrees
 MAX_DISTANCE_FROM_SENSOR = 4  # meters
+DEPTH_WIDTH = 1280
+DEPTH_HEIGHT = 720
+DEPTH_FPS = 15
+COLOR_MODE = None  # None streams depth only, 'separate' also keeps color images in color_data.npy, 'aligned' aligns every depth frame to color
+COLOR_WIDTH = 640  # 'separate' mode
+COLOR_HEIGHT = 480
+COLOR_FPS = 15
+COLOR_INTERVAL = 1.0  # seconds between the color images kept in 'separate' mode
+COLOR_POINTS = True  # RGB of every point from the color stream when COLOR_MODE has one, kept in pointcloud_data.npy and processed_colors.bin
+DEPTH_FILTERS = ['decimation', 'threshold', 'spatial']  # librealsense filters run before the point cloud, in order, of depth_filters.FILTERS
+DECIMATION_MAGNITUDE = 2  # keeps one depth pixel in 4, 4 for one in 16
+MIN_DISTANCE_FROM_SENSOR = 0.15  # meters, closer depth is dropped by the threshold filter with MAX_DISTANCE_FROM_SENSOR
+SPATIAL_MAGNITUDE = 2  # iterations of the edge preserving spatial filter
+SPATIAL_ALPHA = 0.5
+SPATIAL_DELTA = 20  # disparity steps, larger jumps are edges and are not smoothed
+TEMPORAL_ALPHA = 0.4  # weight of the new frame, low values smooth more but lag behind the motion
+TEMPORAL_DELTA = 20
+HOLE_FILLING = 1  # 0 from the left, 1 farthest around, 2 nearest around
+DEPTH_ROI = None  # (left, top, right, bottom) fractions of the depth image projected, e.g. [0, 0.4, 1, 1] skips the top 40%, None for all
+PROCESSING_WORKERS = None  # processes, None for all cores but two, 0 to process in the recorder itself
+IMU_ENABLED = True  # D435i motion streams fused with the GPS, the recorder carries on without them
+ACCEL_RATE = 250  # Hz
+GYRO_RATE = 200  # Hz
+FIX_TIMEOUT = 0.5  # seconds without a fix after which frames are processed on the IMU poses alone
+MAX_DEAD_RECKONING = 10  # seconds without a fix after which frames are skipped
+REGISTER_FRAMES = True  # refines each frame's GPS pose with ICP against the previous frame
+GROUND_METHOD = 'ransac'  # 'ransac' or 'grid', heights relative to the ground fitted in each frame, None for SENSOR_HEIGHT
+DETECT_OBSTACLES = True  # alerts for the steps, holes and obstacles in the processed frames
+STEP_HEIGHT = 0.08  # meters between neighbouring 10 cm cells
+OBSTACLE_HEIGHT = 0.2  # meters above the ground
+HOLE_DEPTH = 0.2  # meters below the ground
+ALERT_ADDRESS = None  # 'host:port' the alerts are also sent to as JSON datagrams, None for the log only
+STREAM_PORT = None  # port the processed points and the trajectory are streamed on (see streaming.py), None to disable
+STREAM_TRANSPORT = 'tcp'  # 'tcp' or 'udp'
+QUEUE_SIZE = 4  # GPS fixes waiting for processing
+QUEUE_POLICY = 'drop_oldest'  # 'drop_oldest', 'coalesce' (only the latest fix is processed) or 'block'
+FRAME_BUFFER_SIZE = 5  # latest frames kept to pair the fixes with
+MAX_FRAME_OFFSET = 0.2  # seconds between a fix and its frame, fixes without a frame this close are skipped
+FRAME_WAIT = 0.1  # seconds a fix waits for the frame following it
+METRICS_PORT = 8765  # None to disable the HTTP endpoint
+METRICS_INTERVAL = 10  # seconds between lines of metrics.jsonl, None to disable
+CALIBRATION_FILE = 'calibration.json'  # written by calibrate.py, its constants replace the ones above
+
+# The constants above are defaults, replaced by calibration.json, config.json and TRIC_* variables (see config.py)
+DEFAULTS = {name: value for name, value in globals().items() if name.isupper()}
+CONFIG = load_config('realsense', DEFAULTS)
+globals().update(CONFIG)
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -27,17 +90,42 @@ class DataRecorder:
         self.start_time = time.time()
         self.session_folder = f"data_{time.strftime('%Y%m%d_%H%M%S')}"
         os.makedirs(self.session_folder, exist_ok=True)
+        metadata_path = write_metadata(self.session_folder, 'realsense', CONFIG, DEFAULTS)
+        changed = {name: value for name, value in CONFIG.items() if value != DEFAULTS[name]}
+        logging.info(f"Settings saved in {metadata_path}" + (f", changed from the defaults: {changed}" if changed else ""))
         self.gps_file = open(os.path.join(self.session_folder, 'gps_data.txt'), 'w')
         self.pointcloud_file = open(os.path.join(self.session_folder, 'pointcloud_data.npy'), 'wb')
         self.processed_file = open(os.path.join(self.session_folder, 'processed_data.txt'), 'w')
-        self.performance_file = open(os.path.join(self.session_folder, 'performance_data.txt'), 'w')
+        self.corrections_file = open(os.path.join(self.session_folder, 'corrections.txt'), 'w') if REGISTER_FRAMES else None
+        self.registration = FrameRegistration() if REGISTER_FRAMES else None
+        self.ground_file = open(os.path.join(self.session_folder, 'ground.txt'), 'w') if GROUND_METHOD else None
+        self.imu_file = open(os.path.join(self.session_folder, 'imu_data.txt'), 'w')
+        self.color_file = open(os.path.join(self.session_folder, 'color_data.npy'), 'wb') if COLOR_MODE == 'separate' else None
+        self.last_color = None
+        self.rays = None
+        self.color_map = None
+        # One RGB row per line of processed_data.txt
+        self.processed_colors_file = open(os.path.join(self.session_folder, 'processed_colors.bin'), 'wb') if COLOR_POINTS and COLOR_MODE else None
+        self.poses = PoseEstimator()
+        self.pool = None
+        if PROCESSING_WORKERS != 0:
+            # Created before the sockets and threads below, the workers are forked from a single threaded process
+            self.pool = FramePool(process_pointcloud, DEPTH_WIDTH * DEPTH_HEIGHT, PROCESSING_WORKERS,
+                                  sensor_height=SENSOR_HEIGHT, sensor_tilt=SENSOR_TILT,
+                                  sensor_orientation=SENSOR_ORIENTATION, angle_from_gps=ANGLE_FROM_GPS,
+                                  distance_from_gps=DISTANCE_FROM_GPS, max_distance=MAX_DISTANCE_FROM_SENSOR)
+            logging.info(f"Processing on {len(self.pool.processes)} worker processes.")
+        self.detector = ObstacleDetector(self.alert, parse_address(ALERT_ADDRESS), step_height=STEP_HEIGHT,
+                                         obstacle_height=OBSTACLE_HEIGHT, hole_depth=HOLE_DEPTH) if DETECT_OBSTACLES else None
+        self.stream = StreamPublisher(STREAM_PORT, STREAM_TRANSPORT).start() if STREAM_PORT is not None else None
+        self.imu_pipeline = None
+        self.latest_accel = None
         
-        self.latest_pointcloud = None
+        self.frames = FrameBuffer(FRAME_BUFFER_SIZE)
         self.latest_gps = None
         self.current_heading = 0
-        self.pointcloud_lock = threading.Lock()
         self.gps_lock = threading.Lock()
-        self.processing_queue = Queue()
+        self.processing_queue = BoundedQueue(QUEUE_SIZE, QUEUE_POLICY)
         
         self.gps_thread = threading.Thread(target=self.gps_loop)
         self.realsense_thread = threading.Thread(target=self.realsense_loop)
@@ -46,20 +134,33 @@ class DataRecorder:
         self.pipeline_started = False
         self.pipeline_lock = threading.Lock()
         self.processing_thread = threading.Thread(target=self.processing_loop)
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.in_flight = queue.Queue()
         
         self.stop_event = threading.Event()
 
-        # Performance monitoring
-        self.total_processing_time = 0
-        self.total_processed_frames = 0
-        self.min_processing_time = float('inf')
-        self.max_processing_time = 0
+        self.metrics = Metrics()
+        self.metrics.gauge('processing_queue', self.processing_queue.qsize)
+        self.metrics.gauge('color_mode', COLOR_MODE)
+        self.metrics.gauge('dropped_fixes', lambda: self.processing_queue.dropped)
+        self.metrics.gauge('merged_fixes', lambda: self.processing_queue.merged)
+        self.metrics.gauge('gps_blocked_seconds', lambda: round(self.processing_queue.blocked_time, 3))
+        if self.stream:
+            self.metrics.gauge('stream', self.stream.stats)
+        if self.pool:
+            self.metrics.gauge('frames_in_flight', self.pool.in_flight)
+        if self.registration:
+            self.metrics.gauge('rejected_registrations', lambda: self.registration.rejected)
+        self.stop_reporting = None
 
     def start(self):
         try:
             self.gps_thread.start()
             self.realsense_thread.start()
             self.processing_thread.start()
+            if self.pool:
+                self.writer_thread.start()
+            self.stop_reporting = start_reporting(self.metrics, self.session_folder, METRICS_PORT, METRICS_INTERVAL)
             logging.info("All threads started successfully.")
         except Exception as e:
             logging.error(f"Error starting threads: {str(e)}")
@@ -67,7 +168,8 @@ class DataRecorder:
 
     def stop(self):
         self.stop_event.set()
-        for thread in [self.gps_thread, self.realsense_thread, self.processing_thread]:
+        self.processing_queue.close()
+        for thread in [self.gps_thread, self.realsense_thread, self.processing_thread, self.writer_thread]:
             if thread.is_alive():
                 thread.join()
         self.close()
@@ -90,12 +192,17 @@ class DataRecorder:
                         timestamp, lat, lon, heading = parsed_data
                         if heading is not None:
                             self.current_heading = heading
+                            self.poses.update_heading(timestamp, heading)
                         if lat is not None and lon is not None:
+                            self.poses.update_gnss(timestamp, lat, lon, *parse_fix_quality(line))
+                            if self.stream:
+                                self.stream.pose(self.start_time + timestamp, *to_utm(lat, lon), self.current_heading)
                             with self.gps_lock:
                                 self.latest_gps = (timestamp, lat, lon, self.current_heading)
                             self.gps_file.write(f"{timestamp},{lat},{lon},{self.current_heading}\n")
                             self.gps_file.flush()
-                            self.processing_queue.put(('gps', (timestamp, lat, lon, self.current_heading)))
+                            self.processing_queue.put((timestamp, lat, lon, self.current_heading))
+                            self.metrics.count('gps_fixes')
             except serial.SerialException as e:
                 logging.error(f"GPS read error: {str(e)}")
                 self.stop_event.set()
@@ -107,49 +214,156 @@ class DataRecorder:
         try:
             self.pipeline = rs.pipeline()
             config = rs.config()
-            config.enable_stream(rs.stream.depth, 1280, 720, rs.format.z16, 15)
-            config.enable_stream(rs.stream.color, 1280, 720, rs.format.bgr8, 15)
+            config.enable_stream(rs.stream.depth, DEPTH_WIDTH, DEPTH_HEIGHT, rs.format.z16, DEPTH_FPS)
+            if COLOR_MODE == 'aligned':
+                config.enable_stream(rs.stream.color, DEPTH_WIDTH, DEPTH_HEIGHT, rs.format.bgr8, DEPTH_FPS)
+            elif COLOR_MODE == 'separate':
+                config.enable_stream(rs.stream.color, COLOR_WIDTH, COLOR_HEIGHT, rs.format.bgr8, COLOR_FPS)
+            elif COLOR_MODE is not None:
+                raise ValueError(f"COLOR_MODE should be None, 'separate' or 'aligned', not {COLOR_MODE!r}")
             
             with self.pipeline_lock:
                 self.pipeline.start(config)
                 self.pipeline_started = True
             
-            self.align = rs.align(rs.stream.color)
+            # Without alignment the points are projected with the depth intrinsics, in the depth camera's frame
+            self.align = rs.align(rs.stream.color) if COLOR_MODE == 'aligned' else None
+            self.filters = FilterChain(rs, DEPTH_FILTERS, {
+                'decimation': {'filter_magnitude': DECIMATION_MAGNITUDE},
+                'threshold': {'min_distance': MIN_DISTANCE_FROM_SENSOR, 'max_distance': MAX_DISTANCE_FROM_SENSOR},
+                'spatial': {'filter_magnitude': SPATIAL_MAGNITUDE, 'filter_smooth_alpha': SPATIAL_ALPHA,
+                            'filter_smooth_delta': SPATIAL_DELTA},
+                'temporal': {'filter_smooth_alpha': TEMPORAL_ALPHA, 'filter_smooth_delta': TEMPORAL_DELTA},
+                'hole_filling': {'holes_fill': HOLE_FILLING}})
+            if DEPTH_FILTERS:
+                logging.info(f"Depth filters: {', '.join(DEPTH_FILTERS)}")
             
             logging.info("RealSense camera initialized successfully.")
-        except rs.error as e:
+            if IMU_ENABLED:
+                self.start_imu()
+        except (rs.error, ValueError) as e:
             logging.error(f"Failed to initialize RealSense camera: {str(e)}")
             self.stop_event.set()
             return
 
         try:
             while not self.stop_event.is_set():
-                frames = self.pipeline.wait_for_frames()
-                aligned_frames = self.align.process(frames)
-                
-                depth_frame = aligned_frames.get_depth_frame()
-                color_frame = aligned_frames.get_color_frame()
+                with self.metrics.stage('acquire'):
+                    frames = self.pipeline.wait_for_frames()
+                    timestamp = time.time() - self.start_time
+                if self.align:
+                    with self.metrics.stage('align'):
+                        frames = self.align.process(frames)
                 
-                if not depth_frame or not color_frame:
+                depth_frame = frames.get_depth_frame()
+                if not depth_frame or (self.align and not frames.get_color_frame()):
+                    self.metrics.count('incomplete_frames')
                     continue
+                if self.color_file:
+                    self.record_color(timestamp, frames.get_color_frame())
                 
-                pc = rs.pointcloud()
-                pc.map_to(color_frame)
-                points = pc.calculate(depth_frame)
+                with self.metrics.stage('filter'):
+                    # After the alignment, aligning a decimated frame would upsample it back
+                    depth_frame = self.filters.process(depth_frame, self.metrics.count)
+
+                with self.metrics.stage('decode'):
+                    pointcloud = self.project_depth(depth_frame)
+                colors = None
+                if self.processed_colors_file:
+                    with self.metrics.stage('colorize'):
+                        colors = self.point_colors(depth_frame, frames.get_color_frame(), pointcloud)
                 
-                vtx = np.asanyarray(points.get_vertices())
-                pointcloud = np.array([(v[0], v[1], v[2]) for v in vtx])
-                
-                with self.pointcloud_lock:
-                    self.latest_pointcloud = pointcloud
+                self.frames.add(timestamp, (pointcloud, colors))
+                self.metrics.count('frames')
+                if self.imu_pipeline and self.poses.initialized and self.poses.fix_age(timestamp) > FIX_TIMEOUT:
+                    # No fix to trigger the processing, the frame goes on its own with the IMU pose
+                    self.processing_queue.put((timestamp, None, None, None))
+                    self.metrics.count('dead_reckoned_frames')
                                 
         except rs.error as e:
             logging.error(f"RealSense camera error: {str(e)}")
         finally:
             self.stop_pipeline()
 
+    def project_depth(self, depth_frame):
+        '''Camera frame points of the depth frame within range and DEPTH_ROI'''
+        depth = depth_frame.get_data()
+        if depth is None:
+            # Frames replayed from points have no depth image
+            return extract_vertices(np.asanyarray(rs.pointcloud().calculate(depth_frame).get_vertices()))
+        intrinsics = depth_frame.get_profile().as_video_stream_profile().get_intrinsics()
+        depth_scale = depth_frame.get_units()
+        if self.rays is None or self.rays.key != RayTable.key_of(intrinsics, depth_scale):
+            self.rays = RayTable(intrinsics, depth_scale, MIN_DISTANCE_FROM_SENSOR, MAX_DISTANCE_FROM_SENSOR, DEPTH_ROI)
+        return self.rays.project(np.asanyarray(depth))
+
+    def point_colors(self, depth_frame, color_frame, pointcloud):
+        '''uint8 RGB of the points of a depth frame, None without a color image'''
+        image = color_frame.get_data() if color_frame else None
+        if image is None:
+            self.metrics.count('uncolored_frames')
+            return None
+        intrinsics = color_frame.get_profile().as_video_stream_profile().get_intrinsics()
+        # Aligned depth is already in the color camera's frame
+        extrinsics = None if self.align else depth_frame.get_profile().get_extrinsics_to(color_frame.get_profile())
+        if self.color_map is None or self.color_map.key != ColorMap.key_of(intrinsics, extrinsics):
+            self.color_map = ColorMap(intrinsics, extrinsics)
+        return self.color_map.colors(pointcloud, np.asanyarray(image))
+
+    def record_color(self, timestamp, color_frame):
+        if not color_frame or (self.last_color is not None and timestamp - self.last_color < COLOR_INTERVAL):
+            return
+        image = color_frame.get_data()
+        if image is None:
+            return
+        with self.metrics.stage('write_color'):
+            np.save(self.color_file, {'timestamp': timestamp, 'frame_timestamp': color_frame.get_timestamp(),
+                                      'image': np.array(image)})
+        self.last_color = timestamp
+        self.metrics.count('color_frames')
+
+    def start_imu(self):
+        try:
+            self.imu_pipeline = rs.pipeline()
+            config = rs.config()
+            config.enable_stream(rs.stream.accel, rs.format.motion_xyz32f, ACCEL_RATE)
+            config.enable_stream(rs.stream.gyro, rs.format.motion_xyz32f, GYRO_RATE)
+            self.imu_pipeline.start(config, self.imu_callback)
+            logging.info("RealSense IMU started.")
+        except rs.error as e:
+            self.imu_pipeline = None
+            logging.warning(f"No RealSense IMU, poses come from the GPS alone: {str(e)}")
+
+    def imu_callback(self, frame):
+        motion = frame.as_motion_frame()
+        data = motion.get_motion_data()
+        if motion.get_profile().stream_type() == rs.stream.accel:
+            self.latest_accel = (data.x, data.y, data.z)
+            return
+        if self.latest_accel is None:
+            return
+        # Each gyro sample is paired with the latest accel sample
+        timestamp = time.time() - self.start_time
+        gyro = (data.x, data.y, data.z)
+        self.poses.update_imu(timestamp, self.latest_accel, gyro)
+        self.imu_file.write(f"{timestamp},{self.latest_accel[0]},{self.latest_accel[1]},{self.latest_accel[2]},{gyro[0]},{gyro[1]},{gyro[2]}\n")
+        self.metrics.count('imu_samples')
+
+    def frame_pose(self, timestamp):
+        '''(lat, lon, heading) of the filtered pose at a frame's timestamp, None when the last fix is too old'''
+        max_age = MAX_DEAD_RECKONING if self.imu_pipeline else FIX_TIMEOUT
+        if not self.poses.initialized or self.poses.fix_age(timestamp) > max_age:
+            return None
+        return self.poses.latlon_at(timestamp)
+
     def stop_pipeline(self):
         with self.pipeline_lock:
+            if self.imu_pipeline:
+                try:
+                    self.imu_pipeline.stop()
+                except Exception as e:
+                    logging.error(f"Error stopping RealSense IMU: {str(e)}")
+                self.imu_pipeline = None
             if self.pipeline and self.pipeline_started:
                 try:
                     self.pipeline.stop()
@@ -161,24 +375,37 @@ class DataRecorder:
     def processing_loop(self):
         while not self.stop_event.is_set():
             try:
-                item = self.processing_queue.get(timeout=1)
-                if item[0] == 'gps':
-                    process_start_time = time.time()
-                    timestamp, lat, lon, heading = item[1]
-                    with self.pointcloud_lock:
-                        if self.latest_pointcloud is not None:
-                            np.save(self.pointcloud_file, {'timestamp': timestamp, 'points': self.latest_pointcloud})
-                            self.pointcloud_file.flush()
-                            processed_points = self.process_pointcloud(self.latest_pointcloud, (lat, lon, heading))
-                            for point in processed_points:
-                                self.processed_file.write(f"{timestamp},{point[0]},{point[1]},{point[2]}\n")
-                            self.processed_file.flush()
-                            process_end_time = time.time()
-                            processing_time = process_end_time - process_start_time
-                            total_time = process_end_time - timestamp
-                            self.log_performance(timestamp, processing_time, total_time)
-                            logging.info(f"Processed and saved data for timestamp {timestamp}")
-                self.processing_queue.task_done()
+                timestamp, lat, lon, heading = self.processing_queue.get(timeout=1)
+                process_start_time = time.perf_counter()
+                frame = self.frames.nearest(timestamp, MAX_FRAME_OFFSET, FRAME_WAIT)
+                if frame is None:
+                    self.metrics.count('unpaired_fixes')
+                    continue
+                frame_timestamp, (pointcloud, colors) = frame
+                pose = self.frame_pose(frame_timestamp)
+                if pose is not None:
+                    lat, lon, heading = pose
+                elif lat is None:
+                    self.metrics.count('stale_frames')
+                    continue
+                self.metrics.record('frame_offset', abs(frame_timestamp - timestamp))
+                with self.metrics.stage('write_raw'):
+                    entry = {'timestamp': timestamp, 'frame_timestamp': frame_timestamp, 'points': pointcloud}
+                    if colors is not None:
+                        entry['colors'] = colors
+                    np.save(self.pointcloud_file, entry)
+                    self.pointcloud_file.flush()
+                if self.pool:
+                    # Waits for a free slot, the bounded queue absorbs the fixes arriving meanwhile
+                    with self.metrics.stage('submit'):
+                        while not self.pool.submit(pointcloud, lat, lon, heading, timeout=1, colors=colors):
+                            if self.stop_event.is_set():
+                                break
+                        else:
+                            self.in_flight.put((timestamp, lat, lon, process_start_time))
+                    continue
+                processed = self.process_pointcloud(pointcloud, (lat, lon, heading), colors)
+                self.write_processed(timestamp, lat, lon, processed, process_start_time)
             except queue.Empty:
                 continue
             except Exception as e:
@@ -186,102 +413,159 @@ class DataRecorder:
                 if self.stop_event.is_set():
                     break
 
+    def writer_loop(self):
+        # Drains the frames still in the workers once the processing loop has stopped
+        while self.processing_thread.is_alive() or not self.in_flight.empty():
+            try:
+                timestamp, lat, lon, process_start_time = self.in_flight.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                processed, seconds = self.pool.get()
+                self.metrics.record('worker', seconds)
+                self.write_processed(timestamp, lat, lon, processed, process_start_time)
+            except Exception as e:
+                logging.error(f"Error processing frame for timestamp {timestamp}: {str(e)}")
+
+    def write_processed(self, timestamp, lat, lon, processed, process_start_time):
+        '''processed is the points of a frame, or (points, colors) for a colored frame'''
+        processed_points, colors = processed if isinstance(processed, tuple) else (processed, None)
+        if GROUND_METHOD and len(processed_points):
+            with self.metrics.stage('ground'):
+                processed_points = self.level_frame(timestamp, lat, lon, processed_points)
+        if self.registration and len(processed_points):
+            with self.metrics.stage('registration'):
+                processed_points = self.register_frame(timestamp, lat, lon, processed_points)
+        if self.detector and len(processed_points):
+            with self.metrics.stage('detect'):
+                self.detector.update(processed_points[:, 0], processed_points[:, 1], processed_points[:, 2],
+                                     self.start_time + timestamp)
+        if self.stream and len(processed_points):
+            with self.metrics.stage('stream'):
+                self.stream.points(self.start_time + timestamp, processed_points)
+        with self.metrics.stage('write'):
+            write_points(self.processed_file, timestamp, processed_points)
+            self.processed_file.flush()
+            if self.processed_colors_file:
+                # Frames without a color image stay black so the rows follow processed_data.txt
+                if colors is None:
+                    colors = np.zeros((len(processed_points), 3), dtype=np.uint8)
+                self.processed_colors_file.write(np.ascontiguousarray(colors, dtype=np.uint8).tobytes())
+                self.processed_colors_file.flush()
+        self.metrics.record('processing', time.perf_counter() - process_start_time)
+        # Timestamps are relative to the start of the session
+        self.metrics.record('end_to_end', time.time() - self.start_time - timestamp)
+        self.metrics.count('processed_frames')
+        self.metrics.count('processed_points', len(processed_points))
+        logging.info(f"Processed and saved data for timestamp {timestamp}")
+
+    def alert(self, alert):
+        latency = alert.detected - alert.measured
+        self.metrics.record('alert_latency', latency)
+        self.metrics.count(f'{alert.kind}_alerts')
+        logging.warning(f"{alert.kind.capitalize()} at {alert.easting:.1f}, {alert.northing:.1f}: height "
+                        f"{alert.height * 1000:.0f} mm, {alert.difference * 1000:.0f} mm from its neighbours, "
+                        f"{latency * 1000:.1f} ms after its frame")
+
+    def level_frame(self, timestamp, lat, lon, points):
+        easting, northing = to_utm(lat, lon)
+        local = points - np.array([easting, northing, 0.0])
+        plane, inliers = segment_ground(local, GROUND_METHOD)
+        if plane is None:
+            self.metrics.count('frames_without_ground')
+            return points
+        # The ground below the GPS position is the zero of the heights, whatever the actual sensor height
+        offset = ground_height(plane)
+        self.ground_file.write(f"{timestamp},{plane[0]:.6f},{plane[1]:.6f},{plane[2]:.6f},{plane[3]:.5f},"
+                               f"{inliers.mean():.3f},{offset:.4f},{plane_tilt(plane):.2f}\n")
+        self.ground_file.flush()
+        leveled = points.copy()
+        leveled[:, 2] -= offset
+        return leveled
+
+    def register_frame(self, timestamp, lat, lon, points):
+        easting, northing = to_utm(lat, lon)
+        correction, rmse, fitness = self.registration.update(points, easting, northing)
+        # Rows of the 3x4 correction relative to the GPS position, see processing.georeference_pointcloud
+        self.corrections_file.write(f"{timestamp},{fitness:.3f},{rmse:.5f}," + ','.join(f"{v:.6f}" for v in correction[:3].ravel()) + "\n")
+        self.corrections_file.flush()
+        origin = np.array([easting, northing, 0.0])
+        return transform_points(points - origin, correction) + origin
+
     def parse_nmea_data(self, data):
-        data = data.strip().split(',')
-        data_type = data[0][1:]
+        timestamp = time.time() - self.start_time
+        try:
+            data_type, value = parse_nmea(data)
+        except (ValueError, IndexError):
+            logging.warning(f"Invalid NMEA data: {data.strip()}")
+            return None
 
         if data_type == "GNGGA":
-            try:
-                timestamp = time.time() - self.start_time
-                lat = float(data[2][:2]) + float(data[2][2:]) / 60
-                if data[3] == 'S':
-                    lat = -lat
-                lon = float(data[4][:3]) + float(data[4][3:]) / 60
-                if data[5] == 'W':
-                    lon = -lon
-                return timestamp, lat, lon, None
-            except (ValueError, IndexError):
-                logging.warning(f"Invalid GNGGA data: {data}")
-                return None
+            lat, lon = value
+            return timestamp, lat, lon, None
         elif data_type == "GNRMC":
-            try:
-                timestamp = time.time() - self.start_time
-                heading = float(data[8]) if data[8] else None
-                return timestamp, None, None, heading
-            except (ValueError, IndexError):
-                logging.warning(f"Invalid GNRMC data: {data}")
-                return None
+            return timestamp, None, None, value
 
         return None
 
-    def process_pointcloud(self, pointcloud, gps_data):
-        voxel_size = 0.05  # 5cm voxel size
-        voxel_grid = {}
-        for point in pointcloud:
-            voxel_key = tuple(np.floor(point / voxel_size).astype(int))
-            if voxel_key not in voxel_grid or point[2] < voxel_grid[voxel_key][2]:
-                voxel_grid[voxel_key] = point
-        downsampled_pointcloud = np.array(list(voxel_grid.values()))
-
+    def process_pointcloud(self, pointcloud, gps_data, colors=None):
         lat, lon, heading = gps_data
-        easting, northing, _, _ = utm.from_latlon(lat, lon)
-
-        R_tilt = Rotation.from_euler('x', SENSOR_TILT-90, degrees=True).as_matrix()
-        R_orientation = Rotation.from_euler('z', SENSOR_ORIENTATION + heading, degrees=True).as_matrix()
-        R = R_orientation @ R_tilt
-
-        transformed_points = (R @ downsampled_pointcloud.T).T
-        transformed_points[:, 0] += DISTANCE_FROM_GPS * np.sin(np.radians(ANGLE_FROM_GPS + heading))
-        transformed_points[:, 1] += DISTANCE_FROM_GPS * np.cos(np.radians(ANGLE_FROM_GPS + heading))
-        transformed_points[:, 2] += SENSOR_HEIGHT
-
-        distances = np.linalg.norm(transformed_points, axis=1)
-        transformed_points = transformed_points[distances <= MAX_DISTANCE_FROM_SENSOR]
-
-        transformed_points[:, 0] += easting
-        transformed_points[:, 1] += northing
-
-        return transformed_points
-
-    def log_performance(self, timestamp, processing_time, total_time):
-        self.total_processing_time += processing_time
-        self.total_processed_frames += 1
-        self.min_processing_time = min(self.min_processing_time, processing_time)
-        self.max_processing_time = max(self.max_processing_time, processing_time)
-        
-        avg_processing_time = self.total_processing_time / self.total_processed_frames
-        
-        performance_log = (f"Timestamp: {timestamp:.3f}, "
-                           f"Processing Time: {processing_time:.3f}s, "
-                           f"Total Time: {total_time:.3f}s, "
-                           f"Avg Processing Time: {avg_processing_time:.3f}s, "
-                           f"Min Processing Time: {self.min_processing_time:.3f}s, "
-                           f"Max Processing Time: {self.max_processing_time:.3f}s\n")
-        
-        self.performance_file.write(performance_log)
-        self.performance_file.flush()
-        
-        logging.debug(performance_log.strip())
+        with self.metrics.stage('downsample'):
+            pointcloud, kept = voxel_downsample(pointcloud, return_index=True)
+        with self.metrics.stage('georeference'):
+            return georeference_pointcloud(pointcloud, lat, lon, heading, SENSOR_HEIGHT, SENSOR_TILT, SENSOR_ORIENTATION,
+                                           ANGLE_FROM_GPS, DISTANCE_FROM_GPS, MAX_DISTANCE_FROM_SENSOR,
+                                           colors=None if colors is None else colors[kept])
 
     def close(self):
         logging.info("Closing connections and files...")
+        if self.stop_reporting:
+            self.stop_reporting()
+        snapshot = self.metrics.snapshot()
+        logging.info(f"Stage latencies: {snapshot['stages']}")
+        frames = snapshot['counters'].get('frames')
+        if frames:
+            pixels = {name: round(value / frames) for name, value in snapshot['counters'].items() if name.startswith('depth_pixels')}
+            logging.info(f"Valid depth pixels per frame: {pixels}")
+            uptime = time.time() - self.metrics.start_time
+            logging.info(f"{frames} frames in {uptime:.0f}s ({frames / uptime:.1f} fps), recorder process at "
+                         f"{sum(os.times()[:2]) / uptime:.0%} CPU, COLOR_MODE {COLOR_MODE!r}")
         self.stop_pipeline()
+        if self.pool:
+            self.pool.close()
         self.gps_file.close()
         self.pointcloud_file.close()
         self.processed_file.close()
-        self.performance_file.close()
+        self.imu_file.close()
+        if self.color_file:
+            self.color_file.close()
+        if self.processed_colors_file:
+            self.processed_colors_file.close()
+        if self.detector:
+            self.detector.close()
+        if self.stream:
+            self.stream.close()
+        if self.corrections_file:
+            self.corrections_file.close()
+        if self.ground_file:
+            self.ground_file.close()
         logging.info("All connections and files closed.")
 
 def plot_data(data_folder):
     logging.info("Plotting data...")
     try:
-        processed_data = np.loadtxt(os.path.join(data_folder, 'processed_data.txt'), delimiter=',')
+        processed_data = load_text(os.path.join(data_folder, 'processed_data.txt'))
 
         if processed_data.size == 0 or processed_data.ndim == 1:
             logging.warning("Insufficient data for plotting.")
             return
 
         timestamps, x, y, z = processed_data[:, 0], processed_data[:, 1], processed_data[:, 2], processed_data[:, 3]
+        colors_path = os.path.join(data_folder, 'processed_colors.bin')
+        colors = load_colors(colors_path) if os.path.isfile(colors_path) else None
+        if colors is not None and len(colors) != len(processed_data):
+            logging.warning(f"{colors_path} has {len(colors)} colors for {len(processed_data)} points, plotting elevations")
+            colors = None
 
         x_rel = x - np.min(x)
         y_rel = y - np.min(y)
@@ -291,13 +575,7 @@ def plot_data(data_folder):
             y=y_rel,
             z=z,
             mode='markers',
-            marker=dict(
-                size=3,
-                color=z,
-                colorscale='Viridis',
-                opacity=1,
-                colorbar=dict(title='Elevation (m)')
-            )
+            marker=point_marker(z, colors, 3, 'Viridis', 'Elevation (m)')
         )])
 
         fig_3d.update_layout(
@@ -316,13 +594,7 @@ def plot_data(data_folder):
             x=x_rel,
             y=y_rel,
             mode='markers',
-            marker=dict(
-                size=3,
-                color=z,
-                colorscale='Viridis',
-                opacity=1,
-                colorbar=dict(title='Elevation (m)')
-            )
+            marker=point_marker(z, colors, 3, 'Viridis', 'Elevation (m)')
         )])
 
         fig_2d.update_layout(
@@ -332,6 +604,8 @@ def plot_data(data_folder):
         )
 
         fig_2d.write_html(os.path.join(data_folder, '2d_pointcloud.html'))
+        if colors is not None:
+            save_as_ply(os.path.join(data_folder, 'point_cloud.ply'), x_rel, y_rel, z, colors)
 
         logging.info(f"Plots saved in {data_folder}")
     except Exception as e:
@@ -350,6 +624,7 @@ def main():
                 logging.error(f"Error during recording: {str(e)}")
             finally:
                 recorder.stop()
+            add_session(recorder.session_folder)
             
             if os.path.exists(recorder.session_folder) and os.path.getsize(os.path.join(recorder.session_folder, 'processed_data.txt')) > 0:
                 plot_data(recorder.session_folder)
@@ -357,8 +632,8 @@ def main():
                 logging.warning("No data was recorded or the data file is empty. Unable to generate plots.")
 
         elif key == 'P':
-            folder = input("Enter the path to the data folder: ")
-            if os.path.exists(folder):
+            folder = choose_session(profile='realsense')
+            if folder:
                 plot_data(folder)
             else:
                 logging.error("Invalid folder path.")
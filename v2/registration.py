@@ -0,0 +1,154 @@
+'''Point-to-plane ICP refining the GPS and heading alignment of point clouds, coarse to fine on voxel-filtered clouds'''
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.transform import Rotation
+
+VOXEL_SIZES = (0.2, 0.1, 0.05)  # meters, coarse to fine
+CORRESPONDENCE_FACTOR = 3  # max correspondence distance in voxel sizes
+ITERATIONS = 15  # per level
+TOLERANCE = 1e-5  # meters or radians of update below which a level stops
+NORMAL_NEIGHBORS = 10
+MIN_CORRESPONDENCES = 50
+MIN_FITNESS = 0.3  # share of source points with a correspondence for a registration to be trusted
+MAX_CORRECTION = 0.5  # meters, larger corrections are rejected as a wrong fit
+MAX_CORRECTION_ANGLE = 10  # Degrees
+MIN_CONSTRAINT = 0.005  # share of the strongest constraint below which a direction of the pose is left as it is
+
+
+def voxel_filter(points, voxel_size):
+    '''Centroid of the points in each voxel'''
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) == 0:
+        return points.reshape(0, 3)
+    keys = np.floor(points / voxel_size).astype(np.int64)
+    keys -= keys.min(axis=0)
+    dims = keys.max(axis=0) + 1
+    flat = (keys[:, 0] * dims[1] + keys[:, 1]) * dims[2] + keys[:, 2]
+    _, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+    centroids = np.empty((len(counts), 3))
+    for axis in range(3):
+        centroids[:, axis] = np.bincount(inverse, weights=points[:, axis]) / counts
+    return centroids
+
+
+def estimate_normals(points, tree=None, neighbors=NORMAL_NEIGHBORS):
+    '''Unit normals from the smallest eigenvector of each point's neighborhood covariance'''
+    if tree is None:
+        tree = cKDTree(points)
+    neighbors = min(neighbors, len(points))
+    _, indices = tree.query(points, k=neighbors)
+    neighborhoods = points[indices.reshape(len(points), -1)]
+    centered = neighborhoods - neighborhoods.mean(axis=1, keepdims=True)
+    covariances = np.einsum('nki,nkj->nij', centered, centered)
+    _, eigenvectors = np.linalg.eigh(covariances)
+    return eigenvectors[:, :, 0]
+
+
+def pose_matrix(x=0, y=0, z=0, heading=0):
+    '''4x4 transform of a rotation of heading degrees about z followed by a translation'''
+    transform = np.eye(4)
+    transform[:3, :3] = Rotation.from_euler('z', heading, degrees=True).as_matrix()
+    transform[:3, 3] = x, y, z
+    return transform
+
+
+def transform_points(points, transform):
+    return points @ transform[:3, :3].T + transform[:3, 3]
+
+
+def solve_constrained(A, residuals, min_constraint=MIN_CONSTRAINT):
+    '''Least squares update of A x = -residuals restricted to the directions the geometry constrains: flat ground
+    leaves x, y and yaw free, where a plain solve would fit the noise of the normals, those are left at 0'''
+    eigenvalues, eigenvectors = np.linalg.eigh(A.T @ A)
+    constrained = eigenvalues > min_constraint * eigenvalues[-1]
+    basis = eigenvectors[:, constrained]
+    return basis @ ((basis.T @ -A.T @ residuals) / eigenvalues[constrained])
+
+
+def icp_point_to_plane(source, target, initial=None, max_distance=0.15, iterations=ITERATIONS, tolerance=TOLERANCE,
+                       target_tree=None, target_normals=None):
+    '''Transform aligning source onto target, minimizing point to plane distances.
+    Returns (transform, rmse, fitness), fitness being the share of source points with a correspondence.'''
+    transform = np.eye(4) if initial is None else np.array(initial, dtype=np.float64)
+    if target_tree is None:
+        target_tree = cKDTree(target)
+    if target_normals is None:
+        target_normals = estimate_normals(target, target_tree)
+
+    rmse, fitness = np.inf, 0.0
+    for _ in range(iterations):
+        moved = transform_points(source, transform)
+        distances, indices = target_tree.query(moved, distance_upper_bound=max_distance)
+        matched = np.isfinite(distances)
+        fitness = matched.mean() if len(source) else 0.0
+        if matched.sum() < MIN_CORRESPONDENCES:
+            break
+        p = moved[matched]
+        q = target[indices[matched]]
+        n = target_normals[indices[matched]]
+        residuals = np.einsum('ij,ij->i', p - q, n)
+        rmse = np.sqrt(np.mean(residuals**2))
+
+        # Linearized about the current pose, x = (rotation vector about the centroid, translation), the rotation
+        # scaled by the spread of the points so both are in meters and their constraints can be compared
+        center = p.mean(axis=0)
+        spread = max(np.sqrt(np.mean(np.sum((p - center)**2, axis=1))), 1e-6)
+        A = np.hstack([np.cross(p - center, n) / spread, n])
+        x = solve_constrained(A, residuals)
+        x[:3] /= spread
+        rotation = Rotation.from_rotvec(x[:3]).as_matrix()
+        update = np.eye(4)
+        update[:3, :3] = rotation
+        update[:3, 3] = x[3:] + center - rotation @ center
+        transform = update @ transform
+        if np.abs(x).max() < tolerance:
+            break
+    return transform, rmse, fitness
+
+
+def register(source, target, initial=None, voxel_sizes=VOXEL_SIZES, iterations=ITERATIONS):
+    '''Coarse to fine point to plane ICP, each level seeded with the previous one's transform'''
+    transform = np.eye(4) if initial is None else initial
+    rmse, fitness = np.inf, 0.0
+    for voxel_size in voxel_sizes:
+        source_level = voxel_filter(source, voxel_size)
+        target_level = voxel_filter(target, voxel_size)
+        if len(source_level) < MIN_CORRESPONDENCES or len(target_level) < MIN_CORRESPONDENCES:
+            continue
+        transform, rmse, fitness = icp_point_to_plane(source_level, target_level, transform,
+                                                      CORRESPONDENCE_FACTOR * voxel_size, iterations)
+    return transform, rmse, fitness
+
+
+def is_plausible(correction, fitness, max_translation=MAX_CORRECTION, max_angle=MAX_CORRECTION_ANGLE):
+    angle = np.degrees(np.linalg.norm(Rotation.from_matrix(correction[:3, :3]).as_rotvec()))
+    return fitness >= MIN_FITNESS and np.linalg.norm(correction[:3, 3]) <= max_translation and angle <= max_angle
+
+
+class FrameRegistration:
+    '''Registers each georeferenced frame onto the previous one and returns the pose correction to apply.
+    Frames are handled relative to their GPS position (easting, northing) to keep the arithmetic precise, the
+    correction is a 4x4 transform in that local frame, as taken by processing.georeference_pointcloud.'''
+    def __init__(self, voxel_sizes=VOXEL_SIZES, iterations=ITERATIONS):
+        self.voxel_sizes = voxel_sizes
+        self.iterations = iterations
+        self.previous = None
+        self.previous_origin = None
+        self.rejected = 0
+
+    def update(self, points, easting, northing):
+        '''Returns (correction, rmse, fitness), the identity when there is no previous frame or the fit is implausible'''
+        origin = np.array([easting, northing, 0.0])
+        local = np.asarray(points, dtype=np.float64) - origin
+        correction, rmse, fitness = np.eye(4), np.inf, 0.0
+        if self.previous is not None and len(local):
+            target = self.previous + (self.previous_origin - origin)
+            transform, rmse, fitness = register(local, target, None, self.voxel_sizes, self.iterations)
+            if is_plausible(transform, fitness):
+                correction = transform
+            else:
+                self.rejected += 1
+        # Later frames are registered onto the corrected cloud, finest level only to keep the memory down
+        self.previous = voxel_filter(transform_points(local, correction), self.voxel_sizes[-1])
+        self.previous_origin = origin
+        return correction, rmse, fitness
@@ -0,0 +1,1001 @@
+#!/usr/bin/env python3
+'''Replays recorded sessions through the same interfaces as serial.Serial, RPLidar and the RealSense pipeline
+
+    python replay.py --speed 0 --gps COM4=dump/run0/gps_data.txt --lidar COM3=dump/run0/lidar_data.txt --input R main.py
+    python replay.py --speed 0 --session data_20240716_171504 --input R main.py
+'''
+import os
+import sys
+import time
+import types
+import runpy
+import threading
+import argparse
+import datetime
+import _thread
+import numpy as np
+
+from config import ENV_PREFIX, METADATA_FILE, read_metadata
+from cloud_io import iter_npy_frames
+
+REALTIME = 1.0
+AS_FAST_AS_POSSIBLE = 0
+FRAME_TIMEOUT = 5  # seconds, same as rs.pipeline.wait_for_frames
+BASE_DATE = datetime.datetime(2024, 7, 16, 17, 15, 4)
+MOTION_STREAMS = ('accel', 'gyro')
+INTERRUPT_GRACE = 2.0  # seconds after the end of the replay a script still polling the ports gets its Ctrl+C
+POLL_WINDOW = 0.5  # seconds, a script that read a port this recently is still polling
+LIDAR_BATCH = 0.01  # seconds of recorded lidar measures delivered at once by ReplayLidarDriver
+VERTEX_DTYPE = np.dtype([('f0', '<f4'), ('f1', '<f4'), ('f2', '<f4')])
+
+_real_time = time.time
+
+
+class ReplayClock:
+    def __init__(self, speed=REALTIME, start=0.0):
+        self.speed = speed
+        self.start = start
+        self.epoch = _real_time() - start
+        self._now = start
+        self._wall_start = None
+        self._blocking = 0
+        self._active = 0
+        self._condition = threading.Condition()
+        self.finished = threading.Event()
+        self.last_poll = None
+
+    def now(self):
+        if self.speed > 0:
+            if self._wall_start is None:
+                self._wall_start = time.perf_counter()
+            return self.start + (time.perf_counter() - self._wall_start) * self.speed
+        return self._now
+
+    def time(self):
+        return self.epoch + self.now()
+
+    def register(self, blocking):
+        '''Adds a stream to the replay, the returned callable marks it as exhausted'''
+        with self._condition:
+            self._active += 1
+            if blocking:
+                self._blocking += 1
+        done = threading.Event()
+
+        def finish():
+            with self._condition:
+                if done.is_set():
+                    return
+                done.set()
+                self._active -= 1
+                if blocking:
+                    self._blocking -= 1
+                self._condition.notify_all()
+                if self._active == 0:
+                    self.finished.set()
+        return finish
+
+    def wait_until(self, t, blocking=True, timeout=None):
+        # Blocking devices (lidar, camera) drive the clock when replaying as fast as possible,
+        # polled serial ports only advance it on their own once no blocking device is left.
+        if self.speed > 0:
+            delay = (t - self.now()) / self.speed
+            if timeout is not None and delay > timeout:
+                time.sleep(timeout)
+                return False
+            if delay > 0:
+                time.sleep(delay)
+            return True
+
+        with self._condition:
+            if not blocking and self._blocking > 0:
+                self._condition.wait_for(lambda: self._now >= t or self._blocking == 0, timeout)
+                if self._now < t and self._blocking > 0:
+                    return False
+            if t > self._now:
+                self._now = t
+                self._condition.notify_all()
+            return True
+
+
+class ReplaySerial:
+    def __init__(self, records, clock, port=None, baudrate=9600, timeout=None, finish=None):
+        self.records = records
+        self.clock = clock
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self.index = 0
+        self.buffer = bytearray()
+        self.bytes_delivered = 0
+        self.finish = finish or clock.register(blocking=False)
+
+    def _fill(self):
+        self.clock.last_poll = time.perf_counter()
+        now = self.clock.now()
+        while self.index < len(self.records) and self.records[self.index][0] <= now:
+            self.buffer += self.records[self.index][1]
+            self.index += 1
+
+    def _wait_next(self, timeout):
+        if self.index >= len(self.records):
+            return False
+        if not self.clock.wait_until(self.records[self.index][0], blocking=False, timeout=timeout):
+            return False
+        self._fill()
+        return True
+
+    def _check_exhausted(self):
+        if self.index >= len(self.records) and not self.buffer:
+            self.finish()
+
+    @property
+    def in_waiting(self):
+        self._fill()
+        if not self.buffer and self.clock.speed == AS_FAST_AS_POSSIBLE:
+            self._wait_next(0)
+        self._check_exhausted()
+        return len(self.buffer)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        self._fill()
+        while len(self.buffer) < size and self._wait_next(self.timeout):
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.bytes_delivered += len(data)
+        self._check_exhausted()
+        return data
+
+    def readline(self):
+        self._fill()
+        while b'\n' not in self.buffer and self._wait_next(self.timeout):
+            pass
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        self.bytes_delivered += len(line)
+        self._check_exhausted()
+        return line
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        self._fill()
+        self.buffer.clear()
+        self._check_exhausted()
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ReplayLidar:
+    def __init__(self, measures, clock, port=None, finish=None):
+        self.measures = measures
+        self.clock = clock
+        self.port = port
+        self.measures_delivered = 0
+        self.motor_running = True
+        self._finish = finish or clock.register(blocking=True)
+
+    def iter_measures(self, scan_type='normal', max_buf_meas=3000):
+        try:
+            for timestamp, new_scan, quality, angle, distance in self.measures:
+                self.clock.wait_until(timestamp)
+                self.measures_delivered += 1
+                yield new_scan, quality, angle, distance
+        finally:
+            self._finish()
+
+    def iter_scans(self, scan_type='normal', max_buf_meas=3000, min_len=5):
+        scan = []
+        for new_scan, quality, angle, distance in self.iter_measures(scan_type, max_buf_meas):
+            if new_scan and len(scan) > min_len:
+                yield scan
+                scan = []
+            if distance > 0:
+                scan.append((quality, angle, distance))
+
+    def get_info(self):
+        return {'model': 0, 'firmware': (0, 0), 'hardware': 0, 'serialnumber': 'replay'}
+
+    def get_health(self):
+        return 'Good', 0
+
+    def clear_input(self):
+        pass
+
+    def start_motor(self):
+        self.motor_running = True
+
+    def stop_motor(self):
+        self.motor_running = False
+
+    def stop(self):
+        pass
+
+    def disconnect(self):
+        self._finish()
+
+
+class ReplayLidarDriver(ReplayLidar):
+    '''Stand-in for lidar_driver.RPLidarDriver, the recorded measures come in batches as from its bulk reads'''
+    def iter_batches(self, scan_mode='express'):
+        from lidar_driver import MEASURE_DTYPE
+        try:
+            times = np.array([measure[0] for measure in self.measures])
+            # One batch per LIDAR_BATCH seconds of recorded measures, the driver reads a few capsules at a time
+            ends = np.flatnonzero(np.diff(np.floor(times / LIDAR_BATCH))) + 1 if len(times) else []
+            for batch in np.split(np.arange(len(times)), ends):
+                if not len(batch):
+                    continue
+                self.clock.wait_until(times[batch[-1]])
+                measures = np.empty(len(batch), dtype=MEASURE_DTYPE)
+                for field, column in zip(MEASURE_DTYPE.names, zip(*(self.measures[i] for i in batch))):
+                    measures[field] = column
+                measures['timestamp'] += self.clock.epoch
+                self.measures_delivered += len(batch)
+                yield measures
+        finally:
+            self._finish()
+
+    def iter_measures(self, scan_mode='express'):
+        for batch in self.iter_batches(scan_mode):
+            yield from zip(batch['new_scan'].tolist(), batch['quality'].tolist(), batch['angle'].tolist(),
+                           batch['distance'].tolist())
+
+    def iter_scans(self, scan_mode='express', min_len=5):
+        from lidar_driver import split_scans
+        return split_scans(self.iter_batches(scan_mode), min_len)
+
+
+class ReplayIntrinsics:
+    def __init__(self, width, height, fx, fy, ppx, ppy):
+        self.width = width
+        self.height = height
+        self.fx = fx
+        self.fy = fy
+        self.ppx = ppx
+        self.ppy = ppy
+        self.coeffs = [0, 0, 0, 0, 0]
+
+
+class ReplayMotionFrame:
+    def __init__(self, stream, timestamp, values):
+        self.stream = stream
+        self.timestamp = timestamp
+        self.values = values
+
+    def is_motion_frame(self):
+        return True
+
+    def as_motion_frame(self):
+        return self
+
+    def get_motion_data(self):
+        return types.SimpleNamespace(x=self.values[0], y=self.values[1], z=self.values[2])
+
+    def get_timestamp(self):
+        return self.timestamp * 1000
+
+    def get_profile(self):
+        return self
+
+    def stream_type(self):
+        return self.stream
+
+
+class ReplayStreamProfile:
+    def __init__(self, intrinsics):
+        self.intrinsics = intrinsics
+
+    def as_video_stream_profile(self):
+        return self
+
+    def get_intrinsics(self):
+        return self.intrinsics
+
+    def get_extrinsics_to(self, other):
+        # The replayed color images are registered to the depth
+        return types.SimpleNamespace(rotation=[1, 0, 0, 0, 1, 0, 0, 0, 1], translation=[0, 0, 0])
+
+
+class ReplayFrame:
+    def __init__(self, timestamp, depth=None, vertices=None, intrinsics=None, depth_scale=0.001, color=None):
+        self.timestamp = timestamp
+        self.depth = depth
+        self.vertices = vertices
+        self.color = color
+        self.depth_scale = depth_scale
+        self.profile = ReplayStreamProfile(intrinsics)
+
+    def __bool__(self):
+        return True
+
+    def get_data(self):
+        return self.depth if self.depth is not None else self.color
+
+    def get_width(self):
+        return self.depth.shape[1] if self.depth is not None else 0
+
+    def get_height(self):
+        return self.depth.shape[0] if self.depth is not None else 0
+
+    def get_timestamp(self):
+        return self.timestamp * 1000
+
+    def get_units(self):
+        return self.depth_scale
+
+    def get_distance(self, x, y):
+        return float(self.depth[y, x]) * self.depth_scale
+
+    def get_profile(self):
+        return self.profile
+
+    def as_depth_frame(self):
+        return self
+
+
+class ReplayFrameset:
+    def __init__(self, depth_frame):
+        self.depth_frame = depth_frame
+        # A color frame carries the image recorded with the depth, if any, as its data
+        self.color_frame = ReplayFrame(depth_frame.timestamp, intrinsics=depth_frame.profile.intrinsics,
+                                       color=depth_frame.color)
+
+    def __bool__(self):
+        return True
+
+    def get_depth_frame(self):
+        return self.depth_frame
+
+    def get_color_frame(self):
+        return self.color_frame
+
+    def get_timestamp(self):
+        return self.depth_frame.get_timestamp()
+
+
+class ReplayPoints:
+    def __init__(self, vertices):
+        self.vertices = vertices
+
+    def get_vertices(self):
+        return self.vertices
+
+    def size(self):
+        return len(self.vertices)
+
+
+class ReplayPointcloud:
+    def map_to(self, frame):
+        pass
+
+    def calculate(self, depth_frame):
+        if depth_frame.vertices is not None:
+            return ReplayPoints(depth_frame.vertices)
+        return ReplayPoints(deproject_depth(depth_frame.depth, depth_frame.profile.intrinsics, depth_frame.depth_scale))
+
+
+class ReplayAlign:
+    def __init__(self, align_to=None):
+        self.align_to = align_to
+
+    def process(self, frames):
+        return frames
+
+
+class ReplayFilter:
+    '''Stand-in for the librealsense processing blocks working on the depth of the replayed frames, frames replayed
+    from points have no depth and go through unchanged'''
+    OPTIONS = {}
+
+    def __init__(self):
+        self.options = dict(self.OPTIONS)
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def get_option(self, option):
+        return self.options[option]
+
+    def process(self, frame):
+        if frame.depth is None:
+            return frame
+        depth, intrinsics = self.apply(frame.depth, frame.profile.intrinsics, frame.depth_scale)
+        return ReplayFrame(frame.timestamp, depth=depth, intrinsics=intrinsics, depth_scale=frame.depth_scale)
+
+    def apply(self, depth, intrinsics, depth_scale):
+        return depth, intrinsics
+
+
+class ReplayDecimationFilter(ReplayFilter):
+    '''Median of the valid pixels of every block up to 3x3, their mean for larger blocks, as librealsense'''
+    OPTIONS = {'filter_magnitude': 2}
+
+    def apply(self, depth, intrinsics, depth_scale):
+        m = int(self.options['filter_magnitude'])
+        if m <= 1:
+            return depth, intrinsics
+        h, w = depth.shape[0] // m, depth.shape[1] // m
+        blocks = depth[:h * m, :w * m].reshape(h, m, w, m).swapaxes(1, 2).reshape(h, w, m * m)
+        valid = np.count_nonzero(blocks, axis=2)
+        if m <= 3:
+            # Zeros sort first, the median of the valid values sits in the upper part of each block
+            index = np.minimum(m * m - valid + np.maximum(valid - 1, 0) // 2, m * m - 1)
+            decimated = np.take_along_axis(np.sort(blocks, axis=2), index[..., np.newaxis], axis=2)[..., 0]
+        else:
+            decimated = (blocks.sum(axis=2, dtype=np.float64) / np.maximum(valid, 1)).astype(depth.dtype)
+        if intrinsics is not None:
+            intrinsics = ReplayIntrinsics(w, h, intrinsics.fx / m, intrinsics.fy / m, intrinsics.ppx / m,
+                                          intrinsics.ppy / m)
+        return decimated, intrinsics
+
+
+class ReplayThresholdFilter(ReplayFilter):
+    OPTIONS = {'min_distance': 0.1, 'max_distance': 4.0}
+
+    def apply(self, depth, intrinsics, depth_scale):
+        meters = depth * depth_scale
+        return np.where((meters < self.options['min_distance']) | (meters > self.options['max_distance']), 0,
+                        depth).astype(depth.dtype), intrinsics
+
+
+def smooth_rows(values, alpha, delta):
+    '''Recursive edge preserving smoothing of every row, left to right then right to left, in place'''
+    for columns in (range(1, values.shape[1]), range(values.shape[1] - 2, -1, -1)):
+        step = 1 if columns.step > 0 else -1
+        for j in columns:
+            previous, current = values[:, j - step], values[:, j]
+            similar = (previous > 0) & (current > 0) & (np.abs(current - previous) < delta)
+            current[similar] = alpha * current[similar] + (1 - alpha) * previous[similar]
+
+
+class ReplaySpatialFilter(ReplayFilter):
+    '''Approximation of librealsense's domain transform filter, on depth units rather than disparity'''
+    OPTIONS = {'filter_magnitude': 2, 'filter_smooth_alpha': 0.5, 'filter_smooth_delta': 20, 'holes_fill': 0}
+
+    def apply(self, depth, intrinsics, depth_scale):
+        values = depth.astype(np.float32)
+        for _ in range(int(self.options['filter_magnitude'])):
+            smooth_rows(values, self.options['filter_smooth_alpha'], self.options['filter_smooth_delta'])
+            smooth_rows(values.T, self.options['filter_smooth_alpha'], self.options['filter_smooth_delta'])
+        return np.rint(values).astype(depth.dtype), intrinsics
+
+
+class ReplayTemporalFilter(ReplayFilter):
+    '''Exponential moving average of every pixel over the frames, reset where it jumps by delta'''
+    OPTIONS = {'filter_smooth_alpha': 0.4, 'filter_smooth_delta': 20, 'holes_fill': 3}
+
+    def __init__(self):
+        super().__init__()
+        self.previous = None
+
+    def apply(self, depth, intrinsics, depth_scale):
+        values = depth.astype(np.float32)
+        if self.previous is not None and self.previous.shape == values.shape:
+            alpha = self.options['filter_smooth_alpha']
+            similar = (values > 0) & (self.previous > 0) & (np.abs(values - self.previous) < self.options['filter_smooth_delta'])
+            values[similar] = alpha * values[similar] + (1 - alpha) * self.previous[similar]
+        self.previous = values
+        return np.rint(values).astype(depth.dtype), intrinsics
+
+
+class ReplayHoleFillingFilter(ReplayFilter):
+    '''Fills invalid pixels from the left (0), the farthest (1) or nearest (2) of their four neighbors'''
+    OPTIONS = {'holes_fill': 1}
+
+    def apply(self, depth, intrinsics, depth_scale):
+        holes = depth == 0
+        if int(self.options['holes_fill']) == 0:
+            columns = np.where(holes, 0, np.arange(depth.shape[1]))
+            np.maximum.accumulate(columns, axis=1, out=columns)
+            return depth[np.arange(depth.shape[0])[:, np.newaxis], columns], intrinsics
+        padded = np.pad(depth, 1)
+        neighbors = np.stack([padded[1:-1, :-2], padded[1:-1, 2:], padded[:-2, 1:-1], padded[2:, 1:-1]])
+        if int(self.options['holes_fill']) == 1:
+            fill = neighbors.max(axis=0)
+        else:
+            fill = np.where(neighbors > 0, neighbors, np.iinfo(depth.dtype).max).min(axis=0)
+            fill[fill == np.iinfo(depth.dtype).max] = 0
+        return np.where(holes, fill, depth), intrinsics
+
+
+class ReplayDisparityTransform(ReplayFilter):
+    '''The stand-ins all work on depth, the transforms leave the frames as they are'''
+    def __init__(self, transform_to_disparity=True):
+        super().__init__()
+
+
+class ReplayConfig:
+    def __init__(self):
+        self.streams = []
+
+    def enable_stream(self, *args):
+        self.streams.append(args)
+
+    def enable_device_from_file(self, *args, **kwargs):
+        pass
+
+
+class ReplayRealSenseError(RuntimeError):
+    pass
+
+
+class ReplayPipeline:
+    def __init__(self, frames, clock, finish=None, imu=None, imu_finish=None):
+        self.frames = frames if frames is not None else []
+        self.clock = clock
+        self.finish = finish or clock.register(blocking=True)
+        self.imu = imu
+        self.imu_finish = imu_finish
+        self.started = False
+        self.frames_delivered = 0
+        self.samples_delivered = 0
+        self._iterator = None
+
+    def start(self, config=None, callback=None):
+        streams = [stream[0] for stream in getattr(config, 'streams', [])]
+        if streams and all(stream in MOTION_STREAMS for stream in streams):
+            # A motion only pipeline, as opened next to the depth one for a D435i's IMU
+            if self.imu is None:
+                raise ReplayRealSenseError("No device with motion sensors connected")
+            self.finish = self.imu_finish
+            self.started = True
+            threading.Thread(target=self._deliver_motion, args=(callback,), daemon=True).start()
+            return None
+        self.started = True
+        self._iterator = iter(self.frames)
+        return None
+
+    def _deliver_motion(self, callback):
+        try:
+            for t, ax, ay, az, gx, gy, gz in self.imu:
+                while not self.clock.wait_until(t, blocking=False, timeout=0.5):
+                    if not self.started:
+                        return
+                if not self.started:
+                    return
+                callback(ReplayMotionFrame('accel', t, (ax, ay, az)))
+                callback(ReplayMotionFrame('gyro', t, (gx, gy, gz)))
+                self.samples_delivered += 1
+        finally:
+            self.finish()
+
+    def wait_for_frames(self, timeout_ms=FRAME_TIMEOUT * 1000):
+        if not self.started:
+            raise ReplayRealSenseError("wait_for_frames cannot be called before start()")
+        frame = next(self._iterator, None)
+        if frame is None:
+            if self.clock.speed > 0:
+                time.sleep(timeout_ms / 1000)
+            raise ReplayRealSenseError(f"Frame didn't arrive within {timeout_ms}")
+        self.clock.wait_until(frame.timestamp)
+        self.frames_delivered += 1
+        return ReplayFrameset(frame)
+
+    def poll_for_frames(self):
+        return self.wait_for_frames()
+
+    def stop(self):
+        self.started = False
+        self.finish()
+
+
+def replay_realsense_module(frames, clock, finish=None, imu=None, imu_finish=None):
+    '''Module object standing in for pyrealsense2, whose pipeline() replays the given frames and IMU samples'''
+    rs = types.ModuleType('pyrealsense2')
+    rs.pipelines = []
+
+    def pipeline(*args):
+        rs.pipelines.append(ReplayPipeline(frames, clock, finish, imu, imu_finish))
+        return rs.pipelines[-1]
+    rs.pipeline = pipeline
+    rs.config = ReplayConfig
+    rs.align = ReplayAlign
+    rs.pointcloud = ReplayPointcloud
+    rs.error = ReplayRealSenseError
+    rs.stream = types.SimpleNamespace(depth='depth', color='color', infrared='infrared', accel='accel', gyro='gyro')
+    rs.format = types.SimpleNamespace(z16='z16', bgr8='bgr8', rgb8='rgb8', y8='y8', motion_xyz32f='motion_xyz32f')
+    rs.intrinsics = ReplayIntrinsics
+    rs.decimation_filter = ReplayDecimationFilter
+    rs.threshold_filter = ReplayThresholdFilter
+    rs.spatial_filter = ReplaySpatialFilter
+    rs.temporal_filter = ReplayTemporalFilter
+    rs.hole_filling_filter = ReplayHoleFillingFilter
+    rs.disparity_transform = ReplayDisparityTransform
+    rs.option = types.SimpleNamespace(**{name: name for name in (
+        'filter_magnitude', 'min_distance', 'max_distance', 'filter_smooth_alpha', 'filter_smooth_delta', 'holes_fill')})
+    return rs
+
+
+def deproject_depth(depth, intrinsics, depth_scale):
+    height, width = depth.shape
+    u = (np.arange(width, dtype=np.float32) - intrinsics.ppx) / intrinsics.fx
+    v = (np.arange(height, dtype=np.float32) - intrinsics.ppy) / intrinsics.fy
+    z = depth.astype(np.float32) * depth_scale
+    vertices = np.empty(height * width, dtype=VERTEX_DTYPE)
+    vertices['f0'] = (z * u[np.newaxis, :]).ravel()
+    vertices['f1'] = (z * v[:, np.newaxis]).ravel()
+    vertices['f2'] = z.ravel()
+    return vertices
+
+
+def nmea_checksum(body):
+    checksum = 0
+    for char in body.encode('ascii'):
+        checksum ^= char
+    return f"{checksum:02X}"
+
+
+def nmea_sentence(body):
+    return f"${body}*{nmea_checksum(body)}\r\n".encode('ascii')
+
+
+def nmea_coordinates(lat, lon):
+    lat_deg, lon_deg = int(abs(lat)), int(abs(lon))
+    lat_min, lon_min = (abs(lat) - lat_deg) * 60, (abs(lon) - lon_deg) * 60
+    return (f"{lat_deg:02d}{lat_min:011.8f},{'N' if lat >= 0 else 'S'},"
+            f"{lon_deg:03d}{lon_min:011.8f},{'E' if lon >= 0 else 'W'}")
+
+
+def gps_fix_sentences(when, lat, lon, heading, zda=False):
+    utc = when.strftime('%H%M%S.') + f"{when.microsecond // 10000:02d}"
+    coordinates = nmea_coordinates(lat, lon)
+    sentences = []
+    if zda:
+        sentences.append(nmea_sentence(f"GNZDA,{utc},{when.day:02d},{when.month:02d},{when.year},00,00"))
+    sentences.append(nmea_sentence(f"GNGGA,{utc},{coordinates},4,12,0.6,0.000,M,0.000,M,1.0,0000"))
+    sentences.append(nmea_sentence(f"GNRMC,{utc},A,{coordinates},0.00,{heading:.2f},{when.strftime('%d%m%y')},,,R"))
+    return sentences
+
+
+def session_base_date(path):
+    folder = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    for pattern, text in (('data_%Y%m%d_%H%M%S', folder), ('%Y-%m-%d_%H-%M-%S', folder.split('.')[0])):
+        try:
+            return datetime.datetime.strptime(text, pattern)
+        except ValueError:
+            continue
+    return BASE_DATE
+
+
+def parse_v1_timestamp(text):
+    return datetime.datetime.strptime(text.strip(), '%Y-%m-%d_%H:%M:%S.%f')
+
+
+def is_v1_data_file(path):
+    with open(path, 'r') as f:
+        first = f.readline().split(',')[0]
+    try:
+        float(first)
+        return False
+    except ValueError:
+        return True
+
+
+def load_serial_capture(path):
+    '''Raw serial capture, one "timestamp,payload" line per received line'''
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            timestamp, _, payload = line.rstrip('\r\n').partition(',')
+            records.append((float(timestamp), payload.encode('ascii') + b'\r\n'))
+    return records
+
+
+def load_gps_records(path):
+    '''NMEA records re-synthesised from a v2 gps_data.txt or a v1 data.txt'''
+    if is_v1_data_file(path):
+        return load_v1_records(path)[0]
+    base = session_base_date(path)
+    records = []
+    fixes = np.loadtxt(path, delimiter=',', ndmin=2)
+    for i, (timestamp, lat, lon, heading) in enumerate(fixes[:, :4]):
+        when = base + datetime.timedelta(seconds=timestamp)
+        for sentence in gps_fix_sentences(when, lat, lon, heading, zda=i == 0):
+            records.append((timestamp, sentence))
+    return records
+
+
+def load_v1_records(path):
+    '''NMEA and ultrasonic array records from a v1 data.txt (time, lat, lon, heading, d1..d7)'''
+    gps_records, arduino_records = [], []
+    start = None
+    with open(path, 'r') as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) < 11:
+                continue
+            when = parse_v1_timestamp(fields[0])
+            if start is None:
+                start = when
+            timestamp = (when - start).total_seconds()
+            lat, lon, heading = float(fields[1]), float(fields[2]), float(fields[3])
+            for sentence in gps_fix_sentences(when, lat, lon, heading, zda=True):
+                gps_records.append((timestamp, sentence))
+            arduino_records.append((max(timestamp - 0.05, 0), (', '.join(fields[4:11]) + '\r\n').encode('ascii')))
+    return gps_records, arduino_records
+
+
+def load_arduino_records(path):
+    if is_v1_data_file(path):
+        return load_v1_records(path)[1]
+    return load_serial_capture(path)
+
+
+def load_imu_samples(path):
+    '''timestamp, ax, ay, az, gx, gy, gz rows of an imu_data.txt'''
+    return np.loadtxt(path, delimiter=',', ndmin=2)
+
+
+def load_lidar_measures(path):
+    measures = []
+    with open(path, 'r') as f:
+        for line in f:
+            timestamp, new_scan, quality, angle, distance = line.strip().split(',')
+            measures.append((float(timestamp), new_scan == 'True', int(quality), float(angle), float(distance)))
+    return measures
+
+
+def iter_depth_frames(path):
+    '''Frames from a pointcloud_data.npy or depth_data.npy written with successive np.save calls'''
+    last_frame = None
+    for entry in iter_npy_frames(path):
+        # The realsense recorder saves a frame again for every fix it is paired with
+        if 'frame_timestamp' in entry:
+            if entry['frame_timestamp'] == last_frame:
+                continue
+            last_frame = entry['frame_timestamp']
+            entry['timestamp'] = last_frame
+        intrinsics = entry.get('intrinsics')
+        if intrinsics is not None:
+            intrinsics = ReplayIntrinsics(**intrinsics)
+        if 'depth' in entry:
+            yield ReplayFrame(entry['timestamp'], depth=entry['depth'], intrinsics=intrinsics,
+                              depth_scale=entry.get('depth_scale', 0.001), color=entry.get('color'))
+        else:
+            points = np.ascontiguousarray(entry['points'], dtype=np.float32)
+            yield ReplayFrame(entry['timestamp'], vertices=points.view(VERTEX_DTYPE).reshape(-1), intrinsics=intrinsics)
+
+
+class DepthFrameSource:
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        return iter_depth_frames(self.path)
+
+
+class ScriptedInput:
+    '''stdin replacement answering the recorders' prompts, the last prompt is held until the replay ends'''
+    def __init__(self, answers, clock):
+        self.answers = list(answers)
+        self.clock = clock
+
+    def readline(self):
+        if self.answers:
+            answer = self.answers.pop(0)
+        elif not self.clock.finished.is_set():
+            self.clock.finished.wait()
+            answer = ''
+        else:
+            raise EOFError
+        print(answer)
+        return answer + '\n'
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class ReplaySession:
+    def __init__(self, speed=REALTIME):
+        self.clock = ReplayClock(speed)
+        self.serial_ports = {}
+        self.lidars = {}
+        self.depth_frames = None
+        self.imu = None
+        self.realsense = None
+        self.devices = []
+
+    def add_serial(self, port, records):
+        self.serial_ports[port] = records, self.clock.register(blocking=False)
+
+    def add_lidar(self, port, measures):
+        self.lidars[port] = measures, self.clock.register(blocking=True)
+
+    def add_depth_frames(self, frames):
+        self.depth_frames = frames, self.clock.register(blocking=True)
+
+    def add_imu(self, samples):
+        self.imu = samples, self.clock.register(blocking=False)
+
+    def open_serial(self, real_serial):
+        def factory(port=None, baudrate=9600, *args, **kwargs):
+            if port in self.serial_ports:
+                records, finish = self.serial_ports[port]
+                device = ReplaySerial(records, self.clock, port, baudrate, kwargs.get('timeout'), finish)
+                self.devices.append(device)
+                return device
+            return real_serial(port, baudrate, *args, **kwargs)
+        return factory
+
+    def open_lidar(self, real_lidar, device_class=ReplayLidar):
+        def factory(port, *args, **kwargs):
+            if port in self.lidars:
+                measures, finish = self.lidars[port]
+                device = device_class(measures, self.clock, port, finish)
+                self.devices.append(device)
+                return device
+            return real_lidar(port, *args, **kwargs)
+        return factory
+
+    def install(self, answers=None):
+        '''Patches serial, rplidar, lidar_driver, pyrealsense2 and time.time for scripts that open hardware directly'''
+        serial = _import_or_module('serial')
+        if not hasattr(serial, 'SerialException'):
+            serial.SerialException = IOError
+        serial.Serial = self.open_serial(getattr(serial, 'Serial', _missing_device('pyserial')))
+        rplidar = _import_or_module('rplidar')
+        rplidar.RPLidar = self.open_lidar(getattr(rplidar, 'RPLidar', _missing_device('rplidar')))
+        # Imported once serial is patched, it opens its port through serial.Serial
+        import lidar_driver
+        lidar_driver.RPLidarDriver = self.open_lidar(lidar_driver.RPLidarDriver, ReplayLidarDriver)
+        if self.depth_frames is not None or self.imu is not None:
+            frames, finish = self.depth_frames or (None, None)
+            imu, imu_finish = self.imu or (None, None)
+            self.realsense = replay_realsense_module(frames, self.clock, finish, imu, imu_finish)
+            sys.modules['pyrealsense2'] = self.realsense
+        time.time = self.clock.time
+        if answers is not None:
+            sys.stdin = ScriptedInput(answers, self.clock)
+
+    def uninstall(self):
+        time.time = _real_time
+        sys.stdin = sys.__stdin__
+
+    def summary(self):
+        counts = []
+        for device in self.devices:
+            if isinstance(device, ReplaySerial):
+                counts.append(f"{device.port}: {device.bytes_delivered} bytes")
+            else:
+                counts.append(f"{device.port}: {device.measures_delivered} measures")
+        if self.realsense is not None:
+            counts.append(f"realsense: {sum(p.frames_delivered for p in self.realsense.pipelines)} frames")
+            if self.imu is not None:
+                counts.append(f"imu: {sum(p.samples_delivered for p in self.realsense.pipelines)} samples")
+        return ', '.join(counts)
+
+
+def _import_or_module(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        return module
+
+
+def _missing_device(package):
+    def factory(port, *args, **kwargs):
+        raise IOError(f"No replay source for {port} and {package} is not installed")
+    return factory
+
+
+def _port_and_path(value):
+    port, _, path = value.partition('=')
+    if not path:
+        raise argparse.ArgumentTypeError(f"expected PORT=FILE, got {value}")
+    return port, path
+
+
+def add_recorded_session(session, folder):
+    '''Replays the files of a session on the ports of its session.json, and runs the script with its settings'''
+    metadata = read_metadata(folder)
+    if not metadata:
+        raise ValueError(f"{folder} has no {METADATA_FILE}, give its files and ports instead")
+    config = metadata['config']
+    sources = [('gps_data.txt', 'GPS_PORT', lambda path, port: session.add_serial(port, load_gps_records(path))),
+               ('lidar_data.txt', 'LIDAR_PORT', lambda path, port: session.add_lidar(port, load_lidar_measures(path))),
+               ('pointcloud_data.npy', None, lambda path, port: session.add_depth_frames(DepthFrameSource(path))),
+               ('imu_data.txt', None, lambda path, port: session.add_imu(load_imu_samples(path)))]
+    for name, port_setting, add in sources:
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and (port_setting is None or port_setting in config):
+            add(path, config.get(port_setting))
+    os.environ[ENV_PREFIX + 'CONFIG'] = os.path.join(folder, METADATA_FILE)
+
+
+def run_script(script, session, args=(), answers=None, interrupt=False):
+    session.install(answers)
+    running = threading.Event()
+    if interrupt:
+        def interrupt_on_end():
+            # Scripts that stop on their own once the streams end (the lidar recorders when the scans run out) are
+            # left to close their files and plot, only the ones still polling the ports get the Ctrl+C
+            session.clock.finished.wait()
+            time.sleep(INTERRUPT_GRACE)
+            last_poll = session.clock.last_poll
+            if running.is_set() and last_poll is not None and time.perf_counter() - last_poll < POLL_WINDOW:
+                _thread.interrupt_main()
+        threading.Thread(target=interrupt_on_end, daemon=True).start()
+
+    script = os.path.abspath(script)
+    sys.argv = [script] + list(args)
+    sys.path.insert(0, os.path.dirname(script))
+    wall_start = time.perf_counter()
+    session_start = session.clock.now()
+    running.set()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        running.clear()
+        session.uninstall()
+    elapsed = time.perf_counter() - wall_start
+    covered = session.clock.now() - session_start
+    print(f"Replayed {covered:.2f}s of session in {elapsed:.2f}s ({covered / elapsed if elapsed else 0:.1f}x). {session.summary()}",
+          file=sys.__stdout__)
+    return elapsed, covered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a recorder script against a recorded session instead of hardware.")
+    parser.add_argument('script', help="recorder script to run, e.g. main.py or ../v1/all_plot0.py")
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    parser.add_argument('--speed', type=float, default=REALTIME, help="1 for real time, 2 for twice as fast, 0 for as fast as possible")
+    parser.add_argument('--gps', type=_port_and_path, action='append', default=[], help="PORT=gps_data.txt or v1 data.txt")
+    parser.add_argument('--arduino', type=_port_and_path, action='append', default=[], help="PORT=v1 data.txt or serial capture")
+    parser.add_argument('--serial', type=_port_and_path, action='append', default=[], help="PORT=raw 'timestamp,line' capture")
+    parser.add_argument('--lidar', type=_port_and_path, action='append', default=[], help="PORT=lidar_data.txt")
+    parser.add_argument('--realsense', help="pointcloud_data.npy or depth_data.npy")
+    parser.add_argument('--imu', help="imu_data.txt, for the RealSense motion streams")
+    parser.add_argument('--session', help="session folder with a session.json, replayed on its ports with its settings")
+    parser.add_argument('--input', action='append', dest='answers', help="answer to the script's prompts, in order")
+    parser.add_argument('--interrupt', action='store_true', help="send Ctrl+C to the script if it still polls the ports once every stream has been replayed")
+    args = parser.parse_args()
+
+    session = ReplaySession(args.speed)
+    if args.session:
+        try:
+            add_recorded_session(session, args.session)
+        except ValueError as e:
+            parser.error(str(e))
+    for port, path in args.gps:
+        session.add_serial(port, load_gps_records(path))
+    for port, path in args.arduino:
+        session.add_serial(port, load_arduino_records(path))
+    for port, path in args.serial:
+        session.add_serial(port, load_serial_capture(path))
+    for port, path in args.lidar:
+        session.add_lidar(port, load_lidar_measures(path))
+    if args.realsense:
+        session.add_depth_frames(DepthFrameSource(args.realsense))
+    if args.imu:
+        session.add_imu(load_imu_samples(args.imu))
+
+    run_script(args.script, session, args.script_args, args.answers, args.interrupt)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+'''Several serial devices read at once on an asyncio event loop, instead of polling in_waiting in a busy loop
+
+Every port wakes the loop as bytes arrive, through the selector on POSIX ports (loop.add_reader on their file
+descriptor) and through a thread blocked in read() otherwise (Windows COM ports, the replay harness). What a wakeup
+brings is split into lines or frames at once and each one is published as a Record, stamped with the time of the
+read that completed it, to the queues of the subscribers.
+
+    async def record():
+        async with SerialHub() as hub:
+            hub.add('gps', serial.Serial('COM8', 57600))
+            hub.add('arduino', serial.Serial('COM3', 9600))
+            async for record in hub.subscribe():
+                record.device, record.timestamp, record.data
+
+    asyncio.run(record())
+'''
+import time
+import asyncio
+import logging
+import threading
+import collections
+
+from processing import split_cyglidar_frames
+
+MAX_LINE = 4096  # bytes without a line end dropped as garbage
+QUEUE_SIZE = 1024  # records per subscriber, the oldest are dropped when it falls behind
+READ_TIMEOUT = 0.1  # seconds a reader thread blocks before checking whether to stop
+WAKE_INTERVAL = 0.5  # seconds, the loop wakes this often even when idle so a Ctrl+C is seen on every platform
+
+Record = collections.namedtuple('Record', ['device', 'timestamp', 'data'])
+
+
+class LineSplitter:
+    '''Lines of a byte stream without their line end, all the complete lines of a read at once'''
+    def __init__(self, terminator=b'\n', max_length=MAX_LINE):
+        self.terminator = terminator
+        self.max_length = max_length
+        self.buffer = b''
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        *lines, self.buffer = (self.buffer + data).split(self.terminator)
+        if len(self.buffer) > self.max_length:
+            self.dropped_bytes += len(self.buffer)
+            self.buffer = b''
+        return [line.rstrip(b'\r') for line in lines]
+
+
+class CygLidarSplitter:
+    '''Payloads (payload header then data) of the CygLidar frames of a byte stream'''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        self.buffer += data
+        payloads, dropped = split_cyglidar_frames(self.buffer)
+        self.dropped_bytes += dropped
+        return payloads
+
+
+class SerialHub:
+    '''Reads the added ports concurrently and publishes their records to the subscribers, lives on a running loop'''
+    def __init__(self):
+        self.loop = None
+        self.devices = {}
+        self.readers = []
+        self.threads = []
+        self.subscribers = []
+        self.stats = {}
+        self.timeouts = {}
+        self.stopping = threading.Event()
+        self.waker = None
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def wake(self):
+        self.waker = self.loop.call_later(WAKE_INTERVAL, self.wake)
+
+    def add(self, name, port, splitter=None):
+        '''Starts reading port, a serial.Serial or alike, as device name, in lines unless another splitter is given'''
+        self.devices[name] = port, splitter or LineSplitter()
+        self.stats[name] = {'bytes': 0, 'records': 0, 'dropped records': 0}
+        # Given back by close, the caller may keep using the port
+        self.timeouts[name] = getattr(port, 'timeout', None)
+        try:
+            fd = port.fileno()
+            self.loop.add_reader(fd, self.readable, name)
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            port.timeout = READ_TIMEOUT
+            thread = threading.Thread(target=self.read_thread, args=(name,), name=f"{name} reader", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        else:
+            # The selector only calls back once bytes are waiting, the read must not wait for more
+            port.timeout = 0
+            self.readers.append(fd)
+
+    def readable(self, name):
+        port, _ = self.devices[name]
+        try:
+            data = port.read(port.in_waiting or 1)
+        except OSError as e:
+            logging.error(f"Reading {name} failed, it is no longer read: {e}")
+            self.loop.remove_reader(port.fileno())
+            return
+        if data:
+            self.received(name, data, time.time())
+
+    def read_thread(self, name):
+        port, _ = self.devices[name]
+        while not self.stopping.is_set():
+            start = time.monotonic()
+            try:
+                data = port.read(max(port.in_waiting, 1))
+            except OSError as e:
+                logging.error(f"Reading {name} failed, it is no longer read: {e}")
+                return
+            if data:
+                self.loop.call_soon_threadsafe(self.received, name, data, time.time())
+            elif time.monotonic() - start < READ_TIMEOUT / 2:
+                # Ports that return at once when there is nothing to read, e.g. a finished replay
+                self.stopping.wait(READ_TIMEOUT)
+
+    def received(self, name, data, timestamp):
+        _, splitter = self.devices[name]
+        stats = self.stats[name]
+        stats['bytes'] += len(data)
+        for message in splitter.feed(data):
+            stats['records'] += 1
+            self.publish(Record(name, timestamp, message))
+
+    def publish(self, record):
+        for queue, devices in self.subscribers:
+            if devices is not None and record.device not in devices:
+                continue
+            if queue.full():
+                queue.get_nowait()
+                self.stats[record.device]['dropped records'] += 1
+            queue.put_nowait(record)
+
+    async def subscribe(self, devices=None, maxsize=QUEUE_SIZE):
+        '''Records of the given devices, all by default, from now on'''
+        subscriber = asyncio.Queue(maxsize), None if devices is None else set(devices)
+        self.subscribers.append(subscriber)
+        try:
+            while True:
+                yield await subscriber[0].get()
+        finally:
+            self.subscribers.remove(subscriber)
+
+    def close(self):
+        self.stopping.set()
+        for fd in self.readers:
+            self.loop.remove_reader(fd)
+        for thread in self.threads:
+            thread.join()
+        for name, timeout in self.timeouts.items():
+            port, _ = self.devices[name]
+            port.timeout = timeout
+        if self.waker is not None:
+            self.waker.cancel()
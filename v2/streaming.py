@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+'''Live streaming of the processed points and of the trajectory to any number of subscribers, over TCP or UDP
+
+The recorders publish batches of points and each GPS fix. Every batch is packed once into packets of at most
+POINTS_PER_PACKET points, quantized to uint16 offsets from the batch's lowest corner (1 mm steps unless the batch is
+wider than 65 m): 6 bytes a point instead of about 40 in processed_data.txt, and a packet always fits a datagram.
+Each subscriber gets its own bounded buffer and sender thread, a slow or stalled one loses its oldest packets and
+never holds up the recorder. Over UDP, subscribers register by sending SUBSCRIBE to the publisher's port and renew it
+every UDP_RENEW seconds.
+
+Packets are a PACKET_HEADER (magic, version, kind, sequence, payload length, time.time() of the data) followed by:
+    POINTS: POINTS_HEADER (origin easting, northing and height in m, step in m) then uint16 x, y, z per point
+    POSE: POSE_FORMAT easting, northing (m) and heading (degrees)
+
+The subscriber assembles a live map of the survey, a grid of the mean height of its cells, and the trajectory:
+    python streaming.py 192.168.1.20:8767
+    python streaming.py --udp --plot 192.168.1.20:8767
+'''
+import time
+import queue
+import socket
+import struct
+import logging
+import argparse
+import threading
+import collections
+import numpy as np
+
+from buffers import BoundedQueue
+from live_view import LiveView, TrailBuffer
+
+TCP = 'tcp'
+UDP = 'udp'
+TRANSPORTS = (TCP, UDP)
+MAGIC = b'TRIC'
+VERSION = 1
+POINTS = 1
+POSE = 2
+PACKET_HEADER = struct.Struct('<4sBBIId')  # magic, version, kind, sequence, payload bytes, timestamp
+POINTS_HEADER = struct.Struct('<dddf')  # origin easting, northing, height, step
+POSE_FORMAT = struct.Struct('<ddf')  # easting, northing, heading
+POINT_DTYPE = np.dtype('<u2')
+QUANTUM = 0.001  # meters, the step of the quantized points unless a batch is too wide for it
+POINTS_PER_PACKET = 200  # 1258 bytes, within the MTU of a datagram
+CLIENT_BUFFER = 256  # packets per subscriber, the oldest are dropped when it falls behind
+SEND_TIMEOUT = 2.0  # seconds a TCP send may block before the subscriber is dropped
+ACCEPT_TIMEOUT = 0.5  # seconds, how often the server threads check whether to stop
+SUBSCRIBE = b'SUBSCRIBE'
+UNSUBSCRIBE = b'UNSUBSCRIBE'
+UDP_RENEW = 2.0  # seconds between the registrations of a UDP subscriber
+UDP_LEASE = 10.0  # seconds after its last registration a UDP subscriber is dropped
+MAP_CELL = 0.2  # meters, cells of the live map
+REPORT_INTERVAL = 1.0  # seconds between the progress lines of the subscriber
+
+Packet = collections.namedtuple('Packet', ['kind', 'sequence', 'timestamp', 'data'])
+
+
+def encode_points(sequence, timestamp, points):
+    '''Packet of up to POINTS_PER_PACKET points, an (n, 3) array in meters'''
+    points = np.asarray(points, dtype=np.float64)
+    origin = points.min(axis=0)
+    step = max(QUANTUM, float((points.max(axis=0) - origin).max()) / np.iinfo(POINT_DTYPE).max)
+    quantized = np.rint((points - origin) / step).astype(POINT_DTYPE)
+    payload = POINTS_HEADER.pack(*origin, step) + quantized.tobytes()
+    return PACKET_HEADER.pack(MAGIC, VERSION, POINTS, sequence, len(payload), timestamp) + payload
+
+
+def encode_pose(sequence, timestamp, easting, northing, heading):
+    payload = POSE_FORMAT.pack(easting, northing, heading)
+    return PACKET_HEADER.pack(MAGIC, VERSION, POSE, sequence, len(payload), timestamp) + payload
+
+
+def decode_header(data):
+    '''(kind, sequence, payload length, timestamp) of the header at the start of data'''
+    magic, version, kind, sequence, length, timestamp = PACKET_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} stream packet")
+    return kind, sequence, length, timestamp
+
+
+def decode_payload(kind, payload):
+    '''(n, 3) float64 points of a POINTS payload, (easting, northing, heading) of a POSE one'''
+    if kind == POINTS:
+        *origin, step = POINTS_HEADER.unpack_from(payload)
+        quantized = np.frombuffer(payload, dtype=POINT_DTYPE, offset=POINTS_HEADER.size).reshape(-1, 3)
+        return quantized * step + np.array(origin)
+    if kind == POSE:
+        return POSE_FORMAT.unpack(payload)
+    raise ValueError(f"Unknown packet kind {kind}")
+
+
+def decode_packet(data):
+    kind, sequence, length, timestamp = decode_header(data)
+    payload = data[PACKET_HEADER.size:PACKET_HEADER.size + length]
+    if len(payload) != length:
+        raise ValueError("Truncated stream packet")
+    return Packet(kind, sequence, timestamp, decode_payload(kind, payload))
+
+
+class Subscriber:
+    '''Bounded buffer of the packets of one subscriber, drained by its own sender thread'''
+    def __init__(self, name, send, close=None):
+        self.name = name
+        self.send = send
+        self.close = close
+        self.queue = BoundedQueue(CLIENT_BUFFER)
+        self.sent = 0
+        self.thread = threading.Thread(target=self.run, name=f"stream to {name}", daemon=True)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    packet = self.queue.get()
+                except queue.Empty:
+                    return
+                try:
+                    self.send(packet)
+                except OSError as e:
+                    logging.info(f"Stream subscriber {self.name} dropped: {e}")
+                    self.queue.close()
+                    return
+                self.sent += 1
+        finally:
+            if self.close:
+                self.close()
+
+    @property
+    def alive(self):
+        return not self.queue.closed
+
+
+class StreamPublisher:
+    '''Publishes points and poses to the subscribers of a TCP or UDP port, never blocking the caller'''
+    def __init__(self, port, transport=TCP, host='0.0.0.0'):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown stream transport {transport!r}, expected one of {', '.join(TRANSPORTS)}")
+        self.transport = transport
+        self.subscribers = {}
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.dropped = 0
+        self.stopping = threading.Event()
+        kind = socket.SOCK_STREAM if transport == TCP else socket.SOCK_DGRAM
+        self.socket = socket.socket(socket.AF_INET, kind)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.settimeout(ACCEPT_TIMEOUT)
+        if transport == TCP:
+            self.socket.listen()
+        self.thread = threading.Thread(target=self.accept if transport == TCP else self.register,
+                                       name=f"stream {transport} server", daemon=True)
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def start(self):
+        self.thread.start()
+        logging.info(f"Streaming the points over {self.transport.upper()} on port {self.port}")
+        return self
+
+    def add(self, name, send, close=None):
+        subscriber = Subscriber(name, send, close)
+        with self.lock:
+            self.subscribers[name] = subscriber
+        subscriber.thread.start()
+        logging.info(f"Stream subscriber {name} connected")
+
+    def accept(self):
+        while not self.stopping.is_set():
+            try:
+                connection, address = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection.settimeout(SEND_TIMEOUT)
+            self.add(address, connection.sendall, connection.close)
+
+    def register(self):
+        while not self.stopping.is_set():
+            try:
+                message, address = self.socket.recvfrom(64)
+            except (socket.timeout, ConnectionResetError):
+                # Windows reports an ICMP port unreachable of a viewer gone away on the next recvfrom
+                message, address = None, None
+            except OSError as e:
+                if self.stopping.is_set() or self.socket.fileno() == -1:
+                    return
+                logging.warning(f"Stream registration: {e}")
+                self.stopping.wait(ACCEPT_TIMEOUT)
+                message, address = None, None
+            now = time.monotonic()
+            if message == SUBSCRIBE:
+                if address not in self.leases:
+                    self.add(address, lambda packet, address=address: self.socket.sendto(packet, address))
+                self.leases[address] = now
+            elif message == UNSUBSCRIBE:
+                self.leases[address] = -np.inf
+            for address, renewed in list(self.leases.items()):
+                if now - renewed > UDP_LEASE:
+                    del self.leases[address]
+                    with self.lock:
+                        subscriber = self.subscribers.pop(address, None)
+                    if subscriber:
+                        subscriber.queue.close()
+                        logging.info(f"Stream subscriber {address} left")
+
+    def publish(self, packets):
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for name, subscriber in subscribers:
+            if not subscriber.alive:
+                with self.lock:
+                    self.subscribers.pop(name, None)
+                continue
+            before = subscriber.queue.dropped
+            for packet in packets:
+                subscriber.queue.put(packet)
+            self.dropped += subscriber.queue.dropped - before
+
+    def next_sequence(self):
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        return self.sequence
+
+    def points(self, timestamp, points):
+        '''Publishes an (n, 3) array of points in meters, NaN rows skipped, measured at timestamp (time.time())'''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        points = points[~np.isnan(points).any(axis=1)]
+        if not len(points) or not self.subscribers:
+            return
+        self.publish([encode_points(self.next_sequence(), timestamp, points[start:start + POINTS_PER_PACKET])
+                      for start in range(0, len(points), POINTS_PER_PACKET)])
+
+    def pose(self, timestamp, easting, northing, heading):
+        if self.subscribers:
+            self.publish([encode_pose(self.next_sequence(), timestamp, easting, northing, heading or 0.0)])
+
+    def stats(self):
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        return {'subscribers': len(subscribers), 'sent': sum(s.sent for s in subscribers), 'dropped': self.dropped}
+
+    def close(self):
+        self.stopping.set()
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        # The packets already queued are still sent, within SEND_TIMEOUT
+        for subscriber in subscribers:
+            subscriber.queue.close()
+        for subscriber in subscribers:
+            subscriber.thread.join(SEND_TIMEOUT)
+        if self.thread.is_alive():
+            self.thread.join()
+        self.socket.close()
+
+
+def receive_exactly(connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Stream closed by the publisher")
+        data += chunk
+    return bytes(data)
+
+
+def iter_packets(host, port, transport=TCP, stop=None):
+    '''Packets received from a publisher until it closes the stream or stop (a threading.Event) is set'''
+    stop = stop or threading.Event()
+    if transport == TCP:
+        with socket.create_connection((host, port)) as connection:
+            connection.settimeout(None)
+            while not stop.is_set():
+                try:
+                    header = receive_exactly(connection, PACKET_HEADER.size)
+                except ConnectionError:
+                    return
+                kind, sequence, length, timestamp = decode_header(header)
+                yield Packet(kind, sequence, timestamp, decode_payload(kind, receive_exactly(connection, length)))
+        return
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as connection:
+        connection.settimeout(UDP_RENEW)
+        renewed = -np.inf
+        try:
+            while not stop.is_set():
+                if time.monotonic() - renewed >= UDP_RENEW:
+                    connection.sendto(SUBSCRIBE, (host, port))
+                    renewed = time.monotonic()
+                try:
+                    data = connection.recv(65536)
+                except socket.timeout:
+                    continue
+                except ConnectionResetError:
+                    # Windows reports the ICMP of a publisher not started yet
+                    continue
+                try:
+                    yield decode_packet(data)
+                except (ValueError, struct.error) as e:
+                    logging.warning(f"Invalid datagram skipped: {e}")
+        finally:
+            connection.sendto(UNSUBSCRIBE, (host, port))
+
+
+class LiveMap:
+    '''Mean height of the cells of the survey and the trajectory, assembled from the stream, in meters from the first
+    position received (UTM coordinates do not fit the float32 of a renderer). snapshot() and trail are live_view
+    buffers.'''
+    def __init__(self, cell=MAP_CELL):
+        self.cell = cell
+        self.origin = None
+        self.cells = {}
+        self.centers = np.empty((1024, 2))
+        self.sums = np.zeros(1024)
+        self.counts = np.zeros(1024, dtype=np.int64)
+        self.trail = TrailBuffer()
+        self.points = 0
+        self.packets = 0
+        self.lost = 0
+        self.sequence = None
+        self.latency = collections.deque(maxlen=1000)
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def add(self, packet):
+        with self.lock:
+            if self.sequence is not None:
+                gap = (packet.sequence - self.sequence - 1) & 0xFFFFFFFF
+                # A datagram arriving out of order is not a loss
+                if gap < 1 << 31:
+                    self.lost += gap
+            self.sequence = packet.sequence
+            self.packets += 1
+            self.latency.append(time.time() - packet.timestamp)
+            if packet.kind == POSE:
+                easting, northing, _ = packet.data
+                self.origin = self.origin or (easting, northing)
+                self.trail.append(easting - self.origin[0], northing - self.origin[1])
+            elif packet.kind == POINTS:
+                self.origin = self.origin or tuple(packet.data[0, :2])
+                self.add_points(packet.data)
+            self.version += 1
+
+    def add_points(self, points):
+        keys = np.floor((points[:, :2] - self.origin) / self.cell).astype(np.int64)
+        indices = np.empty(len(points), dtype=np.int64)
+        for i, key in enumerate(map(tuple, keys.tolist())):
+            index = self.cells.get(key)
+            if index is None:
+                index = self.cells[key] = len(self.cells)
+                if index == len(self.sums):
+                    self.grow()
+                self.centers[index] = (key[0] + 0.5) * self.cell, (key[1] + 0.5) * self.cell
+            indices[i] = index
+        np.add.at(self.sums, indices, points[:, 2])
+        np.add.at(self.counts, indices, 1)
+        self.points += len(points)
+
+    def grow(self):
+        size = 2 * len(self.sums)
+        self.centers = np.concatenate([self.centers, np.empty((size - len(self.centers), 2))])
+        self.sums = np.concatenate([self.sums, np.zeros(size - len(self.sums))])
+        self.counts = np.concatenate([self.counts, np.zeros(size - len(self.counts), dtype=np.int64)])
+
+    def snapshot(self):
+        '''(cell centers relative to origin, mean heights) of the map'''
+        with self.lock:
+            count = len(self.cells)
+            return self.centers[:count].copy(), self.sums[:count] / np.maximum(self.counts[:count], 1)
+
+    def summary(self):
+        with self.lock:
+            latency = np.array(self.latency) * 1000
+            return {'packets': self.packets, 'lost': self.lost, 'points': self.points, 'cells': len(self.cells),
+                    'fixes': self.trail.total,
+                    'latency p50 ms': round(float(np.median(latency)), 1) if len(latency) else None}
+
+
+def receive(live_map, host, port, transport, stop):
+    try:
+        for packet in iter_packets(host, port, transport, stop):
+            live_map.add(packet)
+    except OSError as e:
+        logging.error(f"Stream from {host}:{port} interrupted: {e}")
+    stop.set()
+
+
+def plot(live_map, stop):
+    '''Live view of the map colored by height and of the trajectory, until the window is closed'''
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.set_xlim(-10, 10)
+    ax.set_ylim(-10, 10)
+    view = LiveView(fig)
+    view.add(ax.scatter([], [], c=[], s=4, cmap='terrain', vmin=-0.3, vmax=0.3, marker='s'), live_map, grow=True)
+    view.add(ax.scatter([], [], c='red', s=2), live_map.trail, grow=True)
+    plt.show()
+    stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assembles a live map from the points streamed by a recorder")
+    parser.add_argument('address', help="host:port of the recorder, its STREAM_PORT setting")
+    parser.add_argument('--udp', action='store_true', help="subscribe over UDP instead of TCP")
+    parser.add_argument('--plot', action='store_true', help="display the map as it grows, needs matplotlib")
+    parser.add_argument('--save', help="text file the cells of the map are written to when the stream ends")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    host, _, port = args.address.rpartition(':')
+    live_map, stop = LiveMap(), threading.Event()
+    receiver = threading.Thread(target=receive, args=(live_map, host or '127.0.0.1', int(port),
+                                                      UDP if args.udp else TCP, stop), daemon=True)
+    receiver.start()
+    try:
+        if args.plot:
+            plot(live_map, stop)
+        else:
+            while not stop.wait(REPORT_INTERVAL):
+                logging.info(f"Live map: {live_map.summary()}")
+    except KeyboardInterrupt:
+        stop.set()
+    logging.info(f"Live map: {live_map.summary()}")
+    if args.save:
+        centers, heights = live_map.snapshot()
+        if live_map.origin:
+            centers += live_map.origin
+        np.savetxt(args.save, np.column_stack([centers, heights]), delimiter=',', fmt='%.3f')
+        logging.info(f"{len(heights)} cells saved in {args.save}")
+
+
+if __name__ == '__main__':
+    main()
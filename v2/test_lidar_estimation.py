@@ -1,23 +1,25 @@
 import serial
-from rplidar import RPLidar
+from lidar_driver import RPLidarDriver
 import numpy as np
 
 LIDAR_PORT = 'COM3'
+LIDAR_SCAN_MODE = 'express'
 SENSOR_TILT = 57.7
 SENSOR_HEIGHT = 803
 LIDAR_MAX_ANGLE = 1
 
 def print_lidar_readings():
-    lidar = RPLidar(LIDAR_PORT)
+    lidar = RPLidarDriver(LIDAR_PORT)
     try:
         print("Starting to print LIDAR readings. Press Ctrl+C to stop.")
-        for measurement in lidar.iter_measures():
-            if 0 <= measurement[2] <= LIDAR_MAX_ANGLE or 360 - LIDAR_MAX_ANGLE <= measurement[2] <= 360:
-                delta_y = SENSOR_HEIGHT - measurement[3] * np.sin(np.deg2rad(SENSOR_TILT)) * np.cos(np.deg2rad(measurement[2]))
-                d_forward = measurement[3] * np.cos(np.deg2rad(SENSOR_TILT))
-                d_lateral = d_forward * np.tan(np.deg2rad(measurement[2]))
-                x = np.sqrt(d_forward**2 + d_lateral**2)
-                print("Elevation difference:", delta_y, "Horizontal distance:", x)
+        for batch in lidar.iter_batches(LIDAR_SCAN_MODE):
+            batch = batch[(batch['angle'] <= LIDAR_MAX_ANGLE) | (batch['angle'] >= 360 - LIDAR_MAX_ANGLE)]
+            delta_y = SENSOR_HEIGHT - batch['distance'] * np.sin(np.deg2rad(SENSOR_TILT)) * np.cos(np.deg2rad(batch['angle']))
+            d_forward = batch['distance'] * np.cos(np.deg2rad(SENSOR_TILT))
+            d_lateral = d_forward * np.tan(np.deg2rad(batch['angle']))
+            x = np.sqrt(d_forward**2 + d_lateral**2)
+            for elevation, horizontal in zip(delta_y, x):
+                print("Elevation difference:", elevation, "Horizontal distance:", horizontal)
     except KeyboardInterrupt:
         print("Stopping LIDAR readings...")
     finally: